@@ -0,0 +1,255 @@
+"""Object Cache Server.
+
+A small HTTP server that shares an object cache directory with builds
+that set their objectCachePath to the server's URL. It is intended for
+tests and local or team deployments, not as a hardened public service.
+
+Run it with 'python -m cake.cacheserver --root=DIR'.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import os
+import shutil
+import sys
+import threading
+
+import cake.filesys
+import cake.objectcache
+import cake.zipping
+
+from cake.optparse import OptionParser
+
+DEFAULT_PORT = 8734
+"""The port the server listens on when not specified.
+"""
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves GET, HEAD and PUT requests for /object/<digest> and
+  /index/<digest> from the server's L{cake.objectcache.FileObjectCache}.
+  """
+
+  protocol_version = "HTTP/1.1" # Allow keep-alive connections.
+
+  def _getPath(self):
+    parts = self.path.strip("/").split("/")
+    if len(parts) < 2 or not cake.objectcache.isCacheDigest(parts[-1]):
+      return None, None
+    kind, digest = parts[-2], parts[-1].lower()
+    cache = self.server.cache
+    if kind == "object":
+      return kind, cache.getObjectPath(digest)
+    elif kind == "index":
+      return kind, cache.getIndexPath(digest)
+    else:
+      return None, None
+
+  def _sendStatus(self, status, data=""):
+    self.send_response(status)
+    self.send_header("Content-Type", "application/octet-stream")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    if data and self.command != "HEAD":
+      self.wfile.write(data)
+
+  def do_GET(self):
+    kind, path = self._getPath()
+    if path is None:
+      self._sendStatus(404)
+      return
+    try:
+      f = open(path, "rb")
+    except EnvironmentError:
+      self._sendStatus(404)
+      return
+    try:
+      if kind == "object":
+        # Mark the object as recently used.
+        try:
+          os.utime(path, None)
+        except EnvironmentError:
+          pass
+      self.send_response(200)
+      self.send_header("Content-Type", "application/octet-stream")
+      self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+      self.end_headers()
+      if self.command != "HEAD":
+        shutil.copyfileobj(f, self.wfile, cake.zipping.CHUNK_SIZE)
+    finally:
+      f.close()
+
+  do_HEAD = do_GET
+
+  def do_PUT(self):
+    kind, path = self._getPath()
+    length = int(self.headers.get("Content-Length", "0"))
+    if path is None:
+      self.rfile.read(length)
+      self._sendStatus(404)
+      return
+
+    def write(tempPath):
+      cake.filesys.makeDirs(os.path.dirname(tempPath))
+      f = open(tempPath, "wb")
+      try:
+        remaining = length
+        while remaining > 0:
+          data = self.rfile.read(min(remaining, cake.zipping.CHUNK_SIZE))
+          if not data:
+            raise EnvironmentError("request body is truncated")
+          f.write(data)
+          remaining -= len(data)
+      finally:
+        f.close()
+
+    try:
+      cake.objectcache.storeFileAtomic(path, write)
+    except EnvironmentError, e:
+      self.log_error("writing %s failed: %s", path, e)
+      self.close_connection = 1
+      self._sendStatus(500)
+      return
+    self._sendStatus(204)
+    if kind == "object":
+      self.server.objectStored(length)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """An HTTP server for an object cache directory.
+
+  If a maximum size is given then least recently used objects are
+  removed in the background as the cache grows past it.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, root, maxSize=None, verbose=False):
+    """Construct a cache server.
+
+    @param address: The (host, port) to listen on. Use port 0 to pick a
+    free port.
+    @type address: tuple
+    @param root: The path of the cache directory.
+    @type root: string
+    @param maxSize: The maximum size of the cache in bytes or None for no
+    limit.
+    @type maxSize: int or None
+    @param verbose: Whether to log each request to stderr.
+    @type verbose: bool
+    """
+    BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+    self.cache = cake.objectcache.FileObjectCache(os.path.abspath(root))
+    self.maxSize = maxSize
+    self.verbose = verbose
+    self._addedSize = 0
+    self._collecting = False
+    self._lock = threading.Lock()
+
+  @property
+  def url(self):
+    """The URL builds should use as their objectCachePath.
+    """
+    host, port = self.server_address[:2]
+    return "http://%s:%i/" % (host, port)
+
+  def objectStored(self, size):
+    """Called when an object is stored, to collect garbage if required.
+    """
+    if self.maxSize is None:
+      return
+    self._lock.acquire()
+    try:
+      self._addedSize += size
+      # Scan again once 10% of the maximum size has been added.
+      if self._collecting or self._addedSize < self.maxSize // 10:
+        return
+      addedSize = self._addedSize
+      self._addedSize = 0
+      self._collecting = True
+    finally:
+      self._lock.release()
+
+    def collect():
+      try:
+        self.cache.collectGarbage(self.maxSize, addedSize)
+      finally:
+        self._collecting = False
+    thread = threading.Thread(target=collect)
+    thread.setDaemon(True)
+    thread.start()
+
+def main(argv):
+  """Run a cache server as requested on the command line.
+
+  @param argv: The command-line args, not including the program name.
+  @type argv: list of string
+
+  @return: The exit code.
+  @rtype: int
+  """
+  parser = OptionParser(usage="python -m cake.cacheserver [options]")
+  parser.add_option(
+    "--root",
+    metavar="DIR",
+    help="The directory to store the cache in.",
+    default=None,
+    )
+  parser.add_option(
+    "--bind",
+    metavar="HOST",
+    help="The address to listen on (default: 127.0.0.1).",
+    default="127.0.0.1",
+    )
+  parser.add_option(
+    "--port",
+    type="int",
+    help="The port to listen on (default: %i)." % DEFAULT_PORT,
+    default=DEFAULT_PORT,
+    )
+  parser.add_option(
+    "--max-size",
+    metavar="BYTES",
+    dest="maxSize",
+    type="int",
+    help="Remove least recently used objects when the cache exceeds BYTES.",
+    default=None,
+    )
+  parser.add_option(
+    "-v", "--verbose",
+    action="store_true",
+    help="Log each request.",
+    default=False,
+    )
+  options, args = parser.parse_args(argv)
+  if options.root is None:
+    parser.error("--root must be specified")
+  if args:
+    parser.error("unknown args: %s" % " ".join(args))
+
+  server = CacheServer(
+    (options.bind, options.port),
+    options.root,
+    maxSize=options.maxSize,
+    verbose=options.verbose,
+    )
+  sys.stdout.write("cake: Serving object cache %s on %s\n" % (
+    server.cache.path,
+    server.url,
+    ))
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,634 @@
+"""Build Daemon.
+
+A build daemon is a long-lived Cake process that runs builds on behalf of
+thin clients connecting over a local socket. The daemon keeps the engine's
+in-memory caches (file timestamps and digests, script byte code, the file
+state cache and the dependency database) between builds, and uses a file
+watcher to find out which files have changed since the last build.
+
+Start a daemon in the root of a source tree with 'cake --daemon', then
+run builds anywhere below it with 'cake --use-daemon <usual args>'.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import binascii
+import errno
+import hmac
+import marshal
+import os
+import os.path
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+import cake.engine
+import cake.filesys
+import cake.logging
+import cake.runner
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+DEFAULT_SOCKET_NAME = ".cakedaemon"
+"""The name of the daemon's socket file when not specified.
+
+The daemon creates this file in its working directory. Clients search for
+it in their working directory and its parent directories.
+"""
+
+_lengthStruct = struct.Struct("<I")
+_tokenSize = 32 # Hex digits.
+_authTimeout = 5.0
+
+_useUnixSockets = hasattr(socket, "AF_UNIX")
+
+def _sendMessage(sock, message):
+  """Send a message made of simple python types.
+  """
+  data = marshal.dumps(message)
+  sock.sendall(_lengthStruct.pack(len(data)) + data)
+
+def _receiveExactly(sock, size):
+  chunks = []
+  while size:
+    data = sock.recv(min(size, 65536))
+    if not data:
+      return None
+    chunks.append(data)
+    size -= len(data)
+  return "".encode("latin-1").join(chunks)
+
+def _receiveMessage(sock):
+  """Receive a message sent by L{_sendMessage}.
+
+  @return: The message or None if the connection was closed.
+  """
+  header = _receiveExactly(sock, _lengthStruct.size)
+  if header is None:
+    return None
+  data = _receiveExactly(sock, _lengthStruct.unpack(header)[0])
+  if data is None:
+    return None
+  return marshal.loads(data)
+
+def _writePrivateFile(path, data):
+  """Write a file that only the current user can read.
+
+  On Windows only the read-only attribute can be set through the mode, so
+  the file has the permissions of its directory.
+  """
+  cake.filesys.remove(path)
+  flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+  f = os.fdopen(os.open(path, flags, 0600), "wb")
+  try:
+    f.write(data)
+  finally:
+    f.close()
+
+def _listen(socketPath):
+  """Create a socket listening for clients.
+
+  A unix domain socket is used where supported, only the current user can
+  connect to it. Otherwise a TCP socket bound to the loopback interface is
+  used. Any local user can connect to that, so its port is written to the
+  socket file along with a random token that clients must send before
+  they are served.
+
+  @return: A (listener, token) tuple where token is None if clients don't
+  need to send one.
+  @rtype: tuple of (socket, string or None)
+  """
+  if _useUnixSockets:
+    if os.path.exists(socketPath):
+      try:
+        _connect(socketPath).close()
+      except EnvironmentError:
+        os.remove(socketPath) # Left behind by a daemon that has exited.
+      else:
+        raise EnvironmentError("A build daemon is already listening on " + socketPath)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socketPath)
+    os.chmod(socketPath, 0600)
+    token = None
+  else:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    token = binascii.hexlify(os.urandom(_tokenSize // 2))
+    data = "%i %s" % (listener.getsockname()[1], token)
+    _writePrivateFile(socketPath, data.encode("latin-1"))
+  listener.listen(5)
+  return listener, token
+
+def _connect(socketPath):
+  """Connect to the daemon listening on a socket file.
+  """
+  token = None
+  if _useUnixSockets:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    address = socketPath
+  else:
+    try:
+      port, token = cake.filesys.readFile(socketPath).decode("latin-1").split()
+      address = ("127.0.0.1", int(port))
+    except ValueError:
+      raise EnvironmentError("Invalid socket file " + socketPath)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.connect(address)
+    if token is not None:
+      sock.sendall(token.encode("latin-1"))
+  except EnvironmentError:
+    sock.close()
+    raise
+  return sock
+
+def _authenticate(conn, token):
+  """Check that a client sent the token from the socket file.
+
+  @return: True if the client may be served.
+  @rtype: bool
+  """
+  if token is None:
+    return True
+  conn.settimeout(_authTimeout)
+  try:
+    received = _receiveExactly(conn, len(token))
+  finally:
+    conn.settimeout(None)
+  return received is not None and hmac.compare_digest(received, token)
+
+class PollingWatcher(object):
+  """Finds changed files by stat'ing every file the engine knows about.
+
+  This is as slow as a build without a daemon at finding changes, but
+  still avoids reloading scripts and caches between builds.
+  """
+
+  def findChanges(self, engine):
+    """Find the files that have changed since the engine cached them.
+
+    @param engine: The engine whose cached timestamps should be checked.
+    @type engine: L{cake.engine.Engine}
+
+    @return: The paths of the files that have changed.
+    @rtype: list of string
+    """
+    return self._poll(engine._timestampCache.items())
+
+  def _poll(self, items):
+    changed = []
+    stat = os.stat
+    for path, timestamp in items:
+      try:
+        if stat(path).st_mtime != timestamp:
+          changed.append(path)
+      except EnvironmentError:
+        changed.append(path)
+    return changed
+
+class InotifyWatcher(PollingWatcher):
+  """Finds changed files using Linux inotify events.
+
+  The directories of all files the engine knows about are watched. Events
+  are queued by the kernel and read when the next build starts, so no
+  changes are missed between builds.
+  """
+
+  _mask = 0
+  if pyinotify is not None:
+    _mask = (
+      pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY |
+      pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+      pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+      )
+
+  def __init__(self):
+    self._changed = set()
+    self._overflowed = False
+    self._watchedDirs = set()
+    self._watchManager = pyinotify.WatchManager()
+    self._notifier = pyinotify.Notifier(self._watchManager, self._onEvent, timeout=0)
+
+  def _onEvent(self, event):
+    if event.mask & pyinotify.IN_Q_OVERFLOW:
+      self._overflowed = True
+    else:
+      self._changed.add(event.pathname)
+
+  def findChanges(self, engine):
+    notifier = self._notifier
+    while notifier.check_events(timeout=0):
+      notifier.read_events()
+      notifier.process_events()
+
+    changed = self._changed
+    self._changed = set()
+    if self._overflowed:
+      # Events have been lost so we don't know what has changed.
+      self._overflowed = False
+      return PollingWatcher.findChanges(self, engine)
+
+    # Start watching the directories of any newly cached files. They may
+    # have changed before the watch was added so check them once by hand.
+    watchedDirs = self._watchedDirs
+    newItems = []
+    newDirs = set()
+    for item in engine._timestampCache.items():
+      dirPath = os.path.dirname(item[0])
+      if dirPath not in watchedDirs:
+        newDirs.add(dirPath)
+        newItems.append(item)
+    for dirPath in newDirs:
+      self._watchManager.add_watch(dirPath, self._mask, quiet=True)
+    watchedDirs.update(newDirs)
+
+    changed.update(self._poll(newItems))
+    return list(changed)
+
+def createWatcher():
+  """Create the best file watcher available on this platform.
+
+  @rtype: L{PollingWatcher}
+  """
+  if pyinotify is not None:
+    return InotifyWatcher()
+  else:
+    return PollingWatcher()
+
+class _ForwardingStream(object):
+  """A file-like object that sends everything written to a client.
+  """
+
+  def __init__(self, sock, name):
+    self._sock = sock
+    self._name = name
+    self._lock = threading.Lock()
+    self._broken = False
+
+  def write(self, text):
+    self._lock.acquire()
+    try:
+      if not self._broken:
+        try:
+          _sendMessage(self._sock, (self._name, text))
+        except EnvironmentError:
+          # The client has gone, just finish the build silently.
+          self._broken = True
+    finally:
+      self._lock.release()
+
+  def flush(self):
+    pass
+
+class _FileDescriptorForwarder(object):
+  """Forwards everything written to a file descriptor to a stream.
+
+  Used to send the output of child processes that inherit the daemon's
+  stdout or stderr rather than capturing their output to the client.
+  The file descriptor is replaced by a pipe until L{close} is called.
+  """
+
+  closeTimeout = 1.0
+  """How long to wait for processes still writing to the pipe when closed.
+  Any output they write after this is discarded.
+  """
+
+  def __init__(self, fd, stream):
+    self._fd = fd
+    self._stream = stream
+    self._savedFd = os.dup(fd)
+    self._readFd, writeFd = os.pipe()
+    for f in (self._savedFd, self._readFd):
+      fcntl.fcntl(f, fcntl.F_SETFD, fcntl.fcntl(f, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    os.dup2(writeFd, fd)
+    os.close(writeFd)
+    self._thread = threading.Thread(target=self._run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def _run(self):
+    readFd = self._readFd
+    try:
+      while True:
+        try:
+          data = os.read(readFd, 65536)
+        except EnvironmentError, e:
+          if e.errno == errno.EINTR:
+            continue
+          break
+        if not data:
+          break # All writers have closed the pipe.
+        self._stream.write(data)
+    finally:
+      os.close(readFd)
+
+  def close(self):
+    """Restore the file descriptor and forward any remaining output.
+    """
+    os.dup2(self._savedFd, self._fd)
+    os.close(self._savedFd)
+    self._thread.join(self.closeTimeout)
+
+class BuildServer(object):
+  """Runs builds requested by clients, keeping caches between builds.
+
+  Builds are run one at a time. Each build uses a fresh engine and
+  re-executes the configuration and build scripts, but the scripts'
+  byte code and all file information are shared with previous builds.
+  """
+
+  def __init__(self, socketPath, watcher=None):
+    """Construct a build server.
+
+    @param socketPath: The path of the socket file to listen on.
+    @type socketPath: string
+    @param watcher: The file watcher used to find changed files. If None
+    the best available watcher is used.
+    @type watcher: L{PollingWatcher} or None
+    """
+    if watcher is None:
+      watcher = createWatcher()
+    self.socketPath = socketPath
+    self.watcher = watcher
+    self._stopped = False
+    self._cacheFileStates = {}
+    # The cache engine is never built with, it just holds the caches
+    # between builds.
+    self._cacheEngine = cake.engine.Engine(cake.logging.Logger(), None, [])
+    self._cacheEngine.scriptThreadPool.shutdown()
+
+  def serveForever(self):
+    """Serve clients until a client asks the server to stop.
+    """
+    listener, token = _listen(self.socketPath)
+    try:
+      while not self._stopped:
+        conn = listener.accept()[0]
+        try:
+          try:
+            self._handleConnection(conn, token)
+          except EnvironmentError:
+            pass # Client went away.
+        finally:
+          conn.close()
+    finally:
+      listener.close()
+      cake.filesys.remove(self.socketPath)
+
+  def _handleConnection(self, conn, token=None):
+    if not _authenticate(conn, token):
+      return
+
+    request = _receiveMessage(conn)
+    if request is None:
+      return
+
+    if request[0] == "stop":
+      self._stopped = True
+      _sendMessage(conn, ("exit", 0))
+    elif request[0] == "build":
+      args, cwd, environ = request[1:]
+      exitCode = self.build(
+        args,
+        cwd,
+        environ,
+        stdout=_ForwardingStream(conn, "stdout"),
+        stderr=_ForwardingStream(conn, "stderr"),
+        )
+      _sendMessage(conn, ("exit", exitCode))
+
+  def build(self, args, cwd, environ, stdout, stderr):
+    """Run a single build.
+
+    The output of child processes that don't capture it, eg. those run by
+    L{cake.library.shell.ShellTool}, is also written to stdout and stderr.
+    This isn't supported on Windows, where it goes to the daemon's console.
+
+    @param args: The command-line args for the build.
+    @type args: list of string
+    @param cwd: The client's working directory.
+    @type cwd: string
+    @param environ: The client's environment variables.
+    @type environ: dict
+    @param stdout: Where standard output of the build should be written.
+    @type stdout: file-like object
+    @param stderr: Where standard error of the build should be written.
+    @type stderr: file-like object
+
+    @return: The exit code of the build.
+    @rtype: int
+    """
+    cacheEngine = self._cacheEngine
+    changed = self.watcher.findChanges(cacheEngine)
+    changed.extend(self._findCacheFileChanges())
+    for path in changed:
+      cacheEngine.notifyFileChanged(path)
+
+    oldCwd = os.getcwd()
+    oldEnviron = dict(os.environ)
+    oldStdout, oldStderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    forwarders = []
+    if fcntl is not None:
+      # Child processes inherit the file descriptors, not sys.stdout.
+      for f in (sys.__stdout__, sys.__stderr__):
+        f.flush()
+      forwarders.append(_FileDescriptorForwarder(1, stdout))
+      forwarders.append(_FileDescriptorForwarder(2, stderr))
+    try:
+      os.environ.clear()
+      os.environ.update(environ)
+      os.chdir(cwd)
+      try:
+        return cake.runner.run(args, cwd, cacheEngine=cacheEngine)
+      except SystemExit, e:
+        # Raised by the option parser on bad args.
+        if e.code is None:
+          return 0
+        elif isinstance(e.code, int):
+          return e.code
+        stderr.write(str(e.code) + "\n")
+        return 1
+      except Exception:
+        stderr.write(traceback.format_exc())
+        return 1
+    finally:
+      for forwarder in forwarders:
+        forwarder.close()
+      sys.stdout, sys.stderr = oldStdout, oldStderr
+      os.chdir(oldCwd)
+      os.environ.clear()
+      os.environ.update(oldEnviron)
+      self._recordCacheFileStates()
+
+  def _cacheFilePaths(self):
+    paths = []
+    cacheEngine = self._cacheEngine
+    if cacheEngine._dependencyDatabase is not None:
+      paths.append(cacheEngine._dependencyDatabase.path)
+    if cacheEngine._fileStateCache is not None:
+      paths.append(cacheEngine._fileStateCache.path)
+    return paths
+
+  def _recordCacheFileStates(self):
+    """Remember the state of the persistent cache files after a build.
+    """
+    states = {}
+    for path in self._cacheFilePaths():
+      try:
+        s = os.stat(path)
+        states[path] = (s.st_mtime, s.st_size)
+      except EnvironmentError:
+        states[path] = None
+    self._cacheFileStates = states
+
+  def _findCacheFileChanges(self):
+    """Find persistent cache files changed by another Cake process.
+    """
+    changed = []
+    for path, state in self._cacheFileStates.items():
+      try:
+        s = os.stat(path)
+        if (s.st_mtime, s.st_size) != state:
+          changed.append(path)
+      except EnvironmentError:
+        if state is not None:
+          changed.append(path)
+    return changed
+
+def findSocket(path):
+  """Search up from a directory for a daemon's socket file.
+
+  @param path: The directory to start searching from.
+  @type path: string
+
+  @return: The path of the socket file or None if not found.
+  @rtype: string or None
+  """
+  while True:
+    socketPath = os.path.join(path, DEFAULT_SOCKET_NAME)
+    if os.path.exists(socketPath):
+      return socketPath
+    parent = os.path.dirname(path)
+    if parent == path:
+      return None
+    path = parent
+
+def runClient(socketPath, args, cwd):
+  """Ask a build daemon to run a build.
+
+  The build's output is written to this process's stdout and stderr.
+
+  @param socketPath: The daemon's socket file.
+  @type socketPath: string
+  @param args: The command-line args for the build.
+  @type args: list of string
+  @param cwd: The working directory of the build.
+  @type cwd: string
+
+  @return: The exit code of the build.
+  @rtype: int
+
+  @raise EnvironmentError: If the daemon could not be contacted.
+  """
+  sock = _connect(socketPath)
+  try:
+    _sendMessage(sock, ("build", list(args), cwd, dict(os.environ)))
+    while True:
+      message = _receiveMessage(sock)
+      if message is None:
+        sys.stderr.write("cake: Lost connection to the build daemon.\n")
+        return 1
+      kind, data = message
+      if kind == "exit":
+        return data
+      elif kind == "stdout":
+        sys.stdout.write(data)
+        sys.stdout.flush()
+      else:
+        sys.stderr.write(data)
+        sys.stderr.flush()
+  finally:
+    sock.close()
+
+def main(args, cwd):
+  """Run, use or stop a build daemon as requested on the command line.
+
+  @param args: The command-line args including one of '--daemon',
+  '--use-daemon' or '--stop-daemon'.
+  @type args: list of string
+  @param cwd: The working directory.
+  @type cwd: string
+
+  @return: The exit code.
+  @rtype: int
+  """
+  mode = None
+  socketPath = None
+  buildArgs = []
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    i += 1
+    if arg in ("--daemon", "--use-daemon", "--stop-daemon"):
+      mode = arg
+    elif arg == "--daemon-socket" and i < len(args):
+      socketPath = args[i]
+      i += 1
+    elif arg.startswith("--daemon-socket="):
+      socketPath = arg[len("--daemon-socket="):]
+    else:
+      buildArgs.append(arg)
+  if socketPath is not None:
+    socketPath = os.path.join(cwd, socketPath)
+
+  if mode == "--daemon":
+    if socketPath is None:
+      socketPath = os.path.join(cwd, DEFAULT_SOCKET_NAME)
+    server = BuildServer(socketPath)
+    sys.stdout.write("cake: Build daemon listening on %s (%s).\n" % (
+      socketPath,
+      server.watcher.__class__.__name__,
+      ))
+    sys.stdout.flush()
+    server.serveForever()
+    return 0
+
+  if socketPath is None:
+    socketPath = findSocket(cwd)
+
+  if mode == "--stop-daemon":
+    try:
+      if socketPath is None:
+        raise EnvironmentError("no socket file found")
+      sock = _connect(socketPath)
+      try:
+        _sendMessage(sock, ("stop",))
+        _receiveMessage(sock)
+      finally:
+        sock.close()
+    except EnvironmentError, e:
+      sys.stderr.write("cake: Could not stop the build daemon: %s\n" % e)
+      return 1
+    return 0
+
+  if socketPath is not None:
+    try:
+      return runClient(socketPath, buildArgs, cwd)
+    except EnvironmentError, e:
+      # Fall through to building locally.
+      sys.stderr.write("cake: Could not contact the build daemon: %s\n" % e)
+  sys.stderr.write("cake: No build daemon found, building without it.\n")
+  return cake.runner.run(buildArgs, cwd)
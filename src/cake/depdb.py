@@ -0,0 +1,467 @@
+"""Dependency Info Database.
+
+A single-file alternative to storing one dependency info file per target.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import array
+import errno
+import os
+import struct
+import threading
+import zlib
+
+import cake.filesys
+
+class PathTable(object):
+  """A table of interned paths.
+  
+  Each unique path is assigned a small integer id the first time it is
+  interned. Ids are never reassigned, so dependency infos can refer to
+  paths by id and share a single copy of each path string.
+  """
+  
+  def __init__(self, onAdd=None):
+    """Construct an empty path table.
+    
+    @param onAdd: An optional callable called with (id, path) whenever a
+    new path is added to the table. Used to persist the table.
+    @type onAdd: any callable or None
+    """
+    self._paths = []
+    self._ids = {}
+    self._lock = threading.Lock()
+    self._onAdd = onAdd
+    
+  def __len__(self):
+    return len(self._paths)
+  
+  @property
+  def isPersistent(self):
+    """True if ids remain valid for paths in future builds.
+    """
+    return self._onAdd is not None
+  
+  def intern(self, path):
+    """Get the id of a path, adding it to the table if required.
+    
+    @param path: The path to intern.
+    @type path: string
+    
+    @return: The id of the path.
+    @rtype: int
+    """
+    id = self._ids.get(path, None)
+    if id is None:
+      self._lock.acquire()
+      try:
+        id = self._ids.get(path, None)
+        if id is None:
+          id = len(self._paths)
+          self._paths.append(path)
+          self._ids[path] = id
+          if self._onAdd is not None:
+            self._onAdd(id, path)
+      finally:
+        self._lock.release()
+    return id
+  
+  def internAll(self, paths):
+    """Get the ids of a sequence of paths.
+    
+    @param paths: The paths to intern.
+    @type paths: sequence of string
+    
+    @return: An array of the path ids.
+    @rtype: array.array of int
+    """
+    intern = self.intern
+    return array.array('l', [intern(p) for p in paths])
+  
+  def getPath(self, id):
+    """Get the path with the specified id.
+    
+    @rtype: string
+    """
+    return self._paths[id]
+  
+  def getPaths(self, ids):
+    """Get the paths with the specified ids.
+    
+    @rtype: list of string
+    """
+    paths = self._paths
+    return [paths[i] for i in ids]
+  
+  def _load(self, paths):
+    """Replace the contents of the table with previously persisted paths.
+    """
+    self._lock.acquire()
+    try:
+      self._paths = list(paths)
+      self._ids = dict((p, i) for i, p in enumerate(self._paths))
+    finally:
+      self._lock.release()
+
+class DependencyDatabase(object):
+  """An append-only log of target -> dependency info records.
+
+  The whole log is read into an in-memory index when loaded. Storing a
+  record appends it to the end of the log, superseding any earlier record
+  for the same target. Superseded records are discarded when the log is
+  compacted.
+
+  Records are stored as opaque byte strings, it is up to the caller to
+  serialise and deserialise them.
+  
+  The log also persists a L{PathTable} so that records can refer to
+  dependency paths by id.
+  
+  Path ids are positions in the log, so only one process may write to a
+  database at a time. A writable database takes an exclusive lock on a
+  '.lock' file next to the database file when loaded and releases it when
+  closed. If another process holds the lock the database is loaded
+  read-only instead. Processes that need to share a database should each
+  write to a journal (see L{cake.engine.Engine.dependencyJournalPath}).
+  
+  @ivar pathTable: The persistent path table stored in this database.
+  @type pathTable: L{PathTable}
+  """
+
+  MAGIC = "CKDB".encode("latin-1") # We need bytes for Python 3.x
+  """A magic value stored at the start of the database file.
+
+  @type: string
+  """
+
+  VERSION = 2
+  """The most recent database file version.
+
+  @type: int
+  """
+
+  compactRatio = 1.0
+  """Compact the log when the ratio of superseded to live records exceeds
+  this value.
+
+  @type: float
+  """
+
+  compactMinimum = 1000
+  """The minimum number of superseded records before the log is compacted.
+
+  @type: int
+  """
+
+  _header = struct.Struct("<4sI") # magic, version
+  _record = struct.Struct("<BIII") # type, key length, data length, crc32
+  
+  _TYPE_VALUE = 0
+  _TYPE_PATH = 1
+
+  def __init__(self, path, readOnly=False):
+    """Construct an empty dependency database.
+
+    @param path: The path of the database file.
+    @type path: string
+    @param readOnly: If True the database file is never written. Records
+    stored and paths added are only kept in memory, so the path table is
+    not persistent.
+    @type readOnly: bool
+    """
+    self.path = path
+    self.readOnly = readOnly
+    self._index = {}
+    self._garbage = 0
+    self._needsRewrite = False
+    self._file = None
+    self._fileSize = 0
+    self._writeLock = None
+    self._lock = threading.Lock()
+    if readOnly:
+      self.pathTable = PathTable()
+    else:
+      self.pathTable = PathTable(onAdd=self._addPath)
+
+  def __len__(self):
+    return len(self._index)
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def keys(self):
+    """Return the keys of all records in the database.
+
+    @rtype: list of string
+    """
+    return list(self._index.keys())
+
+  def load(self):
+    """Load the entire database into memory.
+
+    A missing database results in an empty database. If the database is
+    corrupt then all records up to the point of corruption are kept and the
+    database is rewritten when next modified or closed.
+    
+    A writable database is locked for writing first. If another process
+    has it locked then it is loaded read-only instead, and L{readOnly} is
+    set.
+    """
+    if not self.readOnly and self._writeLock is None:
+      try:
+        self._writeLock = cake.filesys.lockFile(self.path + ".lock")
+      except EnvironmentError:
+        pass
+      if self._writeLock is None:
+        self.readOnly = True
+        self.pathTable = PathTable()
+    
+    try:
+      data = cake.filesys.readFile(self.path)
+    except EnvironmentError:
+      return
+
+    index = {}
+    paths = []
+    garbage = 0
+    needsRewrite = False
+
+    headerSize = self._header.size
+    if len(data) < headerSize or \
+       self._header.unpack_from(data, 0) != (self.MAGIC, self.VERSION):
+      needsRewrite = True
+    else:
+      unpackRecord = self._record.unpack_from
+      recordSize = self._record.size
+      dataLen = len(data)
+      offset = headerSize
+      while offset < dataLen:
+        if offset + recordSize > dataLen:
+          needsRewrite = True
+          break
+        recordType, keyLen, valueLen, crc = unpackRecord(data, offset)
+        start = offset + recordSize
+        end = start + keyLen + valueLen
+        if end > dataLen or (zlib.crc32(data[start:end]) & 0xffffffff) != crc:
+          # Truncated or corrupt record, probably due to the build being
+          # interrupted while writing. Ignore it and everything after it.
+          needsRewrite = True
+          break
+        try:
+          key = data[start:start + keyLen].decode("utf8")
+        except UnicodeError:
+          needsRewrite = True
+          break
+        if recordType == self._TYPE_PATH:
+          paths.append(key)
+        else:
+          if key in index:
+            garbage += 1
+          index[key] = data[start + keyLen:end]
+        offset = end
+
+    self._lock.acquire()
+    try:
+      self._index = index
+      self.pathTable._load(paths)
+      self._garbage = garbage
+      self._needsRewrite = needsRewrite
+      self._fileSize = len(data)
+    finally:
+      self._lock.release()
+
+  def get(self, key):
+    """Get the data stored for a key.
+
+    @param key: The key of the record, usually the target's absolute path.
+    @type key: string
+
+    @return: The data stored for the key or None if there is no record.
+    @rtype: string or None
+    """
+    return self._index.get(key, None)
+
+  def put(self, key, value):
+    """Store the data for a key.
+
+    The record is appended to the database file immediately so that it
+    isn't lost if the build is interrupted.
+
+    @param key: The key of the record, usually the target's absolute path.
+    @type key: string
+    @param value: The data to store.
+    @type value: string
+
+    @raise EnvironmentError: If the record could not be written.
+    """
+    record = self._packRecord(self._TYPE_VALUE, key, value)
+
+    self._lock.acquire()
+    try:
+      if key in self._index:
+        self._garbage += 1
+      self._index[key] = value
+      self._append(record)
+    finally:
+      self._lock.release()
+
+  def discard(self, keys):
+    """Discard the records for some keys.
+
+    The records are only removed from the database file when it is
+    compacted, until then they will reappear if the database is loaded
+    again. Use L{needsCompaction} to check whether closing the database
+    will remove them.
+
+    @param keys: The keys of the records to discard.
+    @type keys: iterable of string
+    """
+    self._lock.acquire()
+    try:
+      for key in keys:
+        self._index.pop(key, None)
+    finally:
+      self._lock.release()
+
+  @property
+  def needsCompaction(self):
+    """Whether the database file will be compacted when closed.
+
+    @rtype: bool
+    """
+    garbage = self._garbage
+    return not self.readOnly and (self._needsRewrite or (
+      garbage >= self.compactMinimum and garbage > len(self._index) * self.compactRatio
+      ))
+
+  def _addPath(self, id, path):
+    """Append a newly interned path to the database file.
+    """
+    record = self._packRecord(self._TYPE_PATH, path, "".encode("latin-1"))
+    
+    self._lock.acquire()
+    try:
+      self._append(record)
+    finally:
+      self._lock.release()
+      
+  def _append(self, record):
+    """Append a record to the database file.
+    
+    Must be called with the lock held.
+    """
+    if self.readOnly:
+      return
+    
+    if self._writeLock is None:
+      self._relock()
+    
+    f = self._file
+    if f is None and (self._needsRewrite or not cake.filesys.isFile(self.path)):
+      # Write a fresh file, discarding any corrupt records.
+      self._compact()
+      return
+    
+    try:
+      if f is None:
+        f = self._file = open(self.path, "ab")
+      f.write(record)
+      f.flush()
+      self._fileSize += len(record)
+    except EnvironmentError:
+      # The file may now end with a partial record. Rewrite it on the next
+      # write so that path ids stay consistent with the in-memory table.
+      self._needsRewrite = True
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+      raise
+
+  def _relock(self):
+    """Lock the database for writing again after it was closed.
+
+    Must be called with the lock held.
+
+    @raise EnvironmentError: If another process has the database locked
+    or has written to it since it was closed. The database is read-only
+    from then on.
+    """
+    writeLock = cake.filesys.lockFile(self.path + ".lock")
+    if writeLock is None:
+      self.readOnly = True
+      raise EnvironmentError(
+        errno.EAGAIN,
+        "Database is locked by another process",
+        self.path,
+        )
+    try:
+      fileSize = os.path.getsize(self.path)
+    except EnvironmentError:
+      fileSize = 0
+    if fileSize != self._fileSize:
+      # Our path ids may no longer match those in the file.
+      cake.filesys.unlockFile(writeLock)
+      self.readOnly = True
+      raise EnvironmentError(
+        errno.EAGAIN,
+        "Database was modified by another process",
+        self.path,
+        )
+    self._writeLock = writeLock
+
+  def close(self):
+    """Close the database file, compacting it first if required.
+
+    The write lock is released, so the database must be loaded again if
+    another process may have written to it since.
+
+    @raise EnvironmentError: If the database could not be compacted.
+    """
+    self._lock.acquire()
+    try:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+      try:
+        if self.needsCompaction:
+          if self._writeLock is None:
+            self._relock()
+          self._compact()
+      finally:
+        if self._writeLock is not None:
+          cake.filesys.unlockFile(self._writeLock)
+          self._writeLock = None
+    finally:
+      self._lock.release()
+
+  def _compact(self):
+    """Rewrite the database file with only the live records.
+
+    Must be called with the lock held.
+    """
+    chunks = [self._header.pack(self.MAGIC, self.VERSION)]
+    packRecord = self._packRecord
+    # Paths must be written first and in id order.
+    noValue = "".encode("latin-1")
+    for path in self.pathTable.getPaths(xrange(len(self.pathTable))):
+      chunks.append(packRecord(self._TYPE_PATH, path, noValue))
+    for key, value in self._index.iteritems():
+      chunks.append(packRecord(self._TYPE_VALUE, key, value))
+
+    data = "".encode("latin-1").join(chunks)
+    tempPath = "%s.%i.tmp" % (self.path, os.getpid())
+    cake.filesys.writeFile(tempPath, data)
+    cake.filesys.replaceFile(tempPath, self.path)
+    self._fileSize = len(data)
+    self._garbage = 0
+    self._needsRewrite = False
+
+  def _packRecord(self, recordType, key, value):
+    encodedKey = key.encode("utf8")
+    body = encodedKey + value
+    crc = zlib.crc32(body) & 0xffffffff
+    return self._record.pack(recordType, len(encodedKey), len(value), crc) + body
@@ -5,7 +5,9 @@
 @license: Licensed under the MIT license.
 """
 
+import array
 import codecs
+import errno
 import threading
 import traceback
 import sys
@@ -19,11 +21,25 @@ try:
 except ImportError:
   import pickle
 
+try:
+  _scandir = os.scandir
+except AttributeError:
+  try:
+    from scandir import scandir as _scandir
+  except ImportError:
+    _scandir = None
+
 import cake.bytecode
 import cake.task
 import cake.path
 import cake.hash
+import cake.depdb
 import cake.filesys
+import cake.filestate
+import cake.includegraph
+import cake.objectcache
+import cake.scanner
+import cake.slots
 import cake.threadpool
 
 from cake.script import Script as _Script
@@ -157,6 +173,17 @@ class Engine(object):
 
   @ivar oscwd: The initial working directory when Cake was first started.
   @type oscwd: string
+
+  @ivar cacheStatistics: Counts of object cache hits, misses and stores
+  and of the time spent calculating file digests during the build.
+  @type cacheStatistics: L{cake.objectcache.CacheStatistics}
+
+  @ivar processSlots: Limits the processes run at once by tools. By
+  default the number of processes is only limited by the thread pool.
+  @type processSlots: L{cake.slots.ProcessSlots}
+  @ivar includeScanner: Finds the files included by sources without
+  compiling them, caching what it finds for the rest of the build.
+  @type includeScanner: L{cake.scanner.IncludeScanner}
   """
   
   scriptCachePath = None
@@ -175,6 +202,77 @@ class Engine(object):
   target files themselves with a different extension (usually .dep).
   @type: string or None
   """
+  dependencyDatabasePath = None
+  """Path of the dependency info database.
+  
+  The absolute path of a single database file that should store the
+  dependency info of all targets. The database is loaded once at the start
+  of a build and compacted when it accumulates too many stale records. If
+  None the dependency info is stored in separate files (see
+  L{dependencyInfoPath}).
+  
+  Only one build may write to the database at a time. A build that finds
+  it locked by another only reads from it, so builds that run at the same
+  time should use L{dependencyJournalPath}.
+  @type: string or None
+  """
+  
+  dependencyJournalPath = None
+  """Path of a journal to write new dependency info to.
+  
+  If not None then the dependency database is only read from, and the
+  dependency info of targets built is written to this file instead so
+  that several Cake processes can share one dependency database. The
+  journal is merged into the database with L{mergeDependencyJournal}
+  once all of the processes have finished. This has no effect if the
+  dependency database is not being used.
+  @type: string or None
+  """
+  
+  fileStateCachePath = None
+  """Path of the persistent file state cache.
+  
+  The absolute path of a file used to remember the timestamps, sizes and
+  digests of files between builds. If None file digests are only cached for
+  the duration of a single build.
+  @type: string or None
+  """
+  
+  statKnownDependenciesFirst = False
+  """Stat all files known from previous builds before building.
+  
+  If True then the files known from the dependency database and the file
+  state cache are stat'ed in parallel before any targets are checked (see
+  L{statKnownDependencies}). This has no effect unless one of those
+  caches is enabled.
+  @type: bool
+  """
+  
+  scanDirectories = False
+  """Read whole directories when looking up file timestamps.
+  
+  If True then the first time the timestamp of a file is requested the
+  contents of its directory are listed and cached. Files missing from the
+  listing are known not to exist without further system calls. Where
+  the directory listing also provides the file timestamps (eg. Windows)
+  the timestamps of all files in the directory are cached at once.
+  
+  Tools that write files must report them through
+  L{Configuration.createDependencyInfo} or L{notifyFileChanged} so that
+  cached directory listings stay up to date.
+  @type: bool
+  """
+  
+  criticalPathScheduling = False
+  """Prioritise builds on the critical path of previous builds.
+  
+  If True then each target's build task is given a priority equal to the
+  number of seconds previous builds took to build it and everything
+  that was built using it (see L{Configuration.getBuildPriority}). This
+  requires the dependency database and a thread pool that supports
+  priorities, eg. L{cake.threadpool.WorkStealingThreadPool}.
+  @type: bool
+  """
   
   forceBuild = False
   defaultConfigScriptName = "config.cake"
@@ -185,7 +283,17 @@ class Engine(object):
     """
     self._byteCodeCache = {}
     self._timestampCache = {}
+    self._directoryCache = {}
+    self._directoryCacheLock = threading.Lock()
     self._digestCache = {}
+    self._fileStateCache = None
+    self._fileStateCacheLock = threading.Lock()
+    self._dependencyDatabase = None
+    self._dependencyDatabaseLock = threading.Lock()
+    self._dependencyJournal = None
+    self._pathTable = None
+    self._includeNodeReasons = {}
+    self._includeNodePaths = set()
     self._searchUpCache = {}
     self._configurations = {}
     self.scriptThreadPool = cake.threadpool.ThreadPool(1)
@@ -199,6 +307,9 @@ class Engine(object):
     self.oscwd = os.getcwd() # Save original cwd in case someone changes it.
     self.buildSuccessCallbacks = []
     self.buildFailureCallbacks = []
+    self.cacheStatistics = cake.objectcache.CacheStatistics()
+    self.processSlots = cake.slots.ProcessSlots()
+    self.includeScanner = cake.scanner.IncludeScanner()
 
   @property
   def errorCount(self):
@@ -521,6 +632,12 @@ class Engine(object):
     """
     byteCode = self._byteCodeCache.get(path, None)
     if byteCode is None:
+      # Record the timestamp so that a file watcher can tell when the
+      # script has changed.
+      try:
+        self.getTimestamp(path)
+      except EnvironmentError:
+        pass # Let loadCode() report the error.
       # Cache the code in a user-supplied directory if provided.
       if self.scriptCachePath is not None:
         assert cake.path.isAbs(path) # Need an absolute path to get a unique hash.
@@ -549,7 +666,108 @@ class Engine(object):
     @param path: The path of the file that has changed.
     @type path: string
     """
-    self._timestampCache.pop(path, None)
+    if self.scanDirectories or self._directoryCache:
+      dirPath, name = os.path.split(path)
+      self._directoryCacheLock.acquire()
+      try:
+        # The file may have just been created, so make sure it is listed.
+        names = self._directoryCache.get(os.path.normcase(dirPath), None)
+        if names is not None:
+          names.add(os.path.normcase(name))
+        # If the path is a directory then its contents may have changed.
+        self._directoryCache.pop(os.path.normcase(path), None)
+        self._timestampCache.pop(path, None)
+      finally:
+        self._directoryCacheLock.release()
+    else:
+      self._timestampCache.pop(path, None)
+    self._byteCodeCache.pop(path, None)
+    self.includeScanner.invalidate(path)
+    if path in self._includeNodePaths:
+      # Include graph nodes for the file must be checked again.
+      self._includeNodeReasons = {}
+    
+    # The persistent caches must be reloaded if changed by someone else.
+    dependencyDatabase = self._dependencyDatabase
+    if dependencyDatabase is not None and dependencyDatabase.path == path:
+      self._dependencyDatabase = None
+      self._pathTable = None
+    fileStateCache = self._fileStateCache
+    if fileStateCache is not None:
+      if fileStateCache.path == path:
+        self._fileStateCache = None
+      else:
+        fileStateCache.invalidate(path)
+
+  def adoptCaches(self, engine):
+    """Share the in-memory caches of another engine.
+    
+    This allows file timestamps, digests, script byte code and the
+    persistent caches to be kept between builds run by the same process.
+    Both engines must not be building at the same time, and any files
+    that change between builds must be reported through
+    L{notifyFileChanged}.
+    
+    @param engine: The engine whose caches should be shared.
+    @type engine: L{Engine}
+    """
+    self._byteCodeCache = engine._byteCodeCache
+    self._timestampCache = engine._timestampCache
+    self._directoryCache = engine._directoryCache
+    self._digestCache = engine._digestCache
+    self._fileStateCache = engine._fileStateCache
+    self._dependencyDatabase = engine._dependencyDatabase
+    # The path table is looked up again in case the database path changes.
+    self._pathTable = None
+
+  def _getFileStateCache(self):
+    """Get the persistent file state cache, loading it on first use.
+    
+    @return: The file state cache or None if not enabled.
+    @rtype: L{cake.filestate.FileStateCache} or None
+    """
+    fileStateCache = self._fileStateCache
+    if fileStateCache is None or fileStateCache.path != self.fileStateCachePath:
+      # An adopted cache may have been for a different path.
+      if self.fileStateCachePath is None:
+        return None
+      self._fileStateCacheLock.acquire()
+      try:
+        fileStateCache = self._fileStateCache
+        if fileStateCache is None or fileStateCache.path != self.fileStateCachePath:
+          fileStateCache = cake.filestate.FileStateCache(self.fileStateCachePath)
+          fileStateCache.load()
+          self._fileStateCache = fileStateCache
+      finally:
+        self._fileStateCacheLock.release()
+    return fileStateCache
+
+  def flushCaches(self):
+    """Write any persistent caches back to disk.
+    
+    This should be called once the build has finished.
+    """
+    dependencyDatabase = self._dependencyDatabase
+    if dependencyDatabase is not None and dependencyDatabase.needsCompaction:
+      self._pruneIncludeGraph(dependencyDatabase)
+      
+    for dependencyDatabase in (self._dependencyDatabase, self._dependencyJournal):
+      if dependencyDatabase is not None:
+        try:
+          dependencyDatabase.close()
+        except EnvironmentError, e:
+          self.logger.outputWarning(
+            "cake: Error compacting dependency database %s: %s\n" % (dependencyDatabase.path, e)
+            )
+    
+    fileStateCache = self._fileStateCache
+    if fileStateCache is not None:
+      try:
+        fileStateCache.save()
+      except EnvironmentError, e:
+        self.logger.outputWarning(
+          "cake: Error writing file state cache to %s: %s\n" % (fileStateCache.path, e)
+          )
     
   def getTimestamp(self, path):
     """Get the timestamp of the file at the specified path.
@@ -562,13 +780,184 @@ class Engine(object):
     """
     timestamp = self._timestampCache.get(path, None)
     if timestamp is None:
-      # Assuming here that os.stat() returns the modification time in
-      # seconds since the unix time epoch (Jan 1 1970 UTC).
-      stat = os.stat(path)
-      timestamp = stat.st_mtime
-      self._timestampCache[path] = timestamp
+      if self.scanDirectories and self._isListed(path):
+        # The directory scan may have cached the timestamp.
+        timestamp = self._timestampCache.get(path, None)
+      if timestamp is None:
+        timestamp = self._recordStat(path, os.stat(path))
+    return timestamp
+
+  def _isListed(self, path):
+    """Check whether a file may exist using a cached directory listing.
+    
+    The directory is listed on first use.
+    
+    @return: True if the file is listed in its directory or the directory
+    could not be listed.
+    @rtype: bool
+    
+    @raise OSError: With errno.ENOENT if the file doesn't exist.
+    """
+    dirPath, name = os.path.split(path)
+    normDirPath = os.path.normcase(dirPath)
+    names = self._directoryCache.get(normDirPath, None)
+    if names is None:
+      # Hold the lock while scanning so that notifyFileChanged() can't
+      # be called for a file in the directory until the scan results have
+      # been cached, otherwise a stale timestamp could be cached.
+      self._directoryCacheLock.acquire()
+      try:
+        names = self._directoryCache.get(normDirPath, None)
+        if names is None:
+          try:
+            # Remember the directory timestamp so that a file watcher can
+            # tell when the listing is out of date.
+            timestamp = os.stat(dirPath).st_mtime
+            names = self._scanDirectory(dirPath)
+          except EnvironmentError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+              return True # Can't tell, fall back to stat'ing the file.
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+          self._timestampCache[dirPath] = timestamp
+          self._directoryCache[normDirPath] = names
+      finally:
+        self._directoryCacheLock.release()
+    
+    if os.path.normcase(name) not in names:
+      raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return True
+
+  def _scanDirectory(self, dirPath):
+    """List the contents of a directory, caching any timestamps returned.
+    
+    Must be called with the directory cache lock held.
+    
+    @return: The set of normalised names in the directory.
+    @rtype: set of string
+    """
+    normcase = os.path.normcase
+    if _scandir is None or os.name != 'nt':
+      # On posix the directory entries don't include the timestamps so
+      # files are stat'ed individually as they are needed.
+      return set(normcase(n) for n in os.listdir(dirPath))
+    
+    names = set()
+    recordStat = self._recordStat
+    join = os.path.join
+    for entry in _scandir(dirPath):
+      names.add(normcase(entry.name))
+      if entry.is_file():
+        recordStat(join(dirPath, entry.name), entry.stat())
+    return names
+
+  def _recordStat(self, path, stat):
+    """Cache the result of an os.stat() call.
+    
+    @return: The timestamp of the file.
+    @rtype: float
+    """
+    # Assuming here that os.stat() returns the modification time in
+    # seconds since the unix time epoch (Jan 1 1970 UTC).
+    timestamp = stat.st_mtime
+    fileStateCache = self._getFileStateCache()
+    if fileStateCache is not None:
+      fileStateCache.validate(path, timestamp, stat.st_size, stat.st_ino)
+    self._timestampCache[path] = timestamp
     return timestamp
 
+  def statKnownDependencies(self, threadPool, chunkSize=256):
+    """Stat every file known from previous builds in one parallel sweep.
+    
+    The known files are the dependencies stored in the dependency
+    database and the files in the file state cache. Their timestamps are
+    cached so that subsequent dependency checks don't need to touch the
+    file system. This is most effective for incremental builds of large
+    trees where most targets are up to date.
+    
+    Targets in the dependency database are left out. Their timestamps
+    aren't needed to check whether they are up to date, and caching them
+    before they are rebuilt would give stale timestamps to the targets
+    that depend on them.
+    
+    This should be called after the configurations have been loaded but
+    before any build tasks have started.
+    
+    @param threadPool: The thread pool used to stat files in parallel.
+    @type threadPool: L{ThreadPool}
+    
+    @param chunkSize: The number of files to stat per job.
+    @type chunkSize: int
+    
+    @return: The number of files that were checked.
+    @rtype: int
+    """
+    paths = set()
+    
+    fileStateCache = self._getFileStateCache()
+    if fileStateCache is not None:
+      paths.update(fileStateCache.paths())
+    
+    dependencyDatabase = self._getDependencyDatabase()
+    if dependencyDatabase is not None:
+      isNodeKey = cake.includegraph.isNodeKey
+      unpackNode = cake.includegraph.unpackNode
+      targets = set()
+      for key in dependencyDatabase.keys():
+        if isNodeKey(key):
+          paths.add(unpackNode(dependencyDatabase.get(key))[0])
+        else:
+          targets.add(key)
+      pathTable = dependencyDatabase.pathTable
+      dependencyPaths = pathTable.getPaths(xrange(len(pathTable)))
+      for configuration in self._configurations.values():
+        abspath = configuration.abspath
+        paths.update(abspath(p) for p in dependencyPaths)
+      paths.difference_update(targets)
+        
+    timestampCache = self._timestampCache
+    paths = [p for p in paths if p not in timestampCache]
+    if not paths:
+      return 0
+
+    isTiming = self.logger.debugEnabled("time")
+    if isTiming:
+      startTime = time.time()
+      
+    chunks = [paths[i:i + chunkSize] for i in xrange(0, len(paths), chunkSize)]
+    remaining = [len(chunks)]
+    finished = threading.Event()
+    lock = threading.Lock()
+    
+    def statChunk(chunk):
+      try:
+        recordStat = self._recordStat
+        stat = os.stat
+        for path in chunk:
+          try:
+            recordStat(path, stat(path))
+          except EnvironmentError:
+            # Missing files are reported when the dependency is checked.
+            pass
+      finally:
+        lock.acquire()
+        try:
+          remaining[0] -= 1
+          if not remaining[0]:
+            finished.set()
+        finally:
+          lock.release()
+    
+    for chunk in chunks:
+      threadPool.queueJob(lambda chunk=chunk: statChunk(chunk))
+    finished.wait()
+    
+    if isTiming:
+      self.logger.outputDebug(
+        "time",
+        "time: %.3fs stat of %i known files\n" % (time.time() - startTime, len(paths)),
+        )
+    return len(paths)
+
   def updateFileDigestCache(self, path, timestamp, digest):
     """Update the internal cache of file digests with a new entry.
     
@@ -579,6 +968,9 @@ class Engine(object):
     """
     key = (path, timestamp)
     self._digestCache[key] = digest
+    fileStateCache = self._getFileStateCache()
+    if fileStateCache is not None:
+      fileStateCache.setDigest(path, timestamp, digest)
 
   def getFileDigest(self, path):
     """Get the SHA1 digest of a file's contents.
@@ -592,22 +984,140 @@ class Engine(object):
     timestamp = self.getTimestamp(path)
     key = (path, timestamp)
     digest = self._digestCache.get(key, None)
+    if digest is not None:
+      return digest
+    
+    fileStateCache = self._getFileStateCache()
+    if fileStateCache is not None:
+      digest = fileStateCache.getDigest(path, timestamp)
+      
     if digest is None:
+      startTime = time.time()
       hasher = cake.hash.sha1()
+      size = 0
       f = open(path, 'rb')
       try:
         blockSize = 512 * 1024
         data = f.read(blockSize)
         while data:
           hasher.update(data)
+          size += len(data)
           data = f.read(blockSize)
       finally:
         f.close()
       digest = hasher.digest()
-      self._digestCache[key] = digest
+      self.cacheStatistics.recordHash(size, time.time() - startTime)
+      if fileStateCache is not None:
+        fileStateCache.setDigest(path, timestamp, digest)
+    self._digestCache[key] = digest
       
     return digest
     
+  def _getDependencyDatabase(self):
+    """Get the dependency info database, loading it on first use.
+    
+    @return: The dependency database or None if not enabled.
+    @rtype: L{cake.depdb.DependencyDatabase} or None
+    """
+    dependencyDatabase = self._dependencyDatabase
+    if dependencyDatabase is None or dependencyDatabase.path != self.dependencyDatabasePath:
+      # An adopted database may have been for a different path.
+      if self.dependencyDatabasePath is None:
+        return None
+      self._dependencyDatabaseLock.acquire()
+      try:
+        dependencyDatabase = self._dependencyDatabase
+        if dependencyDatabase is None or dependencyDatabase.path != self.dependencyDatabasePath:
+          dependencyDatabase = cake.depdb.DependencyDatabase(
+            self.dependencyDatabasePath,
+            readOnly=self.dependencyJournalPath is not None,
+            )
+          dependencyDatabase.load()
+          if dependencyDatabase.readOnly and self.dependencyJournalPath is None:
+            self.logger.outputWarning(
+              "cake: Dependency database %s is locked by another build, "
+              "dependency info will not be saved.\n" % dependencyDatabase.path
+              )
+          self._dependencyDatabase = dependencyDatabase
+      finally:
+        self._dependencyDatabaseLock.release()
+    return dependencyDatabase
+    
+  def _getDependencyJournal(self):
+    """Get the journal new dependency info is written to, if any.
+    
+    @return: The dependency journal or None if not enabled.
+    @rtype: L{cake.depdb.DependencyDatabase} or None
+    """
+    dependencyJournal = self._dependencyJournal
+    if dependencyJournal is None and self.dependencyJournalPath is not None:
+      self._dependencyDatabaseLock.acquire()
+      try:
+        dependencyJournal = self._dependencyJournal
+        if dependencyJournal is None:
+          # Start a fresh journal, anything left behind is out of date.
+          cake.filesys.remove(self.dependencyJournalPath)
+          dependencyJournal = cake.depdb.DependencyDatabase(self.dependencyJournalPath)
+          self._dependencyJournal = dependencyJournal
+      finally:
+        self._dependencyDatabaseLock.release()
+    return dependencyJournal
+
+  def mergeDependencyJournal(self, path):
+    """Merge a journal written by another Cake process into the
+    dependency database.
+    
+    The journal file is removed once it has been merged.
+    
+    @param path: The path of the journal (see L{dependencyJournalPath}).
+    @type path: string
+    
+    @return: The number of targets merged.
+    @rtype: int
+    """
+    journal = cake.depdb.DependencyDatabase(path, readOnly=True)
+    journal.load()
+    count = 0
+    isNodeKey = cake.includegraph.isNodeKey
+    for target in journal.keys():
+      if isNodeKey(target):
+        self._storeIncludeNodeRecord(target, journal.get(target), [])
+        continue
+      try:
+        # Journal entries store paths rather than path ids, so loading
+        # them interns the paths in our path table.
+        dependencyInfo = self._loadDependencyInfo(journal.get(target))
+      except DependencyInfoError:
+        continue
+      self.storeDependencyInfo(target, dependencyInfo)
+      count += 1
+    cake.filesys.remove(path)
+    return count
+
+  def _getPathTable(self):
+    """Get the table of interned dependency paths.
+    
+    The path table is persisted in the dependency database if one is
+    being used, otherwise it only lasts for the duration of the build.
+    
+    @rtype: L{cake.depdb.PathTable}
+    """
+    pathTable = self._pathTable
+    if pathTable is None:
+      dependencyDatabase = self._getDependencyDatabase()
+      self._dependencyDatabaseLock.acquire()
+      try:
+        pathTable = self._pathTable
+        if pathTable is None:
+          if dependencyDatabase is not None:
+            pathTable = dependencyDatabase.pathTable
+          else:
+            pathTable = cake.depdb.PathTable()
+          self._pathTable = pathTable
+      finally:
+        self._dependencyDatabaseLock.release()
+    return pathTable
+    
   def getDependencyInfo(self, target):
     """Load the dependency info for the specified target.
     
@@ -622,6 +1132,13 @@ class Engine(object):
     
     @raise DependencyInfoError: if the dependency info could not be retrieved.
     """
+    dependencyDatabase = self._getDependencyDatabase()
+    if dependencyDatabase is not None:
+      dependencyString = dependencyDatabase.get(target)
+      if dependencyString is None:
+        raise DependencyInfoError("doesn't exist")
+      return self._loadDependencyInfo(dependencyString)
+    
     depPath = self.getDependencyInfoPath(target)
     
     # Read entire file at once otherwise thread-switching will kill performance.
@@ -638,6 +1155,36 @@ class Engine(object):
     if dependencyMagic != DependencyInfo.MAGIC:
       raise DependencyInfoError("has an invalid signature")
 
+    return self._loadDependencyInfo(dependencyString)
+
+  def getAllDependencyInfo(self):
+    """Get the dependency info of every target in the dependency database.
+    
+    @return: A dictionary of absolute target path to L{DependencyInfo}.
+    Empty if the dependency database is not being used.
+    @rtype: dict
+    """
+    dependencyInfos = {}
+    dependencyDatabase = self._getDependencyDatabase()
+    if dependencyDatabase is not None:
+      isNodeKey = cake.includegraph.isNodeKey
+      for target in dependencyDatabase.keys():
+        if isNodeKey(target):
+          continue
+        dependencyString = dependencyDatabase.get(target)
+        if dependencyString is None:
+          continue
+        try:
+          dependencyInfos[target] = self._loadDependencyInfo(dependencyString)
+        except DependencyInfoError:
+          continue
+    return dependencyInfos
+
+  def _loadDependencyInfo(self, dependencyString):
+    """Unpickle and validate a dependency info.
+    
+    @raise DependencyInfoError: if the dependency info is invalid.
+    """
     try:      
       dependencyInfo = pickle.loads(dependencyString)
     except:
@@ -650,6 +1197,11 @@ class Engine(object):
     if dependencyInfo.version != DependencyInfo.VERSION:
       raise DependencyInfoError("version has changed")
 
+    try:
+      dependencyInfo._bind(self._getPathTable())
+    except (IndexError, TypeError):
+      raise DependencyInfoError("refers to unknown paths")
+
     return dependencyInfo
   
   def getDependencyInfoPath(self, target):
@@ -680,15 +1232,136 @@ class Engine(object):
     @param dependencyInfo: The dependency info object to store.
     @type dependencyInfo: L{DependencyInfo}
     """
-    depPath = self.getDependencyInfoPath(target)
-
     dependencyString = pickle.dumps(dependencyInfo, pickle.HIGHEST_PROTOCOL)
+
+    dependencyDatabase = self._getDependencyDatabase()
+    if dependencyDatabase is not None:
+      self._putDatabaseRecord(target, dependencyString, dependencyInfo.targets)
+      return
+    
+    depPath = self.getDependencyInfoPath(target)
  
     try:
       cake.filesys.writeFile(depPath, dependencyString + DependencyInfo.MAGIC)
     except Exception, e:
       msg = "cake: Error writing dependency info to %s: %s" % (depPath, e)
       self.raiseError(msg, targets=dependencyInfo.targets)
+
+  def _putDatabaseRecord(self, key, value, targets):
+    """Write a record to the dependency database, or to the journal if
+    one is being used.
+    """
+    dependencyDatabase = self._getDependencyDatabase()
+    if self.dependencyJournalPath is not None:
+      # The database is read-only so this just updates it in memory.
+      dependencyDatabase.put(key, value)
+      dependencyDatabase = self._getDependencyJournal()
+    try:
+      dependencyDatabase.put(key, value)
+    except Exception, e:
+      msg = "cake: Error writing dependency info to %s: %s" % (dependencyDatabase.path, e)
+      self.raiseError(msg, targets=targets)
+
+  @property
+  def canStoreIncludeGraph(self):
+    """Whether include graph nodes can be stored.
+
+    The include graph is stored in the dependency database so is only
+    available if one is being used (see L{dependencyDatabasePath}).
+
+    @rtype: bool
+    """
+    return self._getDependencyDatabase() is not None
+
+  def storeIncludeNode(self, path, timestamp, childDigests, targets):
+    """Store a node of the include graph (see L{cake.includegraph}).
+
+    @param path: The absolute path of the header.
+    @type path: string
+    @param timestamp: The timestamp of the header.
+    @type timestamp: float
+    @param childDigests: The digests of the nodes for the headers it
+    included.
+    @type childDigests: list of string
+    @param targets: The targets being built, used to report errors.
+    @type targets: list of string
+
+    @return: The digest of the node.
+    @rtype: string
+    """
+    digest, record = cake.includegraph.packNode(path, timestamp, childDigests)
+    self._storeIncludeNodeRecord(cake.includegraph.getNodeKey(digest), record, targets)
+    return digest
+
+  def _storeIncludeNodeRecord(self, key, record, targets):
+    # Nodes are identified by their contents so are only written once.
+    if key not in self._getDependencyDatabase():
+      self._putDatabaseRecord(key, record, targets)
+
+  def checkIncludeNode(self, digest):
+    """Check whether the headers of an include graph node are unchanged.
+
+    The result is remembered for the rest of the build so that a subtree
+    shared by many targets is only checked once.
+
+    @param digest: The digest of the node.
+    @type digest: string
+
+    @return: The reason the node is out of date or None if it is up to
+    date.
+    @rtype: string or None
+    """
+    reasons = self._includeNodeReasons
+    try:
+      return reasons[digest]
+    except KeyError:
+      pass
+
+    reason = None
+    record = None
+    dependencyDatabase = self._getDependencyDatabase()
+    if dependencyDatabase is not None:
+      record = dependencyDatabase.get(cake.includegraph.getNodeKey(digest))
+    if record is None:
+      reason = "an include graph node doesn't exist"
+    else:
+      path, timestamp, childDigests = cake.includegraph.unpackNode(record)
+      self._includeNodePaths.add(path)
+      try:
+        if self.getTimestamp(path) != timestamp:
+          reason = "'" + path + "' has been changed"
+      except EnvironmentError:
+        reason = "'" + path + "' no longer exists"
+      if reason is None:
+        for childDigest in childDigests:
+          reason = self.checkIncludeNode(childDigest)
+          if reason is not None:
+            break
+
+    reasons[digest] = reason
+    return reason
+
+  def _pruneIncludeGraph(self, dependencyDatabase):
+    """Discard include graph nodes no longer used by any target.
+    """
+    isNodeKey = cake.includegraph.isNodeKey
+    nodeKeys = set(k for k in dependencyDatabase.keys() if isNodeKey(k))
+    if not nodeKeys:
+      return
+    
+    pending = []
+    for dependencyInfo in self.getAllDependencyInfo().itervalues():
+      if dependencyInfo.includeDigests:
+        pending.extend(cake.includegraph.splitDigests(dependencyInfo.includeDigests))
+    
+    getNodeKey = cake.includegraph.getNodeKey
+    while pending:
+      key = getNodeKey(pending.pop())
+      if key in nodeKeys:
+        nodeKeys.remove(key)
+        record = dependencyDatabase.get(key)
+        pending.extend(cake.includegraph.unpackNode(record)[2])
+    dependencyDatabase.discard(nodeKeys)
   
 class DependencyInfo(object):
   """Object that holds the dependency info for a target.
@@ -699,9 +1372,24 @@ class DependencyInfo(object):
   @type targets: list of strings
   @ivar args: The arguments used for the build.
   @type args: usually a list of string's
+  @ivar depPathIds: The ids of the dependency paths in the engine's path
+  table.
+  @type depPathIds: array of int
+  @ivar depTimestamps: The timestamps of the dependencies.
+  @type depTimestamps: array of float
+  @ivar depDigests: The concatenated 20 byte digests of the dependencies
+  or None if digests were not calculated.
+  @type depDigests: string or None
+  @ivar duration: The number of seconds it took to build the targets or
+  None if not known.
+  @type duration: float or None
+  @ivar includeDigests: The concatenated digests of the include graph
+  nodes for the headers included by the source or None if the headers
+  are stored as dependencies (see L{cake.includegraph}).
+  @type includeDigests: string or None
   """
   
-  VERSION = 3
+  VERSION = 4
   """The most recent DependencyInfo version.
 
   @type: int
@@ -716,13 +1404,77 @@ class DependencyInfo(object):
   @type: string
   """
   
-  def __init__(self, targets, args):
+  DIGEST_SIZE = 20
+  """The size of each digest stored in depDigests.
+  
+  @type: int
+  """
+  
+  duration = None # Default for dependency infos stored without one.
+  includeDigests = None
+  
+  def __init__(self, targets, args, pathTable=None):
     self.version = self.VERSION
     self.targets = targets
     self.args = args
-    self.depPaths = None
+    self.depPathIds = None
     self.depTimestamps = None
     self.depDigests = None
+    self.duration = None
+    self.includeDigests = None
+    self._pathTable = pathTable
+
+  @property
+  def depPaths(self):
+    """The paths of the dependencies.
+    
+    @rtype: list of string or None
+    """
+    if self.depPathIds is None:
+      return None
+    return self._pathTable.getPaths(self.depPathIds)
+
+  def getDepDigest(self, index):
+    """Get the digest of a dependency.
+    
+    @param index: The index of the dependency.
+    @type index: int
+    
+    @return: The digest of the dependency when it was built.
+    @rtype: string of 20 bytes
+    """
+    size = self.DIGEST_SIZE
+    return self.depDigests[index * size:(index + 1) * size]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    pathTable = state.pop("_pathTable", None)
+    state.pop("_unboundPaths", None)
+    if pathTable is None or not pathTable.isPersistent:
+      # Ids are only meaningful within a persistent path table
+      # so store the paths themselves instead.
+      state["depPathIds"] = None
+      state["depPaths"] = self.depPaths
+    return state
+
+  def __setstate__(self, state):
+    self._unboundPaths = state.pop("depPaths", None)
+    self.__dict__.update(state)
+    self._pathTable = None
+
+  def _bind(self, pathTable):
+    """Bind an unpickled dependency info to the engine's path table.
+    
+    @param pathTable: The path table the dependency info's ids refer to.
+    @type pathTable: L{cake.depdb.PathTable}
+    """
+    paths = self.__dict__.pop("_unboundPaths", None)
+    if paths is not None:
+      self.depPathIds = pathTable.internAll(paths)
+    elif self.depPathIds is not None:
+      # Check the ids are valid for this path table.
+      pathTable.getPaths(self.depPathIds)
+    self._pathTable = pathTable
 
 class Configuration(object):
   """A configuration is a collection of related Variants.
@@ -773,6 +1525,9 @@ class Configuration(object):
     self._variants = {}
     self._executed = {}
     self._executedLock = threading.Lock()
+    self._absPathCache = {}
+    self._buildPriorities = None
+    self._buildPrioritiesLock = threading.Lock()
   
   def basePath(self, path):
     """Allows user-supplied conversion of a path passed to a Tool.
@@ -941,7 +1696,7 @@ class Configuration(object):
 
     return script
 
-  def createDependencyInfo(self, targets, args, dependencies, calculateDigests=False):
+  def createDependencyInfo(self, targets, args, dependencies, calculateDigests=False, includeTree=None):
     """Construct a new DependencyInfo object.
     
     @param targets: A list of file paths of targets.
@@ -953,20 +1708,86 @@ class Configuration(object):
     @param calculateDigests: Whether or not to store the digests of
     dependencies in the DependencyInfo.
     @type calculateDigests: bool
+    @param includeTree: The headers included when building the targets.
+    If given, and the engine can store the include graph, the headers
+    are stored as include graph nodes rather than as dependencies.
+    @type includeTree: L{cake.includegraph.IncludeTree} or None
     
     @return: A DependencyInfo object.
     """
-    dependencyInfo = DependencyInfo(targets=list(targets), args=args)
-    paths = dependencyInfo.depPaths = list(dependencies)
+    # The targets have just been written, so forget anything previously
+    # cached about them.
     abspath = self.abspath
-    paths = [abspath(p) for p in paths]
+    notifyFileChanged = self.engine.notifyFileChanged
+    for target in targets:
+      notifyFileChanged(abspath(target))
+    
+    pathTable = self.engine._getPathTable()
+    dependencyInfo = DependencyInfo(
+      targets=list(targets),
+      args=args,
+      pathTable=pathTable,
+      )
+    if includeTree is not None and self.engine.canStoreIncludeGraph:
+      dependencyInfo.includeDigests = self._storeIncludeTree(includeTree, targets)
+      normcase = os.path.normcase
+      normpath = os.path.normpath
+      headers = set(normcase(normpath(abspath(p))) for p in includeTree.paths())
+      dependencies = [
+        d for d in dependencies
+        if normcase(normpath(abspath(d))) not in headers
+        ]
+    ids = dependencyInfo.depPathIds = pathTable.internAll(dependencies)
+    paths = self._getAbsPaths(ids)
     getTimestamp = self.engine.getTimestamp
-    dependencyInfo.depTimestamps = [getTimestamp(p) for p in paths]
+    dependencyInfo.depTimestamps = array.array('d', [getTimestamp(p) for p in paths])
     if calculateDigests:
       getFileDigest = self.engine.getFileDigest
-      dependencyInfo.depDigests = [getFileDigest(p) for p in paths]
+      dependencyInfo.depDigests = "".encode("latin-1").join(
+        [getFileDigest(p) for p in paths]
+        )
     return dependencyInfo
 
+  def _storeIncludeTree(self, includeTree, targets):
+    """Store the nodes of an include tree in the include graph.
+    
+    @return: The concatenated digests of the root nodes.
+    @rtype: string
+    """
+    abspath = self.abspath
+    normpath = os.path.normpath
+    getTimestamp = self.engine.getTimestamp
+    storeIncludeNode = self.engine.storeIncludeNode
+    
+    def store(node):
+      path, children = node
+      childDigests = [store(child) for child in children]
+      absPath = normpath(abspath(path))
+      return storeIncludeNode(absPath, getTimestamp(absPath), childDigests, targets)
+    
+    return "".encode("latin-1").join([store(root) for root in includeTree.roots])
+
+  def _getAbsPaths(self, ids):
+    """Get the absolute paths of a sequence of interned path ids.
+    
+    @param ids: The ids of paths in the engine's path table.
+    @type ids: sequence of int
+    
+    @return: The absolute paths.
+    @rtype: list of string
+    """
+    absPathCache = self._absPathCache
+    getPath = self.engine._getPathTable().getPath
+    abspath = self.abspath
+    absPaths = []
+    append = absPaths.append
+    for id in ids:
+      path = absPathCache.get(id, None)
+      if path is None:
+        path = absPathCache[id] = abspath(getPath(id))
+      append(path)
+    return absPaths
+
   def storeDependencyInfo(self, dependencyInfo):
     """Call this method after a target was built to save the
     dependencies of the target.
@@ -1012,19 +1833,123 @@ class Configuration(object):
         return dependencyInfo, "'" + target + "' doesn't exist"
     
     getTimestamp = self.engine.getTimestamp
-    paths = dependencyInfo.depPaths
+    ids = dependencyInfo.depPathIds
     timestamps = dependencyInfo.depTimestamps
-    assert len(paths) == len(timestamps)
-    for i in xrange(len(paths)):
-      path = paths[i]
+    assert len(ids) == len(timestamps)
+    absPaths = self._getAbsPaths(ids)
+    for i in xrange(len(ids)):
       try:
-        if getTimestamp(abspath(path)) != timestamps[i]:
+        if getTimestamp(absPaths[i]) != timestamps[i]:
+          path = self.engine._getPathTable().getPath(ids[i])
           return dependencyInfo, "'" + path + "' has been changed"
       except EnvironmentError:
+        path = self.engine._getPathTable().getPath(ids[i])
         return dependencyInfo, "'" + path + "' no longer exists" 
     
+    if dependencyInfo.includeDigests:
+      checkIncludeNode = self.engine.checkIncludeNode
+      for digest in cake.includegraph.splitDigests(dependencyInfo.includeDigests):
+        reason = checkIncludeNode(digest)
+        if reason is not None:
+          return dependencyInfo, reason
+    
     return dependencyInfo, None
 
+  def getBuildPriority(self, target, dependencyInfo=None):
+    """Get the scheduling priority for building a target.
+    
+    The priority is the length in seconds of the longest chain of builds
+    that started with the target in previous builds, ie. the time it took
+    to build the target plus the time it took to build the things that
+    were built from it. Building targets with the highest priority first
+    shortens the critical path of the build.
+    
+    @param target: The path of the target.
+    @type target: string
+    @param dependencyInfo: The target's previous dependency info if known.
+    It is used to find the target's own duration if the target isn't in
+    the dependency database.
+    @type dependencyInfo: L{DependencyInfo} or None
+    
+    @return: The priority of the target or 0 if critical path scheduling
+    is disabled or the target has never been built.
+    @rtype: float
+    """
+    if not self.engine.criticalPathScheduling:
+      return 0
+    
+    priorities = self._buildPriorities
+    if priorities is None:
+      self._buildPrioritiesLock.acquire()
+      try:
+        priorities = self._buildPriorities
+        if priorities is None:
+          priorities = self._buildPriorities = self._calculateBuildPriorities()
+      finally:
+        self._buildPrioritiesLock.release()
+    
+    priority = priorities.get(self.abspath(target), None)
+    if priority is None and dependencyInfo is not None:
+      priority = dependencyInfo.duration
+    return priority or 0
+
+  def _calculateBuildPriorities(self):
+    """Calculate the critical path length of every target built before.
+    
+    @return: A dictionary of absolute target path to priority.
+    @rtype: dict
+    """
+    isTiming = self.engine.logger.debugEnabled("time")
+    if isTiming:
+      startTime = time.time()
+      
+    abspath = self.abspath
+    durations = {}
+    consumers = {}
+    dependencyInfos = self.engine.getAllDependencyInfo()
+    for target, dependencyInfo in dependencyInfos.iteritems():
+      durations[target] = dependencyInfo.duration or 0.0
+      for path in dependencyInfo.depPaths or ():
+        consumers.setdefault(abspath(path), []).append(target)
+    
+    # Only dependencies that were themselves built are of interest.
+    for path in consumers.keys():
+      if path not in durations:
+        del consumers[path]
+
+    # Depth-first search of the consumers of each target. A cycle shouldn't
+    # occur but if it does the consumer on the cycle is ignored.
+    priorities = {}
+    visiting = set()
+    noConsumers = ()
+    for root in durations:
+      stack = [root]
+      while stack:
+        target = stack[-1]
+        if target in priorities:
+          stack.pop()
+          continue
+        targetConsumers = consumers.get(target, noConsumers)
+        if target not in visiting:
+          visiting.add(target)
+          stack.extend(
+            c for c in targetConsumers
+            if c not in priorities and c not in visiting
+            )
+          continue
+        stack.pop()
+        longest = 0.0
+        for c in targetConsumers:
+          longest = max(longest, priorities.get(c, 0.0))
+        priorities[target] = durations[target] + longest
+    
+    if isTiming:
+      self.engine.logger.outputDebug(
+        "time",
+        "time: %.3fs critical paths of %i targets\n" % (time.time() - startTime, len(priorities)),
+        )
+    return priorities
+
   def checkReasonToBuild(self, targets, sources):
     """Check for a reason to build given a list of targets and sources.
     
@@ -1071,17 +1996,31 @@ class Configuration(object):
   def primeFileDigestCache(self, dependencyInfo):
     """Prime the engine's file-digest cache using any cached
     information stored in this dependency info.
+    
+    If the dependency info has no digests then the engine's persistent
+    file state cache is used instead (if enabled).
     """
-    if dependencyInfo.depDigests and dependencyInfo.depTimestamps:
-      paths = dependencyInfo.depPaths
-      timestamps = dependencyInfo.depTimestamps
-      digests = dependencyInfo.depDigests
-      assert len(digests) == len(paths)
-      assert len(timestamps) == len(paths)
-      updateFileDigestCache = self.engine.updateFileDigestCache
-      abspath = self.abspath
+    if not dependencyInfo.depTimestamps:
+      return
+    
+    paths = self._getAbsPaths(dependencyInfo.depPathIds)
+    timestamps = dependencyInfo.depTimestamps
+    assert len(timestamps) == len(paths)
+    updateFileDigestCache = self.engine.updateFileDigestCache
+    if dependencyInfo.depDigests:
+      getDepDigest = dependencyInfo.getDepDigest
+      assert len(dependencyInfo.depDigests) == len(paths) * DependencyInfo.DIGEST_SIZE
       for i in xrange(len(paths)):
-        updateFileDigestCache(abspath(paths[i]), timestamps[i], digests[i])
+        updateFileDigestCache(paths[i], timestamps[i], getDepDigest(i))
+    else:
+      fileStateCache = self.engine._getFileStateCache()
+      if fileStateCache is not None:
+        getDigest = fileStateCache.getDigest
+        for i in xrange(len(paths)):
+          path = paths[i]
+          digest = getDigest(path, timestamps[i])
+          if digest is not None:
+            updateFileDigestCache(path, timestamps[i], digest)
 
   def calculateDigest(self, dependencyInfo):
     """Calculate the digest of the sources/dependencies.
@@ -1104,11 +2043,12 @@ class Configuration(object):
     # Include parameters of the build    
     addToDigest(encodeToUtf8(repr(dependencyInfo.args)))
 
-    abspath = self.abspath
-    for path in dependencyInfo.depPaths:
+    paths = dependencyInfo.depPaths
+    absPaths = self._getAbsPaths(dependencyInfo.depPathIds)
+    for i in xrange(len(paths)):
       # Include the dependency file's path and content digest in
       # this digest.
-      addToDigest(encodeToUtf8(path))
-      addToDigest(getFileDigest(abspath(path)))
+      addToDigest(encodeToUtf8(paths[i]))
+      addToDigest(getFileDigest(absPaths[i]))
       
     return hasher.digest()
@@ -0,0 +1,222 @@
+"""Persistent File State Cache.
+
+The file state cache remembers the timestamp, size, inode and content digest
+of files between builds so that unchanged files don't need to be hashed
+again by each new build.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+import cake.filesys
+
+class FileStateCache(object):
+  """A persistent cache of path -> (timestamp, size, inode, digest).
+
+  The cache file is a flat binary file that is memory-mapped when loaded.
+  It consists of a header followed by one fixed-size record per file, each
+  immediately followed by the UTF-8 encoded path of the file.
+
+  A file's cached digest is only trusted while its timestamp, size and inode
+  match the values recorded when the digest was calculated.
+  """
+
+  MAGIC = "CKFS".encode("latin-1") # We need bytes for Python 3.x
+  """A magic value stored at the start of the cache file.
+
+  @type: string
+  """
+
+  VERSION = 1
+  """The most recent file state cache version.
+
+  @type: int
+  """
+
+  _header = struct.Struct("<4sII") # magic, version, record count
+  _record = struct.Struct("<dQQB20sI") # mtime, size, inode, hasDigest, digest, pathLen
+  _noDigest = "\0".encode("latin-1") * 20
+
+  def __init__(self, path):
+    """Construct an empty file state cache.
+
+    @param path: The path of the file used to persist the cache.
+    @type path: string
+    """
+    self.path = path
+    self._states = {}
+    self._lock = threading.Lock()
+    self._dirty = False
+
+  def __len__(self):
+    return len(self._states)
+
+  def paths(self):
+    """Return the paths of all files with a cached state.
+
+    @rtype: list of string
+    """
+    return list(self._states.keys())
+
+  def load(self):
+    """Load the cache from disk.
+
+    A missing or corrupt cache file results in an empty cache.
+    """
+    try:
+      f = open(self.path, "rb")
+    except EnvironmentError:
+      return
+
+    states = {}
+    try:
+      try:
+        size = os.fstat(f.fileno()).st_size
+        if size < self._header.size:
+          return
+        data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+          magic, version, count = self._header.unpack_from(data, 0)
+          if magic != self.MAGIC or version != self.VERSION:
+            return
+
+          unpackRecord = self._record.unpack_from
+          recordSize = self._record.size
+          offset = self._header.size
+          for _ in xrange(count):
+            timestamp, fileSize, inode, hasDigest, digest, pathLen = unpackRecord(data, offset)
+            offset += recordSize
+            path = data[offset:offset + pathLen].decode("utf8")
+            offset += pathLen
+            if not hasDigest:
+              digest = None
+            states[path] = (timestamp, fileSize, inode, digest)
+        finally:
+          data.close()
+      except (EnvironmentError, struct.error, ValueError, UnicodeError):
+        # Corrupt or truncated cache file, just start again.
+        return
+    finally:
+      f.close()
+
+    self._lock.acquire()
+    try:
+      self._states = states
+      self._dirty = False
+    finally:
+      self._lock.release()
+
+  def save(self):
+    """Write the cache back to disk if it has been modified.
+
+    @raise EnvironmentError: If the cache file could not be written.
+    """
+    self._lock.acquire()
+    try:
+      if not self._dirty:
+        return
+      states = self._states.items()
+      self._dirty = False
+    finally:
+      self._lock.release()
+
+    packRecord = self._record.pack
+    noDigest = self._noDigest
+    chunks = [self._header.pack(self.MAGIC, self.VERSION, len(states))]
+    for path, (timestamp, fileSize, inode, digest) in states:
+      encodedPath = path.encode("utf8")
+      if digest is None:
+        chunks.append(packRecord(timestamp, fileSize, inode, 0, noDigest, len(encodedPath)))
+      else:
+        chunks.append(packRecord(timestamp, fileSize, inode, 1, digest, len(encodedPath)))
+      chunks.append(encodedPath)
+
+    # Include the process id in case other processes are saving too.
+    tempPath = "%s.%i.tmp" % (self.path, os.getpid())
+    cake.filesys.writeFile(tempPath, "".encode("latin-1").join(chunks))
+    cake.filesys.replaceFile(tempPath, self.path)
+
+  def validate(self, path, timestamp, size, inode):
+    """Record the current state of a file.
+
+    Any digest cached for the file is discarded if the file has changed
+    since the digest was calculated.
+
+    @param path: The absolute path of the file.
+    @type path: string
+    @param timestamp: The modification time of the file.
+    @type timestamp: float
+    @param size: The size of the file in bytes.
+    @type size: int
+    @param inode: The inode number of the file, or 0 if not supported.
+    @type inode: int
+    """
+    state = self._states.get(path, None)
+    if state is not None and state[:3] == (timestamp, size, inode):
+      return
+
+    self._lock.acquire()
+    try:
+      self._states[path] = (timestamp, size, inode, None)
+      self._dirty = True
+    finally:
+      self._lock.release()
+
+  def getDigest(self, path, timestamp):
+    """Get the cached digest of a file.
+
+    @param path: The absolute path of the file.
+    @type path: string
+    @param timestamp: The current timestamp of the file.
+    @type timestamp: float
+
+    @return: The digest of the file if known and the file hasn't changed,
+    otherwise None.
+    @rtype: string of 20 bytes or None
+    """
+    state = self._states.get(path, None)
+    if state is not None and state[0] == timestamp:
+      return state[3]
+    return None
+
+  def setDigest(self, path, timestamp, digest):
+    """Update the cached digest of a file.
+
+    The digest is ignored if the file's state hasn't been recorded with
+    L{validate} or was recorded with a different timestamp.
+
+    @param path: The absolute path of the file.
+    @type path: string
+    @param timestamp: The timestamp of the file when the digest was
+    calculated.
+    @type timestamp: float
+    @param digest: The digest of the file's contents.
+    @type digest: string of 20 bytes
+    """
+    self._lock.acquire()
+    try:
+      state = self._states.get(path, None)
+      if state is not None and state[0] == timestamp and state[3] != digest:
+        self._states[path] = (state[0], state[1], state[2], digest)
+        self._dirty = True
+    finally:
+      self._lock.release()
+
+  def invalidate(self, path):
+    """Forget any cached state for a file.
+
+    @param path: The absolute path of the file.
+    @type path: string
+    """
+    self._lock.acquire()
+    try:
+      if self._states.pop(path, None) is not None:
+        self._dirty = True
+    finally:
+      self._lock.release()
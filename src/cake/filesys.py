@@ -5,10 +5,21 @@
 @license: Licensed under the MIT license.
 """
 
+import errno
 import shutil
 import os
 import os.path
+import sys
+import threading
 import time
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+try:
+  import msvcrt
+except ImportError:
+  msvcrt = None
 
 import cake.path
 
@@ -98,6 +109,143 @@ def copyFile(source, target):
   """
   shutil.copyfile(source, target)
 
+_FICLONE = 0x40049409 # From linux/fs.h
+
+def cloneFile(source, target):
+  """Create a copy-on-write clone of a file.
+
+  The clone shares storage with the source until either is modified, so
+  it is created almost instantly. Only file systems that support it, eg.
+  Btrfs and XFS on Linux, can clone files.
+
+  @param source: The path of the source file.
+  @type source: string
+  @param target: The path of the target file, which must not exist.
+  @type target: string
+
+  @raise EnvironmentError: If the file couldn't be cloned.
+  """
+  if fcntl is None or not sys.platform.startswith("linux"):
+    raise EnvironmentError(errno.EOPNOTSUPP, "Cloning files is not supported")
+  s = open(source, "rb")
+  try:
+    t = open(target, "wb")
+    try:
+      fcntl.ioctl(t.fileno(), _FICLONE, s.fileno())
+    except EnvironmentError:
+      t.close()
+      remove(target)
+      raise
+    t.close()
+  finally:
+    s.close()
+
+def linkFile(source, target):
+  """Create a file that is a clone, hard link or copy of another.
+
+  The cheapest method the file system supports is used: a copy-on-write
+  clone, then a hard link and finally a copy. The target should be
+  treated as read-only since writing to a hard link also modifies the
+  source (see L{removeIfLinked}).
+
+  @param source: The path of the source file.
+  @type source: string
+  @param target: The path of the target file, which must not exist.
+  @type target: string
+  """
+  try:
+    cloneFile(source, target)
+    return
+  except EnvironmentError:
+    pass
+  if hasattr(os, "link"):
+    try:
+      os.link(source, target)
+      return
+    except EnvironmentError:
+      pass # Eg. on different file systems.
+  copyFile(source, target)
+
+def removeIfLinked(path):
+  """Remove a file if it has other hard links.
+
+  This is done before rebuilding a file that may be a hard link created
+  by L{linkFile}, so that writing the new contents doesn't modify the
+  other links too.
+
+  @param path: The path of the file.
+  @type path: string
+  """
+  try:
+    st = os.stat(path)
+  except EnvironmentError:
+    return
+  if st.st_nlink > 1:
+    remove(path)
+
+def replaceFile(source, target):
+  """Rename a file, replacing the target file if it exists.
+
+  On platforms where a rename cannot overwrite an existing file the
+  target is removed first, so the replacement is not atomic there.
+
+  @param source: The path of the file to rename.
+  @type source: string
+  @param target: The path of the file to replace.
+  @type target: string
+  """
+  try:
+    os.rename(source, target)
+  except EnvironmentError:
+    if not os.path.exists(target):
+      raise
+    remove(target)
+    os.rename(source, target)
+
+def lockFile(path):
+  """Take an exclusive lock on a lock file without waiting for it.
+
+  The lock is held until released by L{unlockFile} or the process exits.
+  It isn't inherited by child processes. The lock file is created if
+  required and is left behind afterwards.
+
+  @param path: The path of the lock file.
+  @type path: string
+
+  @return: The open lock file, or None if another process holds the lock.
+  @rtype: file or None
+
+  @raise EnvironmentError: If the lock file couldn't be opened.
+  """
+  makeDirs(os.path.dirname(path))
+  fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOINHERIT", 0), 0666)
+  f = os.fdopen(fd, "r+b")
+  try:
+    if fcntl is not None:
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    elif msvcrt is not None:
+      msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+  except EnvironmentError, e:
+    f.close()
+    if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK, errno.EDEADLOCK):
+      return None
+    raise
+  return f
+
+def unlockFile(f):
+  """Release a lock taken by L{lockFile}.
+
+  @param f: The lock file returned by L{lockFile}.
+  @type f: file
+  """
+  try:
+    if fcntl is None and msvcrt is not None:
+      f.seek(0)
+      msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+  finally:
+    f.close()
+
 def makeDirs(path):
   """Recursively create directories.
   
@@ -201,3 +349,50 @@ def writeFile(path, data):
     f.write(data)
   finally:
     f.close()
+
+def makeTempPath(path):
+  """Get the path of a temporary file to write before it replaces a file.
+
+  @param path: The path of the file that will be replaced.
+  @type path: string
+
+  @return: A path in the same directory that no other process or thread
+  will use.
+  @rtype: string
+  """
+  # Include the process and thread ids in case others are writing too.
+  return "%s.%i.%i.tmp" % (path, os.getpid(), threading.currentThread().ident)
+
+def writeFileAtomic(path, data):
+  """Write data to a file so that readers never see it partially written.
+
+  The data is written to a temporary file which then replaces the file.
+
+  @param path: The path of the file to write.
+  @type path: string 
+  @param data: The data to write to the file.
+  @type data: string 
+  """
+  tempPath = makeTempPath(path)
+  try:
+    writeFile(tempPath, data)
+    replaceFile(tempPath, path)
+  except EnvironmentError:
+    try:
+      remove(tempPath)
+    except EnvironmentError:
+      pass
+    raise
+
+def makeExecutable(path):
+  """Make a file executable by those that can read it.
+
+  Does nothing on platforms without executable permissions.
+
+  @param path: The path of the file.
+  @type path: string 
+  """
+  if os.name != "posix":
+    return
+  mode = os.stat(path).st_mode
+  os.chmod(path, mode | ((mode & 0444) >> 2))
@@ -5,6 +5,217 @@
 @license: Licensed under the MIT license.
 """
 
+import re
+
+_tokenExpression = re.compile(r'(?:\\ |\S)+')
+"""Matches a file name, which may contain escaped spaces.
+"""
+_escapeExpression = re.compile(r'\\([ #])|\$(\$)')
+"""Matches the escaped characters in a file name.
+"""
+_separatorExpression = re.compile(r':(?=\s|$)')
+"""Matches the colon between a rule's targets and prerequisites.
+
+Colons followed by other characters are part of a file name, eg. a
+Windows drive letter.
+"""
+
+def _unescape(match):
+  return match.group(1) or match.group(2)
+
+class DependencyParser(object):
+  """Parses the dependencies of a target from a .d file as it is read.
+
+  The text can be fed in pieces of any size, eg. as a compiler writes
+  the rules to a pipe. Each complete line is parsed when it is fed, so
+  the time taken is linear in the size of the file.
+
+  The dependencies are the prerequisites of every rule with a target
+  ending in the target suffix. Other rules, such as the empty rules for
+  headers written by GCC's -MP option, are ignored.
+
+  Usage::
+    parser = DependencyParser(".o")
+    parser.feed(text)
+    dependencies = parser.close()
+  """
+
+  def __init__(self, targetSuffix):
+    """Construct a parser.
+
+    @param targetSuffix: Suffix used by targets.
+    @type targetSuffix: string
+    """
+    self._targetSuffix = targetSuffix
+    self._partialLine = []
+    self._inPrerequisites = False
+    self._isTargetRule = False
+    self._ruleTargets = []
+    self._dependencies = []
+    self._uniqueDeps = set()
+
+  def feed(self, text):
+    """Parse some more of the dependency file.
+
+    @param text: The next piece of the file.
+    @type text: string
+    """
+    end = text.rfind('\n')
+    if end == -1:
+      self._partialLine.append(text)
+      return
+    self._partialLine.append(text[:end])
+    text, self._partialLine = "".join(self._partialLine), [text[end+1:]]
+    self._parseLines(text)
+
+  def close(self):
+    """Finish parsing the dependency file.
+
+    @return: A list of dependencies.
+    @rtype: list of string
+    """
+    text = "".join(self._partialLine)
+    self._partialLine = []
+    if text:
+      self._parseLines(text)
+    return self._dependencies
+
+  def _parseLines(self, text):
+    if '\r' in text:
+      text = text.replace('\r\n', '\n')
+      if text.endswith('\r'): # The last line ending wasn't included.
+        text = text[:-1]
+    # Escaped line endings only separate file names, so each rule can be
+    # parsed as a single line. A rule may continue in the next text fed.
+    continued = text.endswith('\\')
+    if continued:
+      text = text[:-1]
+    text = text.replace('\\\n', ' ')
+    lines = text.split('\n')
+    for line in lines[:-1]:
+      self._parseRule(line, False)
+    self._parseRule(lines[-1], continued)
+
+  def _parseRule(self, line, continued):
+    if not self._inPrerequisites:
+      if not self._ruleTargets and line.lstrip().startswith('#'):
+        return # comment
+      match = _separatorExpression.search(line)
+      if match is None:
+        # The targets continue on the next line.
+        if continued:
+          self._ruleTargets.extend(_tokenExpression.findall(line))
+        else:
+          self._ruleTargets = []
+        return
+      self._ruleTargets.extend(_tokenExpression.findall(line, 0, match.start()))
+      suffix = self._targetSuffix
+      self._isTargetRule = False
+      for target in self._ruleTargets:
+        if target.endswith(suffix):
+          self._isTargetRule = True
+          break
+      self._ruleTargets = []
+      self._inPrerequisites = True
+      line = line[match.end():]
+
+    if self._isTargetRule:
+      if '\\ ' in line:
+        paths = _tokenExpression.findall(line)
+      else:
+        paths = line.split()
+      isEscaped = '\\' in line or '$' in line
+      uniqueDeps = self._uniqueDeps
+      dependencies = self._dependencies
+      for path in paths:
+        if path not in uniqueDeps:
+          uniqueDeps.add(path)
+          if isEscaped:
+            path = _escapeExpression.sub(_unescape, path)
+          dependencies.append(path)
+
+    if not continued:
+      self._inPrerequisites = False
+
+_includeExpression = re.compile(r'(\.*)(?:([!x])|(?<=\.)) (.*)$')
+"""Matches a header reported by GCC's -H option, eg. '.. /usr/include/stdio.h'.
+
+Precompiled headers are marked '!' if they were used or 'x' if invalid.
+A precompiled header included from the command line has no dots.
+"""
+
+class IncludeTreeParser(object):
+  """Parses the headers reported by GCC's -H option from its stderr.
+
+  The headers are added to an include tree while the rest of the text,
+  such as warnings and errors, is returned so it can be output as usual.
+  As with L{DependencyParser} the text can be fed in pieces of any size.
+
+  Usage::
+    parser = IncludeTreeParser(includeTree)
+    output = parser.feed(text)
+    output += parser.close()
+  """
+
+  _guardsMessage = "Multiple include guards may be useful for:"
+
+  def __init__(self, includeTree):
+    """Construct a parser.
+
+    @param includeTree: The include tree to add the headers to.
+    @type includeTree: L{cake.includegraph.IncludeTree}
+    """
+    self._includeTree = includeTree
+    self._buffer = ""
+    self._inGuards = False
+
+  def feed(self, text):
+    """Parse the complete lines of some more output.
+
+    @param text: The next piece of output.
+    @type text: string
+
+    @return: The output that wasn't part of the include tree.
+    @rtype: string
+    """
+    text = self._buffer + text
+    end = text.rfind("\n") + 1
+    self._buffer = text[end:]
+    return self._parseLines(text[:end])
+
+  def close(self):
+    """Parse any remaining partial line.
+
+    @return: The output that wasn't part of the include tree.
+    @rtype: string
+    """
+    text = self._buffer
+    self._buffer = ""
+    return self._parseLines(text)
+
+  def _parseLines(self, text):
+    output = []
+    addInclude = self._includeTree.addInclude
+    matchInclude = _includeExpression.match
+    for line in text.splitlines(True):
+      stripped = line.rstrip("\r\n")
+      match = matchInclude(stripped)
+      if match is not None:
+        # Precompiled headers are already dependencies of the object.
+        if not match.group(2):
+          addInclude(len(match.group(1)), match.group(3))
+        continue
+      if stripped == self._guardsMessage:
+        self._inGuards = True
+        continue
+      if self._inGuards:
+        # The list of headers is followed by any diagnostics.
+        if ': ' not in stripped:
+          continue
+        self._inGuards = False
+      output.append(line)
+    return "".join(output)
+
 def parseDependencyFile(path, targetSuffix):
   """Parse a .d file and return the list of dependencies.
   
@@ -15,41 +226,10 @@ def parseDependencyFile(path, targetSuffix):
   @return: A list of dependencies.
   @rtype: list of string
   """
-  dependencies = []
-  uniqueDeps = set()
-
-  def addPath(path):
-    if path and path not in uniqueDeps:
-      uniqueDeps.add(path)
-      path = path.replace('\\ ', ' ') # fix escaped spaces
-      dependencies.append(path)
-
+  parser = DependencyParser(targetSuffix)
   f = open(path, 'rt')
   try:
-    text = f.read()
-    text = text.replace('\\\n', ' ') # join escaped lines
-    text = text.replace('\n', ' ') # join other lines
-    text = text.lstrip() # strip leading whitespace
-
-    # Find the 'target:' rule
-    i = text.find(targetSuffix + ':')
-    if i != -1:
-      text = text[i+len(targetSuffix)+1:] # strip target + ':'
-
-      while True:
-        text = text.lstrip() # strip leading whitespace
-
-        i = text.find(' ')
-        while i != -1 and text[i-1] == '\\': # Skip escaped spaces
-          i = text.find(' ', i+1)
-        
-        if i == -1:
-          addPath(text)
-          break
-        else:
-          addPath(text[:i])
-          text = text[i:]
+    parser.feed(f.read())
   finally:
     f.close()
-  
-  return dependencies
+  return parser.close()
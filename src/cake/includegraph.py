@@ -0,0 +1,148 @@
+"""Header Include Graph.
+
+Most translation units in a large build include the same trees of
+headers. Rather than storing and checking every header of every object
+separately, the headers seen by a compile can be stored as a graph of
+nodes shared between objects.
+
+Each node records a header's absolute path, its timestamp and the
+digests of the nodes for the headers it included. A node's digest is
+the digest of that record, so a node identifies a whole subtree exactly
+as it was when compiled; a header that includes different files in
+different objects (eg. due to macros or include paths) simply has
+different nodes. An object stores only its other dependencies plus the
+digests of the nodes for the headers its source includes directly, and
+each node needs checking only once per build no matter how many objects
+share it.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import struct
+
+import cake.hash
+
+DIGEST_SIZE = 20
+"""The size of a node digest.
+
+@type: int
+"""
+
+_keyPrefix = u"include:"
+_nodeHeader = struct.Struct("<dI") # timestamp, path length
+
+class IncludeTree(object):
+  """The tree of headers included by a compile, built from the headers
+  the compiler reports in the order they were included.
+
+  @ivar roots: The nodes for the headers included by the source file.
+  Each node is a (path, children) tuple where children is a list of
+  nodes.
+  @type roots: list of tuple
+  """
+
+  def __init__(self):
+    self.roots = []
+    self._stack = []
+
+  def addInclude(self, depth, path):
+    """Add a header reported by the compiler.
+
+    @param depth: The depth of the include, 1 if the header was included
+    by the source file, 2 if by a header included by the source file etc.
+    @type depth: int
+    @param path: The path of the header.
+    @type path: string
+    """
+    stack = self._stack
+    del stack[max(depth - 1, 0):]
+    node = (path, [])
+    if stack:
+      stack[-1][1].append(node)
+    else:
+      self.roots.append(node)
+    stack.append(node)
+
+  def paths(self):
+    """Get the paths of all headers in the tree.
+
+    @rtype: set of string
+    """
+    paths = set()
+    pending = list(self.roots)
+    while pending:
+      path, children = pending.pop()
+      paths.add(path)
+      pending.extend(children)
+    return paths
+
+class DependencyList(list):
+  """A list of dependencies along with the include tree they came from.
+
+  Returned by compile commands that were able to work out the include
+  tree so that it can be stored in the include graph.
+
+  @ivar includeTree: The include tree of the compile.
+  @type includeTree: L{IncludeTree}
+  """
+
+  def __init__(self, dependencies, includeTree):
+    list.__init__(self, dependencies)
+    self.includeTree = includeTree
+
+def packNode(path, timestamp, childDigests):
+  """Pack a node into the record it is stored and identified by.
+
+  @param path: The absolute path of the header.
+  @type path: string
+  @param timestamp: The timestamp of the header.
+  @type timestamp: float
+  @param childDigests: The digests of the nodes of the headers it
+  included.
+  @type childDigests: list of string
+
+  @return: A (digest, record) tuple.
+  @rtype: tuple of (string, string)
+  """
+  encodedPath = path.encode("utf8")
+  record = _nodeHeader.pack(timestamp, len(encodedPath)) + encodedPath + \
+    "".encode("latin-1").join(childDigests)
+  return cake.hash.sha1(record).digest(), record
+
+def unpackNode(record):
+  """Unpack a record written by L{packNode}.
+
+  @return: A (path, timestamp, childDigests) tuple.
+  @rtype: tuple of (string, float, list of string)
+  """
+  timestamp, pathLength = _nodeHeader.unpack_from(record, 0)
+  start = _nodeHeader.size
+  end = start + pathLength
+  return record[start:end].decode("utf8"), timestamp, splitDigests(record[end:])
+
+def splitDigests(digests):
+  """Split concatenated node digests.
+
+  @type digests: string
+  @rtype: list of string
+  """
+  return [digests[i:i + DIGEST_SIZE] for i in xrange(0, len(digests), DIGEST_SIZE)]
+
+def getNodeKey(digest):
+  """Get the dependency database key a node is stored under.
+
+  @type digest: string
+  @rtype: string
+  """
+  return _keyPrefix + cake.hash.hexlify(digest)
+
+def isNodeKey(key):
+  """Check whether a dependency database key is for a node rather than
+  a target.
+
+  @type key: string
+  @rtype: bool
+  """
+  return key.startswith(_keyPrefix)
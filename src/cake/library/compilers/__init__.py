@@ -10,33 +10,110 @@ import weakref
 import os
 import os.path
 import datetime
+import errno
 import tempfile
-import subprocess
+import time
 import itertools
-try:
-  import cPickle as pickle
-except ImportError:
-  import pickle
+import threading
 
 import cake.filesys
 import cake.hash
+import cake.includegraph
+import cake.objectcache
 import cake.path
+import cake.slots
+import cake.spawner
 import cake.system
+import cake.trace
 import cake.zipping
 
-from cake.gnu import parseDependencyFile
+from cake.gnu import parseDependencyFile, DependencyParser, IncludeTreeParser
 from cake.async import AsyncResult, waitForAsyncResult, flatten, getResult
 from cake.target import FileTarget, getPath, getPaths, getTask, getTasks
 from cake.task import Task
 from cake.library import Tool, memoise
 from cake.script import Script
 
+_objectCacheUsage = weakref.WeakKeyDictionary()
+_objectCacheWriteEngines = weakref.WeakKeyDictionary()
+_objectCacheUsageLock = threading.Lock()
+
+def _collectUsedObjectCacheGarbage(usage, logger):
+  """Remove old objects from the size limited object caches used by a build.
+  """
+  # Objects stored in the background are included in the usage.
+  _flushObjectCacheWrites()
+  for cache, (maxSize, addedSize) in usage.items():
+    result = cache.collectGarbage(maxSize, addedSize)
+    if result is not None:
+      removedCount, removedSize, size = result
+      logger.outputDebug(
+        "cache",
+        "cache: removed %i objects (%i bytes) from %s, %i bytes remain\n" % (
+          removedCount, removedSize, cache.path, size),
+        )
+
+def _flushObjectCacheWrites():
+  """Wait for objects being stored in the background to be written.
+  """
+  cake.objectcache.getCacheWriter().flush()
+
+def _noteObjectCacheWrite(engine):
+  """Record that a build is storing objects in the background, so they
+  are written before the build finishes.
+  """
+  if engine in _objectCacheWriteEngines:
+    return
+  _objectCacheUsageLock.acquire()
+  try:
+    if engine not in _objectCacheWriteEngines:
+      _objectCacheWriteEngines[engine] = True
+      engine.addBuildSuccessCallback(_flushObjectCacheWrites)
+      engine.addBuildFailureCallback(_flushObjectCacheWrites)
+  finally:
+    _objectCacheUsageLock.release()
+
+def _getFileStat(path):
+  """Get the size and modification time of a file.
+  """
+  st = os.stat(path)
+  return st.st_size, st.st_mtime
+
+def _getObjectCacheDigestStrs(digest, count):
+  """Get the digest strings the targets of a build are cached under.
+
+  The first target is stored under the build's digest so that entries
+  for single object files are the same as those of older versions.
+  """
+  digestStrs = [cake.hash.hexlify(digest)]
+  for i in range(1, count):
+    targetDigest = cake.hash.sha1(digest + str(i).encode("latin-1")).digest()
+    digestStrs.append(cake.hash.hexlify(targetDigest))
+  return digestStrs
+
 def _totalSeconds(td):
   """Return the total number of seconds for a datetime.timedelta value.
   """
   return (td.microseconds + (
     td.seconds + td.days * 24 * 3600) * 10**6) / float(10**6)
 
+class _OutputBuffer(object):
+  """Collects all the output of a process to pass on once it has
+  finished, for compilers whose output can't be processed a line at a
+  time.
+  """
+  
+  def __init__(self, output):
+    self._output = output
+    self._chunks = []
+    self.feed = self._chunks.append
+  
+  def flush(self):
+    if self._chunks:
+      text = "".join(self._chunks)
+      del self._chunks[:]
+      self._output(text)
+
 class CompilerNotFoundError(Exception):
   """Exception raised when a compiler cannot be found.
   
@@ -274,6 +351,39 @@ class Compiler(Tool):
     GCC/MWCW:  -MD
   @type: bool
   """
+  readDependenciesFromStdout = False
+  """Read the compiler generated dependencies from its stdout.
+  
+  If True then the compiler writes its dependency rules to stdout rather
+  than a temporary file, and they are parsed from the process output. This
+  saves creating, reading and removing a file for every object compiled.
+  It has no effect if L{keepDependencyFile} is set, and is only supported
+  by GCC (and compatible compilers such as Clang).
+  
+  Related compiler options::
+    GCC:  -MF -
+  @type: bool
+  """
+  useIncludeGraph = False
+  """Store the headers included by objects in a shared include graph.
+  
+  If True then rather than storing every header an object depends on,
+  the tree of headers reported by the compiler is stored as include graph
+  nodes that are shared between objects (see L{cake.includegraph}). This
+  keeps the dependency database small for large builds, and headers
+  included by many objects are only checked once per build when working
+  out which objects are up to date.
+  
+  It requires the dependency database (see
+  L{cake.engine.Engine.dependencyDatabasePath}) and isn't used for
+  objects stored in the object cache, as their cache keys need every
+  dependency. It is supported by MSVC and GCC (and compatible compilers
+  such as Clang).
+  
+  Related compiler options::
+    GCC:  -H
+  @type: bool
+  """
   optimisation = None
   """Set the optimisation level.
   
@@ -377,6 +487,27 @@ class Compiler(Tool):
     MWCW: -map <target>.map
   @type: bool
   """
+  useShell = True
+  """Run the compiler with the shell on platforms other than Windows.
+  
+  If True then the escaped command line is run by /bin/sh, so arguments
+  are interpreted exactly as they would be on the command line. If False
+  then the compiler is run directly with the list of arguments, which
+  avoids starting a shell for every command. Arguments are then passed
+  as given, eg. quotes in defines are not removed.
+  
+  The compiler is always run directly on Windows.
+  @type: bool
+  """
+  useProcessSpawner = False
+  """Launch compilers from a separate spawner process.
+  
+  On platforms other than Windows, launching a process forks Cake, which
+  takes longer the more memory Cake uses. If True then processes are
+  launched by a small process that Cake starts once (see
+  L{cake.spawner}), which can speed up large builds.
+  @type: bool
+  """
   useResponseFile = None
   """Use a response file.
   
@@ -461,15 +592,100 @@ class Compiler(Tool):
   dependencies exists in the cache then it will be copied from the cache
   rather than being compiled.
   
+  Precompiled headers, libraries, modules, programs and resources are
+  cached in the same way unless the compiler can't cache them safely
+  (see L{canCacheLinkTargets}).
+  
   You can share an object cache with others by putting the object cache
   on a network share. You will also have to make sure all of your project
   paths match. This could be done by using a virtual drive. An alternative
   is to set a workspace root, but this can be problematic for debugging
   (see L{objectCacheWorkspaceRoot}).
   
+  The value can also be the URL of an HTTP object cache server, eg.
+  'http://buildcache:8734/', which is usually much faster than a network
+  share (see L{cake.cacheserver}).
+  
   If the value is None then object caching will be turned off.
   @type: string or None
   """
+  objectCacheMaxSize = None
+  """The maximum size of the object cache in bytes.
+  
+  If set then at the end of each build that used the object cache, the
+  least recently used objects are removed once the cache grows larger
+  than this. Objects can also be removed by running 'cake --cache-gc'.
+  This has no effect on HTTP object caches, whose size is limited by the
+  server.
+  
+  If the value is None then the object cache can grow without limit.
+  @type: int or None
+  """
+  objectCacheIndexSize = 64
+  """The maximum number of dependency entries remembered per object in
+  the object cache index.
+  
+  Each object in the object cache keeps an index of the sets of
+  dependencies it has been compiled with, most recently used first. When
+  looking for a cached object only the indexed entries are tried, so
+  entries used less recently than this many others are forgotten.
+  @type: int
+  """
+  objectCacheScanIncludes = False
+  """Scan sources for includes to find their objects in the object cache.
+  
+  If True then before an object is compiled, its source is scanned for
+  #include directives that are resolved against the include paths and
+  forced includes (see L{cake.scanner}). Objects stored in the object
+  cache are also indexed by the files the scan found and their contents,
+  so an object can be found without knowing what the compiler included
+  when it was last built, even if the entry has been pushed out of the
+  object's own index (see L{objectCacheIndexSize}).
+  
+  The scan only chooses which cache entries to try first. Each entry is
+  still checked against the dependencies the compiler reported when it
+  was stored, so includes the scanner can't follow only cause misses,
+  never out of date objects.
+  @type: bool
+  """
+  objectCacheCodec = "zlib:1"
+  """The codec used to compress objects stored in the object cache.
+  
+  One of 'zlib', 'bz2', 'lzma' or 'none', optionally followed by a
+  compression level, eg. 'zlib:6' or 'lzma:1'. The 'lzma' codec needs
+  Python 3.3 or the 'backports.lzma' package. Higher levels make the
+  cache smaller at the cost of slower stores, which may be worthwhile
+  for a cache on a slow network. 'none' is usually fastest for a cache
+  on a local disk.
+  
+  Objects are restored whichever codec they were stored with, so the
+  codec can be changed without clearing the cache.
+  @type: string
+  """
+  objectCacheWriteQueueSize = 256
+  """The maximum number of targets waiting to be stored in the object cache.
+  
+  Targets are compressed and stored in the object cache in background
+  threads, so that the tasks that depend on them can start as soon as
+  they are built. All queued targets are stored before the build
+  finishes. If the queue is full, eg. because the cache is slow, targets
+  are stored before their build task completes, as they are if this is 0.
+  @type: int
+  """
+  objectCacheLinkObjects = False
+  """Whether to restore objects from the object cache by linking to them.
+  
+  If True then objects are stored uncompressed and restored as a
+  copy-on-write clone of, or failing that a hard link to, the cached file,
+  which is almost instant even for large objects. A plain copy is made
+  if neither is possible, eg. if the cache is on a different file system
+  to the build.
+  
+  Targets that are hard links are removed before they are rebuilt, but
+  other tools must not modify them in place or they will modify the
+  cached object too. This setting is ignored for HTTP object caches.
+  @type: bool
+  """
   objectCacheWorkspaceRoot = None
   """Set the object cache workspace root.
   
@@ -635,6 +851,10 @@ class Compiler(Tool):
   # The name of this compiler
   _name = 'unknown'
 
+  # Whether process output can be processed a line at a time while the
+  # process runs, rather than all at once when it has finished.
+  _streamOutput = True
+
   # Map of engine to map of library path to list of object paths
   __libraryObjects = weakref.WeakKeyDictionary()
   
@@ -1914,6 +2134,7 @@ class Compiler(Tool):
     processStderr=None,
     processExitCode=None,
     allowResponseFile=True,
+    processKind=cake.slots.COMPILE,
     ):
 
     if target is not None:
@@ -1925,13 +2146,8 @@ class Compiler(Tool):
           cake.path.dirName(target), str(e))
         self.engine.raiseError(msg, targets=[target])
 
-    stdout = None
-    stderr = None
     argsPath = None
     try:
-      stdout = tempfile.TemporaryFile(mode="w+t")
-      stderr = tempfile.TemporaryFile(mode="w+t")
-      
       if allowResponseFile and self.useResponseFile:
         argsTemp, argsPath = tempfile.mkstemp(text=True)
         argsFileString = "\n".join(_escapeArgs(args[1:]))
@@ -1951,39 +2167,52 @@ class Compiler(Tool):
         debugString,
         )
 
-      isTiming = self.engine.logger.debugEnabled("time")
-      if isTiming:
-        start = datetime.datetime.utcnow()
-        
-      if cake.system.isWindows():
-        # Use shell=False to avoid command line length limits.
-        executable = self.configuration.abspath(args[0])
-        shell = False
+      if processStdout is None:
+        processStdout = self._outputStdout
+      if processStderr is None:
+        processStderr = self._outputStderr
+      if self._streamOutput:
+        # Process the output a line at a time while the process runs.
+        stdoutBuffer = cake.spawner.LineBuffer(processStdout)
+        stderrBuffer = cake.spawner.LineBuffer(processStderr)
       else:
-        # Use shell=True to allow arguments to be escaped exactly as they
-        # would be on the command line.
-        executable = None
-        shell = True
+        stdoutBuffer = _OutputBuffer(processStdout)
+        stderrBuffer = _OutputBuffer(processStderr)
       
+      # Wait for a process slot before timing the process.
+      processSlots = self.engine.processSlots
+      slot = processSlots.acquire(processKind)
       try:
-        p = subprocess.Popen(
-          args=argsString,
-          executable=executable,
-          shell=shell,
-          cwd=self.configuration.baseDir,
-          env=self._getProcessEnv(),
-          stdin=subprocess.PIPE,
-          stdout=stdout,
-          stderr=stderr,
-          )
-      except EnvironmentError, e:
-        self.engine.raiseError(
-          "cake: failed to launch %s: %s\n" % (args[0], str(e)),
-          targets=[target],
+        isTiming = self.engine.logger.debugEnabled("time")
+        if isTiming:
+          start = datetime.datetime.utcnow()
+
+        tracer = cake.trace.getTracer()
+        if tracer is not None:
+          traceStart = tracer.now()
+          
+        try:
+          exitCode = self._executeProcess(
+            args,
+            argsString,
+            stdoutBuffer.feed,
+            stderrBuffer.feed,
+            )
+        except EnvironmentError, e:
+          self.engine.raiseError(
+            "cake: failed to launch %s: %s\n" % (args[0], str(e)),
+            targets=[target],
+            )
+      finally:
+        processSlots.release(slot)
+
+      if tracer is not None:
+        tracer.span(
+          cake.path.baseName(args[0]),
+          "process",
+          traceStart,
+          args={"target": target, "exitCode": exitCode},
           )
-      p.stdin.close()
-  
-      exitCode = p.wait()
   
       if isTiming:
         elapsed = (datetime.datetime.utcnow() - start)
@@ -1992,31 +2221,12 @@ class Compiler(Tool):
           "time",
           "time: %.3fs %s\n" % (totalSeconds, debugString[5:]),
           )
-  
-      stdout.seek(0)
-      stderr.seek(0)
-  
-      stdoutText = stdout.read() 
-      stderrText = stderr.read()
     finally:
-      if stdout is not None:
-        stdout.close()
-      if stderr is not None:
-        stderr.close()
       if argsPath is not None:
         os.remove(argsPath)
     
-    if stdoutText:
-      if processStdout is not None:
-        processStdout(stdoutText)
-      else:
-        self._outputStdout(stdoutText)
-    
-    if stderrText:
-      if processStderr is not None:
-        processStderr(stderrText)
-      else:
-        self._outputStderr(stderrText)
+    stdoutBuffer.flush()
+    stderrBuffer.flush()
       
     if processExitCode is not None:
       processExitCode(exitCode)
@@ -2029,6 +2239,107 @@ class Compiler(Tool):
     # TODO: Return DLL's/EXE's used by gcc.exe or MSVC as well.
     return [args[0]]
   
+  def _executeProcess(self, args, argsString, onStdout, onStderr):
+    """Run a process to completion.
+    
+    @param args: The program and its arguments.
+    @type args: list of string
+    @param argsString: The escaped command line.
+    @type argsString: string
+    @param onStdout: Called with each piece of stdout as it is read.
+    @type onStdout: function(string)
+    @param onStderr: Called with each piece of stderr as it is read.
+    @type onStderr: function(string)
+    
+    @return: The exit code of the process.
+    @rtype: int
+    
+    @raise EnvironmentError: If the process couldn't be launched.
+    """
+    cwd = self.configuration.baseDir
+    env = self._getProcessEnv()
+    
+    if not cake.system.isWindows():
+      if self.useShell:
+        # Use shell=True to allow arguments to be escaped exactly as they
+        # would be on the command line.
+        popenArgs = argsString
+      else:
+        popenArgs = list(args)
+      if self.useProcessSpawner:
+        runProcess = cake.spawner.getSpawner().run
+      else:
+        runProcess = cake.spawner.runProcess
+      exitCode, _, _ = runProcess(
+        popenArgs,
+        shell=self.useShell,
+        cwd=cwd,
+        env=env,
+        onStdout=onStdout,
+        onStderr=onStderr,
+        )
+      return exitCode
+    
+    # Output is written to temporary files rather than pipes since pipe
+    # handles can be inherited by processes launched concurrently by other
+    # threads, which would keep them open until those processes exit.
+    # Use shell=False to avoid command line length limits.
+    exitCode, _, _ = cake.spawner.runProcessWithFiles(
+      argsString,
+      executable=self.configuration.abspath(args[0]),
+      cwd=cwd,
+      env=env,
+      onStdout=onStdout,
+      onStderr=onStderr,
+      )
+    return exitCode
+
+  def _runProcessAndScanDependencies(self, args, target, canUseStdout=False, canTraceIncludes=False):
+    """Run a compiler that writes a dependency file given by '-MF'.
+    
+    @param canUseStdout: Whether the compiler can write the dependency
+    file to stdout (see L{readDependenciesFromStdout}).
+    @param canTraceIncludes: Whether the compiler can report the headers
+    it includes with '-H' (see L{useIncludeGraph}).
+    
+    @return: The dependencies of the target.
+    @rtype: list of string
+    """
+    includeTree = None
+    processStderr = None
+    if canTraceIncludes and self.useIncludeGraph:
+      includeTree = cake.includegraph.IncludeTree()
+      includeParser = IncludeTreeParser(includeTree)
+      def processStderr(text):
+        # The output is passed on in whole lines, so can be parsed and
+        # output as it arrives.
+        output = includeParser.feed(text) + includeParser.close()
+        if output:
+          self._outputStderr(output)
+      args = args + ['-H']
+    
+    if canUseStdout and self.readDependenciesFromStdout and not self.keepDependencyFile:
+      parser = DependencyParser(cake.path.extension(target))
+      dependencies = self._runProcess(
+        args + ['-MF', '-'],
+        target,
+        processStdout=parser.feed,
+        processStderr=processStderr,
+        )
+      dependencies.extend(parser.close())
+    else:
+      depPath = self._generateDependencyFile(target)
+      dependencies = self._runProcess(
+        args + ['-MF', depPath],
+        target,
+        processStderr=processStderr,
+        )
+      dependencies.extend(self._scanDependencyFile(depPath, target))
+    
+    if includeTree is not None:
+      dependencies = cake.includegraph.DependencyList(dependencies, includeTree)
+    return dependencies
+
   def _scanDependencyFile(self, depPath, target):
     self.engine.logger.outputDebug(
       "scan",
@@ -2095,7 +2406,7 @@ class Compiler(Tool):
     libraryObjects[path] = tuple(objectPaths)
   
   def buildPch(self, target, source, header, object):
-    compile, args, _ = self.getPchCommands(
+    compile, args, canBeCached = self.getPchCommands(
       target,
       source,
       header,
@@ -2103,7 +2414,7 @@ class Compiler(Tool):
       )
     
     # Check if the target needs building
-    _, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
+    oldDependencyInfo, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
     if not reasonToBuild:
       return # Target is up to date
     self.engine.logger.outputDebug(
@@ -2115,33 +2426,480 @@ class Compiler(Tool):
     if object is not None:
       targets.append(object)
 
+    useCache = self._useObjectCache(canBeCached)
+    if useCache:
+      message = lambda: self.pchMessage(target, source, header=header, cached=True)
+      if self._restoreFromObjectCache(target, args, oldDependencyInfo, message):
+        return
+
+    startTime = []
     def command():
+      startTime.append(time.time())
       message = self.pchMessage(target, source, header=header, cached=False)
       self.engine.logger.outputInfo(message)
+      self._removeLinkedTargets(targets, oldDependencyInfo)
       return compile()
 
+    # Every object using the pch waits for it, so it usually has the
+    # highest priority of all.
+    priority = self.configuration.getBuildPriority(target, oldDependencyInfo)
     compileTask = self.engine.createTask(command)
     compileTask.parent.completeAfter(compileTask)
-    compileTask.start(immediate=True)
+    compileTask.start(immediate=True, priority=priority)
 
     def storeDependencyInfo():
-      abspath = self.configuration.abspath
-      normpath = os.path.normpath
-      dependencies = [
-          normpath(abspath(p))
-          for p in compileTask.result
-          ]
+      dependencies = self._getObjectCacheDependencies(compileTask.result)
+      if useCache:
+        # The object file must be restored along with the pch.
+        dependencyTargets = targets
+        includeTree = None
+      else:
+        dependencyTargets = [target]
+        includeTree = getattr(compileTask.result, "includeTree", None)
       newDependencyInfo = self.configuration.createDependencyInfo(
-        targets=[target],
+        targets=dependencyTargets,
         args=args,
         dependencies=dependencies,
-        calculateDigests=False,
+        calculateDigests=useCache,
+        includeTree=includeTree,
         )
+      newDependencyInfo.duration = time.time() - startTime[0]
       self.configuration.storeDependencyInfo(newDependencyInfo)
+
+      if useCache:
+        self._storeInObjectCache(target, newDependencyInfo, dependencies)
         
     storeDependencyTask = self.engine.createTask(storeDependencyInfo)
     storeDependencyTask.parent.completeAfter(storeDependencyTask)
-    storeDependencyTask.startAfter(compileTask, immediate=True)
+    storeDependencyTask.startAfter(compileTask, immediate=True, priority=priority)
+
+  def _getObjectCache(self):
+    """Get the backend for the object cache.
+    
+    @rtype: L{cake.objectcache.ObjectCache}
+    """
+    path = self.objectCachePath
+    if not cake.objectcache.isUrl(path):
+      path = self.configuration.abspath(path)
+    return cake.objectcache.getObjectCache(path)
+
+  def _getObjectCacheCodec(self):
+    """Get the codec to compress objects stored in the object cache with.
+    
+    @rtype: L{cake.zipping.Codec}
+    """
+    try:
+      return cake.zipping.getCodec(self.objectCacheCodec)
+    except ValueError, e:
+      self.engine.raiseError("objectCacheCodec: %s\n" % e)
+  
+  def _updateObjectCacheIndex(self, cache, targetDigestStr, entries, entry):
+    """Write the index for an object in the cache with an entry moved or
+    added to the front.
+    """
+    newEntries = [entry]
+    for e in entries:
+      if e[0] != entry[0]:
+        newEntries.append(e)
+    del newEntries[self.objectCacheIndexSize:]
+    cache.writeIndex(targetDigestStr, newEntries)
+  
+  def _noteObjectCacheUse(self, cache, addedSize):
+    """Record that a build used the object cache.
+    
+    If L{objectCacheMaxSize} is set then old objects are removed from the
+    cache at the end of the build.
+    
+    @param addedSize: The size in bytes of objects added to the cache.
+    @type addedSize: int
+    """
+    maxSize = self.objectCacheMaxSize
+    if maxSize is None:
+      return
+    
+    engine = self.engine
+    _objectCacheUsageLock.acquire()
+    try:
+      usage = _objectCacheUsage.get(engine, None)
+      if usage is None:
+        usage = _objectCacheUsage[engine] = {}
+        collect = lambda l=engine.logger: _collectUsedObjectCacheGarbage(usage, l)
+        engine.addBuildSuccessCallback(collect)
+        engine.addBuildFailureCallback(collect)
+      oldMaxSize, oldAddedSize = usage.get(cache, (maxSize, 0))
+      usage[cache] = (min(maxSize, oldMaxSize), oldAddedSize + addedSize)
+    finally:
+      _objectCacheUsageLock.release()
+
+  def _getObjectCacheKey(self, target):
+    """Get the digest string identifying the index of cached entries
+    for a target.
+    """
+    # We either need to make all paths that form the cache digest relative
+    # to the workspace root or all of them absolute.
+    configuration = self.configuration
+    targetDigestPath = configuration.abspath(target)
+    if self.objectCacheWorkspaceRoot is not None:
+      workspaceRoot = configuration.abspath(self.objectCacheWorkspaceRoot)
+      workspaceRoot = os.path.normcase(workspaceRoot)
+      targetDigestPathNorm = os.path.normcase(targetDigestPath)
+      if cake.path.commonPath(targetDigestPathNorm, workspaceRoot) == workspaceRoot:
+        targetDigestPath = targetDigestPath[len(workspaceRoot)+1:]
+    targetDigest = cake.hash.sha1(targetDigestPath.encode("utf8")).digest()
+    return cake.hash.hexlify(targetDigest)
+
+  def _getObjectCacheDependencies(self, paths):
+    """Normalise the dependency paths of a target.
+
+    Since we may be sharing the target in the object cache we need to
+    make any paths in this workspace relative to the workspace root.
+    """
+    abspath = self.configuration.abspath
+    normpath = os.path.normpath
+    if self.objectCacheWorkspaceRoot is None:
+      return [normpath(abspath(p)) for p in paths]
+
+    workspaceRoot = os.path.normcase(
+      abspath(self.objectCacheWorkspaceRoot)
+      ) + os.path.sep
+    workspaceRootLen = len(workspaceRoot)
+    dependencies = []
+    for path in paths:
+      path = normpath(abspath(path))
+      pathNorm = os.path.normcase(path)
+      if pathNorm.startswith(workspaceRoot):
+        path = path[workspaceRootLen:]
+      dependencies.append(path)
+    return dependencies
+
+  def _useObjectCache(self, canBeCached):
+    """Check whether a build should use the object cache.
+
+    Targets that can't be cached while the cache is enabled are counted
+    in the engine's cache statistics.
+
+    @param canBeCached: Whether the build's targets can be cached.
+    @type canBeCached: bool
+
+    @rtype: bool
+    """
+    if self.objectCachePath is None:
+      return False
+    if not canBeCached:
+      self.engine.cacheStatistics.recordUncacheable(self.__class__.__name__)
+      return False
+    return True
+
+  def _restoreFromObjectCache(
+    self,
+    target,
+    args,
+    oldDependencyInfo,
+    message,
+    executable=False,
+    scanDigestStr=None,
+    ):
+    """Try to restore the targets of a build from the object cache.
+
+    @param target: The path of the main target of the build.
+    @type target: string
+    @param args: The args of the build's command.
+    @param oldDependencyInfo: The dependency info from the previous build
+    of the target, if any.
+    @type oldDependencyInfo: L{DependencyInfo} or None
+    @param message: A function returning the message to output if the
+    targets were restored.
+    @type message: function
+    @param executable: Whether the main target should be made executable
+    when restored.
+    @type executable: bool
+    @param scanDigestStr: The digest of the build's scanned includes, if
+    any (see L{objectCacheScanIncludes}).
+    @type scanDigestStr: string or None
+
+    @return: True if the targets were restored and their dependency info
+    stored, False if the targets need building.
+    @rtype: bool
+    """
+    configuration = self.configuration
+
+    # If doing a force build, pretend the cache is empty
+    if self.engine.forceBuild:
+      return False
+
+    # Prime the file digest cache from previous run so we don't have
+    # to recalculate file digests for files that haven't changed.
+    if oldDependencyInfo is not None:
+      configuration.primeFileDigestCache(oldDependencyInfo)
+
+    # Find the candidate dependency lists for this target, most recently
+    # used first.
+    targetDigestStr = self._getObjectCacheKey(target)
+    cache = self._getObjectCache()
+    indexEntries = cache.readIndex(targetDigestStr)
+    if indexEntries is not None:
+      candidates = indexEntries
+    else:
+      # No index, eg. written by an older version of Cake.
+      candidates = cache.scanEntries(targetDigestStr)
+    
+    if scanDigestStr is not None:
+      # Entries stored when the includes were the same are tried first.
+      scanEntries = cache.readIndex(scanDigestStr)
+      if scanEntries:
+        scanDependencyDigestStrs = set(e[0] for e in scanEntries)
+        candidates = scanEntries + [
+          c for c in candidates if c[0] not in scanDependencyDigestStrs
+          ]
+
+    statistics = self.engine.cacheStatistics
+    if not candidates:
+      statistics.recordMiss(statistics.NO_ENTRY)
+      return False
+    missReason = statistics.DIGEST_MISMATCH
+
+    # Start fetching the object the most recently used entry last
+    # produced while we check whether it still matches.
+    prefetchedDigestStr = None
+    if candidates[0][2] is not None:
+      prefetchedDigestStr = candidates[0][2]
+      cache.prefetchObject(prefetchedDigestStr)
+
+    try:
+      for candidateIndex, candidate in enumerate(candidates):
+        dependencyDigestStr, candidateDependencies = candidate[:2]
+        if len(candidate) > 3:
+          targets = candidate[3]
+        else:
+          targets = [target]
+        try:
+          newDependencyInfo = configuration.createDependencyInfo(
+            targets=targets,
+            args=args,
+            dependencies=candidateDependencies,
+            )
+        except EnvironmentError:
+          # One of the dependencies didn't exist
+          continue
+
+        # Check if the state of our files matches that of cached targets.
+        digestStrs = _getObjectCacheDigestStrs(
+          configuration.calculateDigest(newDependencyInfo),
+          len(targets),
+          )
+        restoredBytes = 0
+        try:
+          for t, digestStr in zip(targets, digestStrs):
+            absTarget = configuration.abspath(t)
+            cache.restoreObject(digestStr, absTarget)
+            restoredBytes += os.path.getsize(absTarget)
+          if executable:
+            cake.filesys.makeExecutable(configuration.abspath(target))
+        except EnvironmentError, e:
+          # Not in the cache or invalid cache file. Objects for other
+          # digests are never found, so a missing object is only
+          # reported if the entry says it was stored.
+          if e.errno == errno.ENOENT:
+            if digestStrs[0] == candidate[2] and missReason == statistics.DIGEST_MISMATCH:
+              missReason = statistics.MISSING_OBJECT
+          else:
+            missReason = statistics.CORRUPT_ENTRY
+          continue
+        statistics.recordHit(restoredBytes)
+        self.engine.logger.outputInfo(message())
+        configuration.storeDependencyInfo(newDependencyInfo)
+        self._noteObjectCacheUse(cache, 0)
+
+        # Move the entry to the front so it is tried first next time.
+        newCandidate = (dependencyDigestStr, candidateDependencies, digestStrs[0])
+        newCandidate += tuple(candidate[3:])
+        if candidateIndex != 0 or tuple(candidate) != newCandidate or indexEntries is None:
+          if indexEntries is None:
+            indexEntries = candidates
+          self._updateObjectCacheIndex(cache, targetDigestStr, indexEntries, newCandidate)
+        # Successfully restored targets and saved new dependency info file.
+        return True
+    finally:
+      if prefetchedDigestStr is not None:
+        cache.discardPrefetched(prefetchedDigestStr)
+
+    statistics.recordMiss(missReason)
+    return False
+
+  def _storeInObjectCache(self, target, dependencyInfo, dependencies, scanDigestStr=None):
+    """Store the targets of a build in the object cache.
+
+    The targets are usually stored in the background so that tasks that
+    depend on them can start sooner (see L{objectCacheWriteQueueSize}).
+    Failing to store the targets is not an error.
+
+    @param target: The path of the main target of the build.
+    @type target: string
+    @param dependencyInfo: The dependency info of the build, created with
+    calculateDigests=True.
+    @type dependencyInfo: L{DependencyInfo}
+    @param dependencies: The dependencies of the build, as returned by
+    L{_getObjectCacheDependencies}.
+    @type dependencies: list of string
+    @param scanDigestStr: The digest of the build's scanned includes, if
+    any (see L{objectCacheScanIncludes}).
+    @type scanDigestStr: string or None
+    """
+    configuration = self.configuration
+    engine = self.engine
+    targets = list(dependencyInfo.targets)
+    codec = self._getObjectCacheCodec()
+    link = self.objectCacheLinkObjects
+    try:
+      targetDigestStr = self._getObjectCacheKey(target)
+      cache = self._getObjectCache()
+      digestStrs = _getObjectCacheDigestStrs(
+        configuration.calculateDigest(dependencyInfo),
+        len(targets),
+        )
+      absTargets = [configuration.abspath(t) for t in targets]
+      # Remember the state of the targets so that we don't store them
+      # if they change before they are written.
+      targetStats = [_getFileStat(t) for t in absTargets]
+    except EnvironmentError:
+      return
+
+    dependencyDigest = cake.hash.sha1()
+    for dep in dependencies:
+      dependencyDigest.update(dep.encode("utf8"))
+    dependencyDigest = dependencyDigest.digest()
+    dependencyDigestStr = cake.hash.hexlify(dependencyDigest)
+
+    def write():
+      tracer = cake.trace.getTracer()
+      if tracer is not None:
+        traceStart = tracer.now()
+      try:
+        if [_getFileStat(t) for t in absTargets] != targetStats:
+          engine.logger.outputDebug(
+            "cache",
+            "cache: not storing %s, it changed before it could be stored\n" % target,
+            )
+          return
+
+        # Store the targets first, then the dependency entry so that
+        # other processes won't find the entry until the targets are ready.
+        storedSize = 0
+        for absTarget, digestStr in zip(absTargets, digestStrs):
+          storedSize += cache.storeObject(digestStr, absTarget, codec, link=link)
+        self._noteObjectCacheUse(cache, storedSize)
+        engine.cacheStatistics.recordStore(storedSize)
+
+        entry = (dependencyDigestStr, dependencies, digestStrs[0])
+        if targets == [target]:
+          # Older versions of Cake only know about single object files.
+          cache.storeEntry(targetDigestStr, dependencyDigestStr, dependencies)
+        else:
+          entry += (targets,)
+
+        # Re-read the index in case another build has added entries.
+        indexEntries = cache.readIndex(targetDigestStr)
+        if indexEntries is None:
+          indexEntries = cache.scanEntries(targetDigestStr)
+        self._updateObjectCacheIndex(cache, targetDigestStr, indexEntries, entry)
+        
+        if scanDigestStr is not None:
+          indexEntries = cache.readIndex(scanDigestStr) or []
+          self._updateObjectCacheIndex(cache, scanDigestStr, indexEntries, entry)
+
+      except EnvironmentError:
+        # Don't worry if we can't put the targets in the cache
+        # The build shouldn't fail.
+        pass
+
+      if tracer is not None:
+        tracer.span("store", "cache", traceStart, args={"target": target})
+
+    writer = cake.objectcache.getCacheWriter()
+    if writer.put(write, self.objectCacheWriteQueueSize):
+      _noteObjectCacheWrite(engine)
+    else:
+      write()
+
+  def _getScanDigestStr(self, target, source, pch, args):
+    """Get the digest string identifying the cache entries of an object
+    by the files its source includes (see L{objectCacheScanIncludes}).
+    
+    @return: The digest string or None if the source couldn't be scanned.
+    @rtype: string or None
+    """
+    configuration = self.configuration
+    abspath = configuration.abspath
+    
+    forcedIncludes = []
+    for path in getPaths(self.getForcedIncludes()):
+      absPath = abspath(path)
+      if not cake.filesys.isFile(absPath):
+        # Forced includes may be relative to an include path.
+        for includePath in self.getIncludePaths():
+          candidate = abspath(cake.path.join(includePath, path))
+          if cake.filesys.isFile(candidate):
+            absPath = candidate
+            break
+      forcedIncludes.append(absPath)
+    
+    try:
+      paths, unresolved = self.engine.includeScanner.scan(
+        abspath(source),
+        [abspath(p) for p in self.getIncludePaths()],
+        forcedIncludes,
+        )
+      if pch is not None:
+        paths.append(abspath(pch.path))
+      
+      # Hash the paths as they are stored in the cache so that the digest
+      # is the same for other workspaces sharing the cache.
+      getFileDigest = self.engine.getFileDigest
+      entries = sorted(zip(self._getObjectCacheDependencies(paths), paths))
+      hasher = cake.hash.sha1()
+      hasher.update(self._getObjectCacheKey(target).encode("utf8"))
+      hasher.update(repr(args).encode("utf8"))
+      for path, absPath in entries:
+        hasher.update(path.encode("utf8"))
+        hasher.update(getFileDigest(absPath))
+      for name in sorted(unresolved):
+        hasher.update(name.encode("utf8"))
+    except EnvironmentError, e:
+      self.engine.logger.outputDebug(
+        "scan",
+        "scan: Unable to scan %s: %s\n" % (source, e),
+        )
+      return None
+    
+    self.engine.logger.outputDebug(
+      "scan",
+      "scan: %s includes %i files, %i not found\n" % (source, len(paths) - 1, len(unresolved)),
+      )
+    return cake.hash.hexlify(hasher.digest())
+
+  def _removeLinkedTargets(self, targets, oldDependencyInfo):
+    """Remove targets that are hard links before they are rebuilt.
+    
+    Targets restored from the object cache with L{objectCacheLinkObjects}
+    may be hard links to cached objects, which must not be modified.
+    """
+    paths = set(targets)
+    if oldDependencyInfo is not None:
+      paths.update(oldDependencyInfo.targets)
+    abspath = self.configuration.abspath
+    for path in paths:
+      cake.filesys.removeIfLinked(abspath(path))
+
+  def canCacheLinkTargets(self):
+    """Whether the targets of libraries, modules, programs and resources
+    can be safely stored in the object cache.
+
+    Compilers whose linkers produce outputs that aren't listed as targets,
+    or that update targets incrementally, should return False.
+
+    @rtype: bool
+    """
+    return True
 
   def buildObject(self, target, source, pch, shared):
     """Perform the actual build of an object.
@@ -2170,207 +2928,68 @@ class Compiler(Tool):
       "Rebuilding '" + target + "' because " + reasonToBuild + ".\n",
       )
 
-    useCacheForThisObject = canBeCached and self.objectCachePath is not None
-    cacheDepMagic = "CKCH" 
+    useCacheForThisObject = self._useObjectCache(canBeCached)
     
+    scanDigestStr = None
     if useCacheForThisObject:
-      #######################
-      # USING OBJECT CACHE
-      #######################
-      
-      # Prime the file digest cache from previous run so we don't have
-      # to recalculate file digests for files that haven't changed.
-      if oldDependencyInfo is not None:
-        configuration.primeFileDigestCache(oldDependencyInfo)
-      
-      # We either need to make all paths that form the cache digest relative
-      # to the workspace root or all of them absolute.
-      targetDigestPath = configuration.abspath(target)
-      if self.objectCacheWorkspaceRoot is not None:
-        workspaceRoot = configuration.abspath(self.objectCacheWorkspaceRoot)
-        workspaceRoot = os.path.normcase(workspaceRoot)
-        targetDigestPathNorm = os.path.normcase(targetDigestPath)
-        if cake.path.commonPath(targetDigestPathNorm, workspaceRoot) == workspaceRoot:
-          targetDigestPath = targetDigestPath[len(workspaceRoot)+1:]
-          
-      # Find the directory that will contain all cached dependency
-      # entries for this particular target object file.
-      targetDigest = cake.hash.sha1(targetDigestPath.encode("utf8")).digest()
-      targetDigestStr = cake.hash.hexlify(targetDigest)
-      targetCacheDir = cake.path.join(
-        self.objectCachePath,
-        targetDigestStr[0],
-        targetDigestStr[1],
-        targetDigestStr
-        )
-      targetCacheDir = configuration.abspath(targetCacheDir)
-      
-      # Find all entries in the directory
-      entries = set()
-      
-      # If doing a force build, pretend the cache is empty
-      if not self.engine.forceBuild:
-        try:
-          entries.update(os.listdir(targetCacheDir))
-        except EnvironmentError:
-          # Target cache dir doesn't exist, treat as if no entries
-          pass
-      
-      hexChars = "0123456789abcdefABCDEF"
-      
-      # Try to find the dependency files
-      for entry in entries:
-        # Skip any entry that's not a SHA-1 hash
-        if len(entry) != 40:
-          continue
-        skip = False
-        for c in entry:
-          if c not in hexChars:
-            skip = True
-            break
-        if skip:
-          continue
-
-        cacheDepPath = cake.path.join(targetCacheDir, entry)
-        
-        try:
-          cacheDepContents = cake.filesys.readFile(cacheDepPath)
-        except EnvironmentError:
-          continue
-        
-        # Check for the correct signature to make sure the file isn't corrupt
-        cacheDepMagicLen = len(cacheDepMagic)
-        cacheDepSignature = cacheDepContents[-cacheDepMagicLen:]
-        cacheDepContents = cacheDepContents[:-cacheDepMagicLen]
-        
-        if cacheDepSignature != cacheDepMagic:
-          # Invalid signature
-          continue
-        
-        try:
-          candidateDependencies = pickle.loads(cacheDepContents)
-        except Exception:
-          # Invalid dependency file for this entry
-          continue
-        
-        if not isinstance(candidateDependencies, list):
-          # Data format change
-          continue
-        
-        try:
-          newDependencyInfo = configuration.createDependencyInfo(
-            targets=[target],
-            args=args,
-            dependencies=candidateDependencies,
-            )
-        except EnvironmentError:
-          # One of the dependencies didn't exist
-          continue
-        
-        # Check if the state of our files matches that of a cached object file.
-        cachedObjectDigest = configuration.calculateDigest(newDependencyInfo)
-        cachedObjectDigestStr = cake.hash.hexlify(cachedObjectDigest)
-        cachedObjectPath = cake.path.join(
-          self.objectCachePath,
-          cachedObjectDigestStr[0],
-          cachedObjectDigestStr[1],
-          cachedObjectDigestStr
-          )
-        cachedObjectPath = configuration.abspath(cachedObjectPath)
-        if cake.filesys.isFile(cachedObjectPath):
-          message = self.objectMessage(target, source, pch=getPath(pch), shared=shared, cached=True)
-          self.engine.logger.outputInfo(message)
-          try:
-            cake.zipping.decompressFile(cachedObjectPath, configuration.abspath(target))
-          except EnvironmentError:
-            continue # Invalid cache file
-          configuration.storeDependencyInfo(newDependencyInfo)
-          # Successfully restored object file and saved new dependency info file.
-          return
+      if self.objectCacheScanIncludes:
+        scanDigestStr = self._getScanDigestStr(target, source, pch, args)
+      message = lambda: self.objectMessage(target, source, pch=getPath(pch), shared=shared, cached=True)
+      if self._restoreFromObjectCache(
+        target,
+        args,
+        oldDependencyInfo,
+        message,
+        scanDigestStr=scanDigestStr,
+        ):
+        return
 
     # Else, if we get here we didn't find the object in the cache so we need
     # to actually execute the build.
+    startTime = []
     def command():
+      startTime.append(time.time())
       message = self.objectMessage(target, source, pch=getPath(pch), shared=shared, cached=False)
       self.engine.logger.outputInfo(message)
+      self._removeLinkedTargets([target], oldDependencyInfo)
       return compile()
     
     def storeDependencyInfoAndCache():
-      # Since we are sharing this object in the object cache we need to
-      # make any paths in this workspace relative to the current workspace.
-      abspath = configuration.abspath
-      normpath = os.path.normpath
-      dependencies = []
-      if self.objectCacheWorkspaceRoot is None:
-        dependencies = [
-          normpath(abspath(p))
-          for p in compileTask.result
-          ]
+      dependencies = self._getObjectCacheDependencies(compileTask.result)
+      if useCacheForThisObject:
+        # The cache key must be calculated from every dependency.
+        includeTree = None
       else:
-        workspaceRoot = os.path.normcase(
-          configuration.abspath(self.objectCacheWorkspaceRoot)
-          ) + os.path.sep
-        workspaceRootLen = len(workspaceRoot)
-        for path in compileTask.result:
-          path = normpath(abspath(path))
-          pathNorm = os.path.normcase(path)
-          if pathNorm.startswith(workspaceRoot):
-            path = path[workspaceRootLen:]
-          dependencies.append(path)
-      
+        includeTree = getattr(compileTask.result, "includeTree", None)
       newDependencyInfo = configuration.createDependencyInfo(
         targets=[target],
         args=args,
         dependencies=dependencies,
         calculateDigests=useCacheForThisObject,
+        includeTree=includeTree,
         )
+      newDependencyInfo.duration = time.time() - startTime[0]
       configuration.storeDependencyInfo(newDependencyInfo)
 
       # Finally update the cache if necessary
       if useCacheForThisObject:
-        try:
-          objectDigest = configuration.calculateDigest(newDependencyInfo)
-          objectDigestStr = cake.hash.hexlify(objectDigest)
-          
-          dependencyDigest = cake.hash.sha1()
-          for dep in dependencies:
-            dependencyDigest.update(dep.encode("utf8"))
-          dependencyDigest = dependencyDigest.digest()
-          dependencyDigestStr = cake.hash.hexlify(dependencyDigest)
-          
-          cacheDepPath = cake.path.join(
-            targetCacheDir,
-            dependencyDigestStr
-            )
-          cacheObjectPath = cake.path.join(
-            self.objectCachePath,
-            objectDigestStr[0],
-            objectDigestStr[1],
-            objectDigestStr,
-            )
-          cacheObjectPath = configuration.abspath(cacheObjectPath)
-
-          # Copy the object file first, then the dependency file
-          # so that other processes won't find the dependency until
-          # the object file is ready.
-          cake.zipping.compressFile(configuration.abspath(target), cacheObjectPath)
-          
-          if not cake.filesys.isFile(cacheDepPath):
-            dependencyString = pickle.dumps(dependencies, pickle.HIGHEST_PROTOCOL)       
-            cake.filesys.writeFile(cacheDepPath, dependencyString + cacheDepMagic)
-            
-        except EnvironmentError:
-          # Don't worry if we can't put the object in the cache
-          # The build shouldn't fail.
-          pass
+        self._storeInObjectCache(
+          target,
+          newDependencyInfo,
+          dependencies,
+          scanDigestStr=scanDigestStr,
+          )
     
+    # Objects don't complete until their dependency info is stored, so
+    # that must run at the compile's priority too.
+    priority = configuration.getBuildPriority(target, oldDependencyInfo)
     compileTask = self.engine.createTask(command)
     compileTask.parent.completeAfter(compileTask)
-    compileTask.start(immediate=True)
+    compileTask.start(immediate=True, priority=priority)
 
     storeDependencyTask = self.engine.createTask(storeDependencyInfoAndCache)
     storeDependencyTask.parent.completeAfter(storeDependencyTask)
-    storeDependencyTask.startAfter(compileTask, immediate=True)
+    storeDependencyTask.startAfter(compileTask, immediate=True, priority=priority)
   
   def getPchCommands(self, target, source, header, object):
     """Get the command-lines for compiling a precompiled header.
@@ -2416,7 +3035,7 @@ class Compiler(Tool):
     args = repr(archive)
     
     # Check if the target needs building
-    _, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
+    oldDependencyInfo, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
     if not reasonToBuild:
       return # Target is up to date
     self.engine.logger.outputDebug(
@@ -2424,25 +3043,43 @@ class Compiler(Tool):
       "Rebuilding '" + target + "' because " + reasonToBuild + ".\n",
       )
 
+    useCache = self._useObjectCache(self.canCacheLinkTargets())
+    if useCache:
+      message = lambda: self.libraryMessage(target, sources, cached=True)
+      if self._restoreFromObjectCache(target, args, oldDependencyInfo, message):
+        return
+
     def command():
+      startTime = time.time()
       message = self.libraryMessage(target, sources, cached=False)
       self.engine.logger.outputInfo(message)
+      self._removeLinkedTargets([target], oldDependencyInfo)
       
       archive()
       
       targets, dependencies = scan()
+      if useCache:
+        dependencies = self._getObjectCacheDependencies(dependencies)
       
       newDependencyInfo = self.configuration.createDependencyInfo(
         targets=targets,
         args=args,
         dependencies=dependencies,
+        calculateDigests=useCache,
         )
+      newDependencyInfo.duration = time.time() - startTime
       
       self.configuration.storeDependencyInfo(newDependencyInfo)
 
+      if useCache:
+        self._storeInObjectCache(target, newDependencyInfo, dependencies)
+
     archiveTask = self.engine.createTask(command)
     archiveTask.parent.completeAfter(archiveTask)
-    archiveTask.start(immediate=True)
+    archiveTask.start(
+      immediate=True,
+      priority=self.configuration.getBuildPriority(target, oldDependencyInfo),
+      )
   
   def getLibraryCommand(self, target, sources):
     """Get the command for constructing a library.
@@ -2461,7 +3098,7 @@ class Compiler(Tool):
     args = [repr(link), repr(scan)]
     
     # Check if the target needs building
-    _, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
+    oldDependencyInfo, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
     if not reasonToBuild:
       return # Target is up to date
     self.engine.logger.outputDebug(
@@ -2469,25 +3106,43 @@ class Compiler(Tool):
       "Rebuilding '" + target + "' because " + reasonToBuild + ".\n",
       )
 
+    useCache = self._useObjectCache(self.canCacheLinkTargets())
+    if useCache:
+      message = lambda: self.moduleMessage(target, sources, cached=True)
+      if self._restoreFromObjectCache(target, args, oldDependencyInfo, message, executable=True):
+        return
+
     def command():
+      startTime = time.time()
       message = self.moduleMessage(target, sources, cached=False)
       self.engine.logger.outputInfo(message)
+      self._removeLinkedTargets([target], oldDependencyInfo)
       
       link()
     
       targets, dependencies = scan()
+      if useCache:
+        dependencies = self._getObjectCacheDependencies(dependencies)
       
       newDependencyInfo = self.configuration.createDependencyInfo(
         targets=targets,
         args=args,
         dependencies=dependencies,
+        calculateDigests=useCache,
         )
+      newDependencyInfo.duration = time.time() - startTime
       
       self.configuration.storeDependencyInfo(newDependencyInfo)
+
+      if useCache:
+        self._storeInObjectCache(target, newDependencyInfo, dependencies)
   
     moduleTask = self.engine.createTask(command)
     moduleTask.parent.completeAfter(moduleTask)
-    moduleTask.start(immediate=True)
+    moduleTask.start(
+      immediate=True,
+      priority=self.configuration.getBuildPriority(target, oldDependencyInfo),
+      )
   
   def getModuleCommands(self, target, sources, importLibrary, installName):
     """Get the commands for linking a module.
@@ -2517,7 +3172,7 @@ class Compiler(Tool):
     args = [repr(link), repr(scan)]
     
     # Check if the target needs building
-    _, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
+    oldDependencyInfo, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
     if not reasonToBuild:
       return # Target is up to date
     self.engine.logger.outputDebug(
@@ -2525,25 +3180,43 @@ class Compiler(Tool):
       "Rebuilding '" + target + "' because " + reasonToBuild + ".\n",
       )
 
+    useCache = self._useObjectCache(self.canCacheLinkTargets())
+    if useCache:
+      message = lambda: self.programMessage(target, sources, cached=True)
+      if self._restoreFromObjectCache(target, args, oldDependencyInfo, message, executable=True):
+        return
+
     def command():
+      startTime = time.time()
       message = self.programMessage(target, sources, cached=False)
       self.engine.logger.outputInfo(message)
+      self._removeLinkedTargets([target], oldDependencyInfo)
           
       link()
     
       targets, dependencies = scan()
+      if useCache:
+        dependencies = self._getObjectCacheDependencies(dependencies)
       
       newDependencyInfo = self.configuration.createDependencyInfo(
         targets=targets,
         args=args,
         dependencies=dependencies,
+        calculateDigests=useCache,
         )
+      newDependencyInfo.duration = time.time() - startTime
       
       self.configuration.storeDependencyInfo(newDependencyInfo)
 
+      if useCache:
+        self._storeInObjectCache(target, newDependencyInfo, dependencies)
+
     programTask = self.engine.createTask(command)
     programTask.parent.completeAfter(programTask)
-    programTask.start(immediate=True)
+    programTask.start(
+      immediate=True,
+      priority=self.configuration.getBuildPriority(target, oldDependencyInfo),
+      )
 
   def getProgramCommands(self, target, sources):
     """Get the commands for linking a program.
@@ -2576,7 +3249,7 @@ class Compiler(Tool):
     args = repr(compile)
     
     # Check if the target needs building
-    _, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
+    oldDependencyInfo, reasonToBuild = self.configuration.checkDependencyInfo(target, args)
     if not reasonToBuild:
       return # Target is up to date
     self.engine.logger.outputDebug(
@@ -2584,25 +3257,43 @@ class Compiler(Tool):
       "Rebuilding '" + target + "' because " + reasonToBuild + ".\n",
       )
 
+    useCache = self._useObjectCache(self.canCacheLinkTargets())
+    if useCache:
+      message = lambda: self.resourceMessage(target, source, cached=True)
+      if self._restoreFromObjectCache(target, args, oldDependencyInfo, message):
+        return
+
     def command():
+      startTime = time.time()
       message = self.resourceMessage(target, source, cached=False)
       self.engine.logger.outputInfo(message)
+      self._removeLinkedTargets([target], oldDependencyInfo)
       
       compile()
       
       targets, dependencies = scan()
+      if useCache:
+        dependencies = self._getObjectCacheDependencies(dependencies)
       
       newDependencyInfo = self.configuration.createDependencyInfo(
         targets=targets,
         args=args,
         dependencies=dependencies,
+        calculateDigests=useCache,
         )
+      newDependencyInfo.duration = time.time() - startTime
       
       self.configuration.storeDependencyInfo(newDependencyInfo)
 
+      if useCache:
+        self._storeInObjectCache(target, newDependencyInfo, dependencies)
+
     resourceTask = self.engine.createTask(command)
     resourceTask.parent.completeAfter(resourceTask)
-    resourceTask.start(immediate=True)
+    resourceTask.start(
+      immediate=True,
+      priority=self.configuration.getBuildPriority(target, oldDependencyInfo),
+      )
   
   def getResourceCommand(self, target, sources):
     """Get the command for constructing a resource.
@@ -10,6 +10,7 @@ from cake.target import getPaths
 from cake.library.compilers import Compiler, makeCommand, CompilerNotFoundError
 import cake.filesys
 import cake.path
+import cake.slots
 import cake.system
 import os
 import os.path
@@ -343,20 +344,21 @@ class GccCompiler(Compiler):
     return language
 
   def getPchCommands(self, target, source, header, object):
-    depPath = self._generateDependencyFile(target)
     args = list(self._getCompileArgs(cake.path.extension(source), shared=False, pch=True))
     args.extend([source, '-o', target])
 
     def compile():   
-      dependencies = self._runProcess(args + ['-MF', depPath], target)
-      dependencies.extend(self._scanDependencyFile(depPath, target))
-      return dependencies
+      return self._runProcessAndScanDependencies(
+        args,
+        target,
+        canUseStdout=True,
+        canTraceIncludes=True,
+        )
     
     canBeCached = True
     return compile, args, canBeCached
   
   def getObjectCommands(self, target, source, pch, shared):
-    depPath = self._generateDependencyFile(target)
     args = list(self._getCompileArgs(cake.path.extension(source), shared))
     args.extend([source, '-o', target])
   
@@ -367,8 +369,12 @@ class GccCompiler(Compiler):
         ])
         
     def compile():
-      dependencies = self._runProcess(args + ['-MF', depPath], target)
-      dependencies.extend(self._scanDependencyFile(depPath, target))
+      dependencies = self._runProcessAndScanDependencies(
+        args,
+        target,
+        canUseStdout=True,
+        canTraceIncludes=True,
+        )
               
       if pch is not None:
         dependencies.append(pch.path)
@@ -395,7 +401,7 @@ class GccCompiler(Compiler):
     @makeCommand(args)
     def archive():
       cake.filesys.remove(target)
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
 
     @makeCommand("lib-scan")
     def scan():
@@ -447,7 +453,7 @@ class GccCompiler(Compiler):
     
     @makeCommand(args)
     def link():
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
 
       if dll and importLibrary:
         # Since the target .dylib is also the import library, copy it to the
@@ -528,7 +534,7 @@ class WindowsGccCompiler(GccCompiler):
     @makeCommand(args)
     def compile():
       cake.filesys.remove(self.configuration.abspath(target))
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
 
     @makeCommand("rc-scan")
     def scan():
@@ -571,7 +577,7 @@ class MacGccCompiler(GccCompiler):
     @makeCommand(args)
     def archive():
       cake.filesys.remove(target)
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
 
     @makeCommand("lib-scan")
     def scan():
@@ -622,7 +628,7 @@ class MacGccCompiler(GccCompiler):
 
     @makeCommand(args)
     def link():
-      self._runProcess(args, target)      
+      self._runProcess(args, target, processKind=cake.slots.LINK)      
 
       if dll and importLibrary:
         # Since the target .dylib is also the import library, copy it to the
@@ -11,8 +11,11 @@ import re
 import threading
 
 import cake.filesys
+import cake.includegraph
 import cake.path
+import cake.slots
 import cake.system
+import cake.trace
 from cake.library.compilers import Compiler, makeCommand, CompilerNotFoundError
 from cake.library import memoise
 from cake.target import getPaths, getTasks
@@ -962,6 +965,10 @@ class MsvcCompiler(Compiler):
       if self.language == 'c++/cli':
         dependencies.extend(getPaths(self.forcedUsings))
       dependenciesSet = set()
+      if self.useIncludeGraph:
+        includeTree = cake.includegraph.IncludeTree()
+      else:
+        includeTree = None
 
       def processStdout(text):
         includePrefix = ('Note: including file:')
@@ -973,7 +980,11 @@ class MsvcCompiler(Compiler):
           if line == sourceName:
             continue
           if line.startswith(includePrefix):
-            path = line[includePrefixLen:].lstrip()
+            indentedPath = line[includePrefixLen:]
+            path = indentedPath.lstrip()
+            if includeTree is not None:
+              # The indent is one space per level of include depth.
+              includeTree.addInclude(len(indentedPath) - len(path), path)
             normPath = os.path.normcase(os.path.normpath(path))
             if normPath not in dependenciesSet:
               dependenciesSet.add(normPath)
@@ -990,6 +1001,8 @@ class MsvcCompiler(Compiler):
         processStdout=processStdout,
         )
       
+      if includeTree is not None:
+        dependencies = cake.includegraph.DependencyList(dependencies, includeTree)
       return dependencies
       
     def compileWhenPdbIsFree():
@@ -1001,9 +1014,18 @@ class MsvcCompiler(Compiler):
       try:
         predecessor = self._pdbQueue.get(absPdbFile, None)
         if predecessor is not None:
-          predecessor.addCallback(
-            lambda: compileTask.start(immediate=True)
-            )
+          tracer = cake.trace.getTracer()
+          if tracer is not None:
+            # Show how long compiles are serialised waiting for the pdb.
+            tracer.beginAsync("pdb wait", "pdb", id(compileTask), {"pdb": pdbFile})
+            def startAfterPdbWait():
+              tracer.endAsync("pdb wait", "pdb", id(compileTask))
+              compileTask.start(immediate=True)
+            predecessor.addCallback(startAfterPdbWait)
+          else:
+            predecessor.addCallback(
+              lambda: compileTask.start(immediate=True)
+              )
         else:
           compileTask.start(immediate=True)
         self._pdbQueue[absPdbFile] = compileTask
@@ -1051,7 +1073,7 @@ class MsvcCompiler(Compiler):
     
     @makeCommand(args)
     def archive():
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
 
     @makeCommand("lib-scan")
     def scan():
@@ -1145,6 +1167,10 @@ class MsvcCompiler(Compiler):
     
     return args
 
+  def canCacheLinkTargets(self):
+    # The linker updates .pdb and .ilk files that aren't always targets.
+    return not self.debugSymbols and not self.useIncrementalLinking
+
   def getProgramCommands(self, target, sources):
     return self._getLinkCommands(target, sources, dll=False)
   
@@ -1229,7 +1255,7 @@ class MsvcCompiler(Compiler):
     def link():
       if dll and importLibrary:
         cake.filesys.makeDirs(cake.path.dirName(importLibrary))
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
        
     @makeCommand(args) 
     def linkWithManifestIncremental():
@@ -1244,7 +1270,7 @@ class MsvcCompiler(Compiler):
         self._runProcess(
           args=rcArgs,
           target=embeddedRes,
-          processStdout=self._processRcStdout,
+          processStdout=self._getRcStdoutProcessor(),
           allowResponseFile=False,
           )
       
@@ -1282,6 +1308,7 @@ class MsvcCompiler(Compiler):
           args=mtArgs,
           target=embeddedManifest,
           processExitCode=processExitCode,
+          processKind=cake.slots.LINK,
           )
         
         return result[0]
@@ -1340,7 +1367,7 @@ class MsvcCompiler(Compiler):
         "/outputresource:%s;%i" % (target, manifestResourceId),
         ]
       
-      self._runProcess(mtArgs, embeddedManifest)
+      self._runProcess(mtArgs, embeddedManifest, processKind=cake.slots.LINK)
         
     @makeCommand("link-scan")
     def scan():
@@ -1397,7 +1424,7 @@ class MsvcCompiler(Compiler):
       self._runProcess(
         args,
         target,
-        processStdout=self._processRcStdout,
+        processStdout=self._getRcStdoutProcessor(),
         allowResponseFile=False)
 
     @makeCommand("rc-scan")
@@ -1407,19 +1434,33 @@ class MsvcCompiler(Compiler):
 
     return compile, scan
     
-  def _processRcStdout(self, text):
-    """Process the output of rc.exe, suppressing the leading logo.
+  def _getRcStdoutProcessor(self):
+    """Get a function to process the output of rc.exe, suppressing the
+    leading logo.
     
     We use this rather than /nologo as the /nologo flag isn't supported on all
     versions of rc.exe.
+    
+    The output is processed a line at a time as rc.exe runs, so a new
+    function is needed for each run to keep track of the leading lines.
     """
-    outputLines = text.splitlines()
-
-    # Skip any leading logo output by some of the later versions of rc.exe
-    if len(outputLines) >= 2 and \
-       outputLines[0].startswith('Microsoft (R) Windows (R) Resource Compiler Version ') and \
-       outputLines[1].startswith('Copyright (C) Microsoft Corporation.  All rights reserved.'):
-      outputLines = outputLines[2:]
-      
-    if outputLines:
-      self._outputStdout("\n".join(outputLines) + "\n")
+    # The logo output by some of the later versions of rc.exe
+    logoLines = [
+      'Microsoft (R) Windows (R) Resource Compiler Version ',
+      'Copyright (C) Microsoft Corporation.  All rights reserved.',
+      ]
+    lineCount = [0]
+    
+    def processStdout(text):
+      outputLines = []
+      for line in text.splitlines():
+        index = lineCount[0]
+        lineCount[0] += 1
+        if index < len(logoLines) and line.startswith(logoLines[index]):
+          continue
+        outputLines.append(line)
+        
+      if outputLines:
+        self._outputStdout("\n".join(outputLines) + "\n")
+    
+    return processStdout
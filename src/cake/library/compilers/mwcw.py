@@ -10,6 +10,7 @@ import os.path
 
 import cake.filesys
 import cake.path
+import cake.slots
 from cake.library import memoise, getPaths
 from cake.library.compilers import Compiler, makeCommand
 from cake.gnu import parseDependencyFile
@@ -20,6 +21,8 @@ class MwcwCompiler(Compiler):
   programSuffix = '.elf'
   pchSuffix = '.mch'
   _name = 'mwcw'
+  # Messages span several lines so must be formatted all at once.
+  _streamOutput = False
 
   def __init__(
     self,
@@ -209,20 +212,16 @@ class MwcwCompiler(Compiler):
     return language
 
   def getPchCommands(self, target, source, header, object):
-    depPath = self._generateDependencyFile(target)
     args = list(self._getCompileArgs(cake.path.extension(source)))
     args.extend([source, '-precompile', target])
     
     def compile():
-      dependencies = self._runProcess(args + ['-MF', depPath], target)
-      dependencies.extend(self._scanDependencyFile(depPath, target))
-      return dependencies
+      return self._runProcessAndScanDependencies(args, target)
 
     canBeCached = True
     return compile, args, canBeCached   
   
   def getObjectCommands(self, target, source, pch, shared):
-    depPath = self._generateDependencyFile(target)
     args = list(self._getCompileArgs(cake.path.extension(source)))
     args.extend([source, '-o', target])
     
@@ -230,8 +229,7 @@ class MwcwCompiler(Compiler):
       args.extend(['-include', pch.path])
 
     def compile():
-      dependencies = self._runProcess(args + ['-MF', depPath], target)
-      dependencies.extend(self._scanDependencyFile(depPath, target))
+      dependencies = self._runProcessAndScanDependencies(args, target)
       
       if pch is not None:
         dependencies.append(pch.path)
@@ -256,7 +254,7 @@ class MwcwCompiler(Compiler):
     @makeCommand(args)
     def archive():
       cake.filesys.remove(self.configuration.abspath(target))
-      self._runProcess(args, target)
+      self._runProcess(args, target, processKind=cake.slots.LINK)
 
     @makeCommand("lib-scan")
     def scan():
@@ -306,7 +304,7 @@ class MwcwCompiler(Compiler):
       
     @makeCommand(args)
     def link():
-      self._runProcess(args, target)      
+      self._runProcess(args, target, processKind=cake.slots.LINK)      
     
     @makeCommand("link-scan")
     def scan():
@@ -9,6 +9,8 @@ import os
 import subprocess
 import cake.filesys
 import cake.path
+import cake.slots
+import cake.trace
 from cake.async import waitForAsyncResult, flatten
 from cake.target import Target, FileTarget, getPaths, getTasks
 from cake.library import Tool
@@ -125,21 +127,39 @@ class ShellTool(Tool):
         "run: %s\n" % argsString,
         )
 
+      processSlots = engine.processSlots
+      slot = processSlots.acquire(cake.slots.SHELL)
       try:
-        p = subprocess.Popen(
-          args=args,
-          executable=executable,
-          env=self._env,
-          stdin=subprocess.PIPE,
-          shell=shell,
-          cwd=cwd,
-          )
-      except EnvironmentError, e:
-        msg = "cake: failed to launch %s: %s\n" % (argsList[0], str(e))
-        engine.raiseError(msg, targets=targets)
+        tracer = cake.trace.getTracer()
+        if tracer is not None:
+          traceStart = tracer.now()
 
-      p.stdin.close()
-      exitCode = p.wait()
+        try:
+          # Make processes run by the command share our jobserver.
+          p = subprocess.Popen(
+            args=args,
+            executable=executable,
+            env=processSlots.getEnvironment(self._env),
+            stdin=subprocess.PIPE,
+            shell=shell,
+            cwd=cwd,
+            )
+        except EnvironmentError, e:
+          msg = "cake: failed to launch %s: %s\n" % (argsList[0], str(e))
+          engine.raiseError(msg, targets=targets)
+
+        p.stdin.close()
+        exitCode = p.wait()
+      finally:
+        processSlots.release(slot)
+
+      if tracer is not None:
+        tracer.span(
+          cake.path.baseName(argsList[0]),
+          "process",
+          traceStart,
+          args={"targets": targets, "exitCode": exitCode},
+          )
       
       if exitCode != 0:
         msg = "%s exited with code %i\n" % (argsList[0], exitCode)
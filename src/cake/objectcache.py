@@ -0,0 +1,1126 @@
+"""Object Cache Backends.
+
+An object cache stores compiled outputs keyed by the digest of the inputs
+used to build them, so they can be restored instead of rebuilt. For each
+target the cache also keeps an index of the lists of dependencies it has
+been built with, most recently used first.
+
+Two backends are provided. L{FileObjectCache} stores the cache in a
+directory, which may be on a network share. L{HttpObjectCache} talks to
+an HTTP server such as the one in L{cake.cacheserver}, which avoids the
+many small file system operations that are slow over SMB or NFS.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import collections
+import errno
+import httplib
+import json
+import marshal
+import os
+import os.path
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import traceback
+import urlparse
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+import cake.filesys
+import cake.path
+import cake.zipping
+
+_depMagic = "CKCH"
+_indexMagic = "CKIX"
+_indexVersion = 2
+_indexName = "index"
+_sizeName = "size"
+_rawSuffix = ".raw"
+_usedSuffix = ".used"
+
+def isCacheDigest(name):
+  """Check if a name is a SHA-1 hex digest, as used for cache keys.
+
+  @rtype: bool
+  """
+  if len(name) != 40:
+    return False
+  hexChars = "0123456789abcdefABCDEF"
+  for c in name:
+    if c not in hexChars:
+      return False
+  return True
+
+def isUrl(path):
+  """Check if an object cache path is a URL rather than a file system path.
+
+  @rtype: bool
+  """
+  return path.startswith("http://") or path.startswith("https://")
+
+def parseIndex(data):
+  """Parse the contents of an index.
+
+  @return: A list of (dependencyDigestStr, dependencies, objectDigestStr)
+  tuples, most recently used first, or None if the data isn't a valid
+  index. The objectDigestStr is the object most recently built or restored
+  using the entry, or None if unknown.
+  """
+  magicLen = len(_indexMagic)
+  if data[:magicLen] != _indexMagic:
+    return None
+  try:
+    version, entries = marshal.loads(data[magicLen:])
+  except Exception:
+    return None
+  if version != _indexVersion:
+    return None
+  return entries
+
+def formatIndex(entries):
+  """Format a list of entries as the contents of an index.
+
+  @raise ValueError: If the entries can't be formatted.
+  """
+  return _indexMagic + marshal.dumps((_indexVersion, [tuple(e) for e in entries]))
+
+def storeFileAtomic(path, write):
+  """Write a file so that readers never see it partially written.
+
+  @param path: The path of the file to write.
+  @type path: string
+  @param write: A function that writes the file given a temporary path.
+  @type write: function
+
+  @return: The return value of write.
+  """
+  tempPath = cake.filesys.makeTempPath(path)
+  try:
+    result = write(tempPath)
+    cake.filesys.replaceFile(tempPath, path)
+  except EnvironmentError:
+    try:
+      cake.filesys.remove(tempPath)
+    except EnvironmentError:
+      pass
+    raise
+  return result
+
+class ObjectCache(object):
+  """Base class for object cache backends.
+
+  Objects and indexes are keyed by 40 character hex digests. Failing to
+  read from or write to the cache should never fail a build, so the index
+  methods ignore errors while the object methods raise EnvironmentError
+  for the caller to ignore.
+  """
+
+  def readIndex(self, targetDigestStr):
+    """Read the index of dependency entries for a target.
+
+    @return: The entries as returned by L{parseIndex}, or None if there
+    is no valid index.
+    """
+    raise NotImplementedError()
+
+  def writeIndex(self, targetDigestStr, entries):
+    """Write the index of dependency entries for a target.
+    """
+    raise NotImplementedError()
+
+  def scanEntries(self, targetDigestStr):
+    """Find dependency entries for a target that has no index.
+
+    @return: A list of (dependencyDigestStr, dependencies, None) tuples.
+    """
+    return []
+
+  def storeEntry(self, targetDigestStr, dependencyDigestStr, dependencies):
+    """Store a dependency entry for readers that don't use the index.
+    """
+    pass
+
+  def restoreObject(self, objectDigestStr, targetPath):
+    """Restore a cached object.
+
+    @param targetPath: The path to write the object to.
+    @type targetPath: string
+
+    @raise EnvironmentError: If the object isn't in the cache or couldn't
+    be restored.
+    """
+    raise NotImplementedError()
+
+  def storeObject(self, objectDigestStr, sourcePath, codec=None, link=False):
+    """Store an object in the cache.
+
+    @param sourcePath: The path of the object to store.
+    @type sourcePath: string
+    @param codec: The codec to compress the object with, or None for the
+    default. Objects are restored whichever codec they were stored with.
+    @type codec: L{cake.zipping.Codec} or None
+    @param link: Whether to store the object uncompressed so that it can
+    be restored by linking to it, if the backend supports it. The codec
+    is ignored if so.
+    @type link: bool
+
+    @return: The number of bytes added to the cache.
+    @rtype: int
+
+    @raise EnvironmentError: If the object couldn't be stored.
+    """
+    raise NotImplementedError()
+
+  def prefetchObject(self, objectDigestStr):
+    """Start fetching an object that is likely to be restored soon.
+
+    The fetched object is kept until it is restored or discarded with
+    L{discardPrefetched}.
+    """
+    pass
+
+  def discardPrefetched(self, objectDigestStr):
+    """Discard an object fetched by L{prefetchObject} that wasn't restored.
+    """
+    pass
+
+  def collectGarbage(self, maxSize=None, addedSize=None):
+    """Remove the least recently used objects if the cache is too large.
+
+    @param maxSize: The maximum size of the cache in bytes, or None to only
+    remove orphaned dependency entries.
+    @type maxSize: int or None
+    @param addedSize: The number of bytes stored by this build. If given
+    then the cache is only scanned if its estimated size exceeds maxSize.
+    @type addedSize: int or None
+
+    @return: A (removedCount, removedSize, remainingSize) tuple, or None if
+    the cache wasn't scanned or the backend doesn't support collection.
+    """
+    return None
+
+class FileObjectCache(ObjectCache):
+  """An object cache stored in a directory.
+
+  Objects are stored compressed at <path>/<d[0]>/<d[1]>/<d>, or
+  uncompressed at <path>/<d[0]>/<d[1]>/<d>.raw if they are to be restored
+  by linking to them (see L{cake.filesys.linkFile}). Each
+  target has a directory <path>/<d[0]>/<d[1]>/<d>/ holding its index and
+  an individual file for each dependency entry, which older versions of
+  Cake read instead of the index.
+  """
+
+  def __init__(self, path):
+    """Construct a file object cache.
+
+    @param path: The absolute path of the cache directory.
+    @type path: string
+    """
+    self.path = path
+
+  def getObjectPath(self, objectDigestStr):
+    """Get the path of the file storing an object.
+    """
+    d = objectDigestStr
+    return cake.path.join(self.path, d[0], d[1], d)
+
+  def getRawObjectPath(self, objectDigestStr):
+    """Get the path of the file storing an uncompressed object.
+    """
+    return self.getObjectPath(objectDigestStr) + _rawSuffix
+
+  def getIndexPath(self, targetDigestStr):
+    """Get the path of the file storing a target's index.
+    """
+    d = targetDigestStr
+    return cake.path.join(self.path, d[0], d[1], d, _indexName)
+
+  def readIndex(self, targetDigestStr):
+    try:
+      data = cake.filesys.readFile(self.getIndexPath(targetDigestStr))
+    except EnvironmentError:
+      return None
+    return parseIndex(data)
+
+  def writeIndex(self, targetDigestStr, entries):
+    try:
+      cake.filesys.writeFileAtomic(self.getIndexPath(targetDigestStr), formatIndex(entries))
+    except (EnvironmentError, ValueError):
+      pass # The cache still works without the index.
+
+  def scanEntries(self, targetDigestStr):
+    # This is much slower than reading the index, it is only done if the
+    # index is missing, eg. it was written by an older version of Cake.
+    targetCacheDir = os.path.dirname(self.getIndexPath(targetDigestStr))
+    try:
+      names = os.listdir(targetCacheDir)
+    except EnvironmentError:
+      # Target cache dir doesn't exist, treat as if no entries
+      return []
+
+    magicLen = len(_depMagic)
+
+    entries = []
+    for name in names:
+      # Skip any entry that's not a SHA-1 hash
+      if not isCacheDigest(name):
+        continue
+
+      try:
+        contents = cake.filesys.readFile(cake.path.join(targetCacheDir, name))
+      except EnvironmentError:
+        continue
+
+      # Check for the correct signature to make sure the file isn't corrupt
+      if contents[-magicLen:] != _depMagic:
+        continue
+
+      try:
+        dependencies = pickle.loads(contents[:-magicLen])
+      except Exception:
+        # Invalid dependency file for this entry
+        continue
+
+      if not isinstance(dependencies, list):
+        # Data format change
+        continue
+
+      entries.append((name, dependencies, None))
+    return entries
+
+  def storeEntry(self, targetDigestStr, dependencyDigestStr, dependencies):
+    targetCacheDir = os.path.dirname(self.getIndexPath(targetDigestStr))
+    entryPath = cake.path.join(targetCacheDir, dependencyDigestStr)
+    if not cake.filesys.isFile(entryPath):
+      data = pickle.dumps(dependencies, pickle.HIGHEST_PROTOCOL)
+      cake.filesys.writeFile(entryPath, data + _depMagic)
+
+  def restoreObject(self, objectDigestStr, targetPath):
+    # Replace the target rather than writing to it in case it's a link
+    # to a raw object, and so a failed restore leaves it untouched.
+    objectPath = self.getObjectPath(objectDigestStr)
+    try:
+      storeFileAtomic(
+        targetPath,
+        lambda p: cake.zipping.decompressFile(objectPath, p),
+        )
+    except EnvironmentError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      objectPath = self.getRawObjectPath(objectDigestStr)
+      cake.filesys.makeDirs(os.path.dirname(targetPath))
+      storeFileAtomic(
+        targetPath,
+        lambda p: cake.filesys.linkFile(objectPath, p),
+        )
+      # Targets in other workspaces may be hard links to the raw object,
+      # so touching it would change their timestamps too. Touch a file
+      # next to it instead.
+      objectPath += _usedSuffix
+
+    # Mark the object as recently used.
+    try:
+      os.utime(objectPath, None)
+    except EnvironmentError:
+      try:
+        cake.filesys.writeFile(objectPath, "")
+      except EnvironmentError:
+        pass
+
+  def storeObject(self, objectDigestStr, sourcePath, codec=None, link=False):
+    # Write the object atomically so that other builds never restore a
+    # partially written object.
+    if link:
+      def copy(p):
+        # Clone or copy rather than link so that rebuilding the source
+        # can't modify the cached object.
+        cake.filesys.makeDirs(os.path.dirname(p))
+        try:
+          cake.filesys.cloneFile(sourcePath, p)
+        except EnvironmentError:
+          cake.filesys.copyFile(sourcePath, p)
+        return os.path.getsize(p)
+      return storeFileAtomic(self.getRawObjectPath(objectDigestStr), copy)
+    return storeFileAtomic(
+      self.getObjectPath(objectDigestStr),
+      lambda p: cake.zipping.compressFile(sourcePath, p, codec),
+      )
+
+  def collectGarbage(self, maxSize=None, addedSize=None):
+    if addedSize is not None:
+      # Only scan the cache if the estimated size, from the last scan plus
+      # the objects stored since, exceeds the maximum size.
+      size = self._readSize()
+      if size is not None and (maxSize is None or size + addedSize <= maxSize):
+        self._writeSize(size + addedSize)
+        return None
+    return collectGarbage(self.path, maxSize)
+
+  def _readSize(self):
+    try:
+      data = cake.filesys.readFile(cake.path.join(self.path, _sizeName))
+      size = marshal.loads(data)
+    except Exception:
+      return None
+    if not isinstance(size, (int, long)):
+      return None
+    return size
+
+  def _writeSize(self, size):
+    try:
+      cake.filesys.writeFileAtomic(cake.path.join(self.path, _sizeName), marshal.dumps(size))
+    except EnvironmentError:
+      pass
+
+def collectGarbage(path, maxSize=None):
+  """Remove least recently used objects from an object cache directory.
+
+  Objects are removed, oldest first, until the cache is below 90% of
+  maxSize. An object's modification time is used as its last use time,
+  it is updated when the object is restored from the cache. The access
+  time isn't used since it often isn't updated, eg. on 'noatime' mounts.
+  Uncompressed objects may be hard linked by restored targets so the
+  modification time of a '.used' file next to them is used instead.
+
+  Dependency entries whose most recent object no longer exists are then
+  removed, along with any entries no longer in a target's index.
+
+  @param path: The path to the object cache directory.
+  @type path: string
+  @param maxSize: The maximum size of the cache in bytes or None to only
+  remove orphaned dependency entries.
+  @type maxSize: int or None
+
+  @return: A (removedCount, removedSize, remainingSize) tuple giving the
+  number and total size of the objects removed and the size of the objects
+  that remain.
+  @rtype: tuple of (int, int, int)
+  """
+  cache = FileObjectCache(path)
+  objects = []
+  usedTimes = {}
+  targetCacheDirs = []
+  totalSize = 0
+
+  def listDir(path):
+    try:
+      return os.listdir(path)
+    except EnvironmentError:
+      return [] # Not a directory or removed by another build.
+
+  for first in listDir(path):
+    if len(first) != 1:
+      continue
+    firstPath = cake.path.join(path, first)
+    for second in listDir(firstPath):
+      secondPath = cake.path.join(firstPath, second)
+      for fileName in listDir(secondPath):
+        name = fileName
+        if name.endswith(_usedSuffix):
+          entryPath = cake.path.join(secondPath, fileName)
+          try:
+            usedTimes[entryPath[:-len(_usedSuffix)]] = os.stat(entryPath).st_mtime
+          except EnvironmentError:
+            pass
+          continue
+        if name.endswith(_rawSuffix):
+          name = name[:-len(_rawSuffix)]
+        if not isCacheDigest(name):
+          continue
+        entryPath = cake.path.join(secondPath, fileName)
+        try:
+          st = os.stat(entryPath)
+        except EnvironmentError:
+          continue
+        if stat.S_ISDIR(st.st_mode):
+          targetCacheDirs.append((name, entryPath))
+        else:
+          objects.append((st.st_mtime, st.st_size, name, entryPath))
+          totalSize += st.st_size
+
+  for i, (mtime, size, name, objectPath) in enumerate(objects):
+    usedTime = usedTimes.pop(objectPath, None)
+    if usedTime is not None and usedTime > mtime:
+      objects[i] = (usedTime, size, name, objectPath)
+
+  # Remove '.used' files left behind by objects removed by other builds.
+  for objectPath in usedTimes:
+    try:
+      cake.filesys.remove(objectPath + _usedSuffix)
+    except EnvironmentError:
+      pass
+
+  removedCount = 0
+  removedSize = 0
+  removedObjects = set()
+  removedPaths = set()
+  if maxSize is not None and totalSize > maxSize:
+    targetSize = int(maxSize * 0.9)
+    objects.sort()
+    for _, size, name, objectPath in objects:
+      if totalSize <= targetSize:
+        break
+      try:
+        cake.filesys.remove(objectPath)
+      except EnvironmentError:
+        continue
+      if objectPath.endswith(_rawSuffix):
+        try:
+          cake.filesys.remove(objectPath + _usedSuffix)
+        except EnvironmentError:
+          pass
+      totalSize -= size
+      removedCount += 1
+      removedSize += size
+      removedObjects.add(name)
+      removedPaths.add(objectPath)
+
+  # An object may be stored both compressed and uncompressed.
+  remainingObjects = set(
+    name for _, _, name, objectPath in objects
+    if objectPath not in removedPaths
+    )
+
+  def isLive(entry):
+    objectDigestStr = entry[2]
+    if objectDigestStr is None:
+      return False
+    if objectDigestStr in remainingObjects:
+      return True
+    if objectDigestStr in removedObjects:
+      return False
+    # May have been added by another build since the cache was listed.
+    return cake.filesys.isFile(cache.getObjectPath(objectDigestStr)) or \
+      cake.filesys.isFile(cache.getRawObjectPath(objectDigestStr))
+
+  for targetDigestStr, targetCacheDir in targetCacheDirs:
+    entries = cache.readIndex(targetDigestStr)
+    if entries is None:
+      continue # Written by an older version, can't tell what's orphaned.
+
+    liveEntries = [e for e in entries if isLive(e)]
+    if len(liveEntries) != len(entries):
+      if liveEntries:
+        cache.writeIndex(targetDigestStr, liveEntries)
+      else:
+        try:
+          cake.filesys.remove(cache.getIndexPath(targetDigestStr))
+        except EnvironmentError:
+          pass
+
+    liveNames = set(e[0] for e in liveEntries)
+    for name in listDir(targetCacheDir):
+      if isCacheDigest(name) and name not in liveNames:
+        try:
+          cake.filesys.remove(cake.path.join(targetCacheDir, name))
+        except EnvironmentError:
+          pass
+    if not liveEntries:
+      try:
+        os.rmdir(targetCacheDir)
+      except EnvironmentError:
+        pass # Another build may have just added an entry.
+
+  cache._writeSize(totalSize)
+
+  return removedCount, removedSize, totalSize
+
+class _Prefetch(object):
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.file = None
+    self.discarded = False
+
+class HttpObjectCache(ObjectCache):
+  """An object cache accessed over HTTP.
+
+  Objects are fetched and stored with GET and PUT requests to
+  <url>/object/<digest> and indexes with <url>/index/<digest>. Objects
+  are sent compressed and streamed through temporary files so they are
+  never held in memory. Connections are kept open and reused between
+  requests.
+  """
+
+  maxConnections = 8
+  """The maximum number of idle connections to keep open.
+
+  @type: int
+  """
+
+  maxPrefetches = 8
+  """The maximum number of objects to prefetch at once.
+
+  @type: int
+  """
+
+  timeout = 30
+  """The socket timeout in seconds.
+
+  @type: float
+  """
+
+  def __init__(self, url):
+    """Construct an HTTP object cache.
+
+    @param url: The base URL of the cache, eg. 'http://cache:8734/'.
+    @type url: string
+    """
+    self.url = url
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == "https":
+      self._connectionClass = httplib.HTTPSConnection
+    else:
+      self._connectionClass = httplib.HTTPConnection
+    self._netloc = str(parts.netloc)
+    self._prefix = str(parts.path.rstrip("/"))
+    self._connections = []
+    self._prefetches = {}
+    self._lock = threading.Lock()
+
+  def _getConnection(self):
+    self._lock.acquire()
+    try:
+      if self._connections:
+        return self._connections.pop()
+    finally:
+      self._lock.release()
+    return self._connectionClass(self._netloc, timeout=self.timeout)
+
+  def _releaseConnection(self, connection):
+    self._lock.acquire()
+    try:
+      if len(self._connections) < self.maxConnections:
+        self._connections.append(connection)
+        return
+    finally:
+      self._lock.release()
+    connection.close()
+
+  def _request(self, method, path, body=None, responseFile=None):
+    """Make a request to the cache server.
+
+    @param body: The data or file object to send, if any.
+    @type body: string, file or None
+    @param responseFile: A file object to write the response to if the
+    request succeeds, rather than returning it.
+    @type responseFile: file or None
+
+    @return: A (status, data) tuple.
+
+    @raise EnvironmentError: If the request failed.
+    """
+    # httplib can't send binary bodies with unicode headers.
+    url = str(self._prefix + path)
+    headers = {}
+    if body is not None:
+      headers["Content-Type"] = "application/octet-stream"
+
+    # Retry once in case the server closed an idle pooled connection.
+    for attempt in (0, 1):
+      connection = self._getConnection()
+      if hasattr(body, "seek"):
+        body.seek(0)
+      if responseFile is not None:
+        responseFile.seek(0)
+        responseFile.truncate()
+      try:
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        if responseFile is not None and response.status == httplib.OK:
+          data = None
+          while True:
+            chunk = response.read(cake.zipping.CHUNK_SIZE)
+            if not chunk:
+              break
+            responseFile.write(chunk)
+        else:
+          data = response.read()
+      except (httplib.HTTPException, socket.error), e:
+        connection.close()
+        if attempt:
+          raise EnvironmentError("%s %s%s failed: %s" % (method, self._netloc, url, e))
+        continue
+      if response.will_close:
+        connection.close()
+      else:
+        self._releaseConnection(connection)
+      return response.status, data
+
+  def _getObject(self, objectDigestStr):
+    """Fetch a compressed object into a temporary file.
+    """
+    f = tempfile.TemporaryFile()
+    try:
+      status, _ = self._request("GET", "/object/" + objectDigestStr, responseFile=f)
+      if status != httplib.OK:
+        raise EnvironmentError(
+          errno.ENOENT,
+          "object %s not in cache (HTTP %i)" % (objectDigestStr, status),
+          )
+    except:
+      f.close()
+      raise
+    f.seek(0)
+    return f
+
+  def readIndex(self, targetDigestStr):
+    try:
+      status, data = self._request("GET", "/index/" + targetDigestStr)
+    except EnvironmentError:
+      return None
+    if status != httplib.OK:
+      return None
+    return parseIndex(data)
+
+  def writeIndex(self, targetDigestStr, entries):
+    try:
+      self._request("PUT", "/index/" + targetDigestStr, formatIndex(entries))
+    except (EnvironmentError, ValueError):
+      pass # The cache still works without the index.
+
+  def restoreObject(self, objectDigestStr, targetPath):
+    self._lock.acquire()
+    try:
+      prefetch = self._prefetches.pop(objectDigestStr, None)
+    finally:
+      self._lock.release()
+
+    f = None
+    if prefetch is not None:
+      prefetch.done.wait()
+      f = prefetch.file
+    if f is None:
+      f = self._getObject(objectDigestStr)
+    def write(p):
+      target = open(p, "wb")
+      try:
+        cake.zipping.decompressStream(f, target)
+      finally:
+        target.close()
+    try:
+      cake.filesys.makeDirs(os.path.dirname(targetPath))
+      # Replace the target rather than writing to it in case it's a link.
+      storeFileAtomic(targetPath, write)
+    finally:
+      f.close()
+
+  def storeObject(self, objectDigestStr, sourcePath, codec=None, link=False):
+    f = tempfile.TemporaryFile()
+    try:
+      source = open(sourcePath, "rb")
+      try:
+        size = cake.zipping.compressStream(source, f, codec)
+      finally:
+        source.close()
+      f.flush()
+      status, _ = self._request("PUT", "/object/" + objectDigestStr, f)
+    finally:
+      f.close()
+    if status not in (httplib.OK, httplib.CREATED, httplib.NO_CONTENT):
+      raise EnvironmentError(
+        "storing object %s failed (HTTP %i)" % (objectDigestStr, status)
+        )
+    return size
+
+  def prefetchObject(self, objectDigestStr):
+    self._lock.acquire()
+    try:
+      if objectDigestStr in self._prefetches:
+        return
+      if len(self._prefetches) >= self.maxPrefetches:
+        return
+      prefetch = self._prefetches[objectDigestStr] = _Prefetch()
+    finally:
+      self._lock.release()
+
+    def run():
+      try:
+        try:
+          f = self._getObject(objectDigestStr)
+        except EnvironmentError:
+          pass # Report the error if the object is restored.
+        else:
+          self._lock.acquire()
+          try:
+            prefetch.file = f
+            discarded = prefetch.discarded
+          finally:
+            self._lock.release()
+          if discarded:
+            f.close()
+      finally:
+        prefetch.done.set()
+
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+
+  def discardPrefetched(self, objectDigestStr):
+    self._lock.acquire()
+    try:
+      prefetch = self._prefetches.pop(objectDigestStr, None)
+      if prefetch is None:
+        return
+      # If still fetching, the fetch closes the file when it's done.
+      prefetch.discarded = True
+      f = prefetch.file
+    finally:
+      self._lock.release()
+    if f is not None:
+      f.close()
+
+_caches = {}
+_cachesLock = threading.Lock()
+
+def getObjectCache(path):
+  """Get the backend for an object cache.
+
+  The same backend is returned for the same path so that connections can
+  be shared.
+
+  @param path: The absolute path of a cache directory, or the URL of an
+  HTTP cache.
+  @type path: string
+
+  @rtype: L{ObjectCache}
+  """
+  cache = _caches.get(path, None)
+  if cache is None:
+    _cachesLock.acquire()
+    try:
+      cache = _caches.get(path, None)
+      if cache is None:
+        if isUrl(path):
+          cache = HttpObjectCache(path)
+        else:
+          cache = FileObjectCache(path)
+        _caches[path] = cache
+    finally:
+      _cachesLock.release()
+  return cache
+
+class CacheWriter(object):
+  """Stores objects in object caches in background threads.
+
+  Writes are queued so that a build doesn't wait for objects to be
+  compressed and stored before the tasks that depend on them can start.
+  Only the functions that do the writes are queued, not the data, and
+  the number queued is limited, so memory use is bounded.
+  """
+
+  threadCount = 2
+  """The number of threads that write to caches.
+
+  @type: int
+  """
+
+  def __init__(self):
+    self._queue = collections.deque()
+    self._pendingCount = 0
+    self._threadCount = 0
+    self._condition = threading.Condition()
+
+  def put(self, write, maxQueued):
+    """Queue a write to run in the background.
+
+    @param write: A function that does the write. Errors should be
+    handled by the function.
+    @type write: function
+    @param maxQueued: The maximum number of writes that can be waiting to
+    run, including this one.
+    @type maxQueued: int
+
+    @return: True if the write was queued, False if too many writes are
+    already waiting, in which case the caller should do the write itself.
+    @rtype: bool
+    """
+    self._condition.acquire()
+    try:
+      if len(self._queue) >= maxQueued:
+        return False
+      self._queue.append(write)
+      self._pendingCount += 1
+      if self._threadCount < self.threadCount:
+        self._threadCount += 1
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+      self._condition.notifyAll()
+    finally:
+      self._condition.release()
+    return True
+
+  def flush(self):
+    """Wait until all queued writes have finished.
+    """
+    self._condition.acquire()
+    try:
+      while self._pendingCount:
+        self._condition.wait()
+    finally:
+      self._condition.release()
+
+  def _run(self):
+    while True:
+      self._condition.acquire()
+      try:
+        while not self._queue:
+          self._condition.wait()
+        write = self._queue.popleft()
+      finally:
+        self._condition.release()
+      try:
+        write()
+      except Exception:
+        # The write should have handled its errors, but make sure the
+        # thread keeps running and a flush doesn't hang.
+        traceback.print_exc(file=sys.stderr)
+      self._condition.acquire()
+      try:
+        self._pendingCount -= 1
+        self._condition.notifyAll()
+      finally:
+        self._condition.release()
+
+_cacheWriter = CacheWriter()
+
+def getCacheWriter():
+  """Get the writer that stores objects in the background.
+
+  @rtype: L{CacheWriter}
+  """
+  return _cacheWriter
+
+class CacheStatistics(object):
+  """Counts how effective the object cache was during a build.
+
+  @ivar lookups: The number of targets looked up in the cache.
+  @type lookups: int
+  @ivar hits: The number of lookups whose targets were restored.
+  @type hits: int
+  @ivar misses: The number of lookups that failed, keyed by reason.
+  @type misses: dict of string to int
+  @ivar uncacheable: The number of targets that couldn't be cached while
+  the cache was enabled, keyed by tool name.
+  @type uncacheable: dict of string to int
+  @ivar restoredBytes: The total size of the targets restored.
+  @type restoredBytes: int
+  @ivar storedCount: The number of targets stored.
+  @type storedCount: int
+  @ivar storedBytes: The number of bytes added to the cache.
+  @type storedBytes: int
+  @ivar hashedCount: The number of files whose digests were calculated.
+  @type hashedCount: int
+  @ivar hashedBytes: The total size of the files hashed.
+  @type hashedBytes: int
+  @ivar hashSeconds: The time spent calculating file digests.
+  @type hashSeconds: float
+  """
+
+  NO_ENTRY = "no entry"
+  """Miss reason when the target has never been stored.
+  """
+
+  DIGEST_MISMATCH = "digest mismatch"
+  """Miss reason when no stored dependencies match the current ones.
+  """
+
+  MISSING_OBJECT = "missing object"
+  """Miss reason when the matching object was removed from the cache.
+  """
+
+  CORRUPT_ENTRY = "corrupt entry"
+  """Miss reason when the matching object couldn't be read.
+  """
+
+  _fields = [
+    "lookups",
+    "hits",
+    "restoredBytes",
+    "storedCount",
+    "storedBytes",
+    "hashedCount",
+    "hashedBytes",
+    "hashSeconds",
+    ]
+
+  def __init__(self):
+    self.lookups = 0
+    self.hits = 0
+    self.misses = {}
+    self.uncacheable = {}
+    self.restoredBytes = 0
+    self.storedCount = 0
+    self.storedBytes = 0
+    self.hashedCount = 0
+    self.hashedBytes = 0
+    self.hashSeconds = 0.0
+    self._lock = threading.Lock()
+
+  def recordHit(self, restoredBytes):
+    """Record a lookup whose targets were restored.
+    """
+    self._lock.acquire()
+    try:
+      self.lookups += 1
+      self.hits += 1
+      self.restoredBytes += restoredBytes
+    finally:
+      self._lock.release()
+
+  def recordMiss(self, reason):
+    """Record a lookup that failed.
+
+    @param reason: Why the lookup failed, eg. L{NO_ENTRY}.
+    @type reason: string
+    """
+    self._lock.acquire()
+    try:
+      self.lookups += 1
+      self.misses[reason] = self.misses.get(reason, 0) + 1
+    finally:
+      self._lock.release()
+
+  def recordUncacheable(self, name):
+    """Record a target that couldn't be cached.
+
+    @param name: The name of the tool that built the target.
+    @type name: string
+    """
+    self._lock.acquire()
+    try:
+      self.uncacheable[name] = self.uncacheable.get(name, 0) + 1
+    finally:
+      self._lock.release()
+
+  def recordStore(self, storedBytes):
+    """Record a target being stored.
+    """
+    self._lock.acquire()
+    try:
+      self.storedCount += 1
+      self.storedBytes += storedBytes
+    finally:
+      self._lock.release()
+
+  def recordHash(self, hashedBytes, seconds):
+    """Record the calculation of a file's digest.
+    """
+    self._lock.acquire()
+    try:
+      self.hashedCount += 1
+      self.hashedBytes += hashedBytes
+      self.hashSeconds += seconds
+    finally:
+      self._lock.release()
+
+  @property
+  def used(self):
+    """Whether the cache was used, or would have been if targets could
+    be cached.
+
+    @rtype: bool
+    """
+    return bool(self.lookups or self.storedCount or self.uncacheable)
+
+  def asDict(self):
+    """Get the statistics as a dictionary that can be written as JSON.
+
+    @rtype: dict
+    """
+    self._lock.acquire()
+    try:
+      result = dict((name, getattr(self, name)) for name in self._fields)
+      result["misses"] = dict(self.misses)
+      result["uncacheable"] = dict(self.uncacheable)
+    finally:
+      self._lock.release()
+    return result
+
+  def merge(self, other):
+    """Add the statistics from another build, eg. another process.
+
+    @param other: The other build's statistics, as returned by L{asDict}.
+    @type other: dict
+    """
+    self._lock.acquire()
+    try:
+      for name in self._fields:
+        setattr(self, name, getattr(self, name) + other.get(name, 0))
+      for counts, otherCounts in (
+        (self.misses, other.get("misses", {})),
+        (self.uncacheable, other.get("uncacheable", {})),
+        ):
+        for key, count in otherCounts.items():
+          counts[key] = counts.get(key, 0) + count
+    finally:
+      self._lock.release()
+
+  def read(self, path):
+    """Merge the statistics from a report written by L{write}.
+
+    @raise EnvironmentError: If the report couldn't be read.
+    """
+    try:
+      other = json.loads(cake.filesys.readFile(path))
+    except ValueError, e:
+      raise EnvironmentError(str(e))
+    self.merge(other)
+
+  def write(self, path):
+    """Write the statistics to a JSON file.
+    """
+    data = json.dumps(self.asDict(), indent=1, sort_keys=True)
+    cake.filesys.writeFile(path, data + "\n")
+
+  def format(self):
+    """Format the statistics as a summary for the end of a build.
+
+    @rtype: string
+    """
+    s = self.asDict()
+    lines = []
+    missCount = sum(s["misses"].values())
+    if s["lookups"]:
+      line = "Object cache: %i lookups, %i hits (%i%%), %i misses" % (
+        s["lookups"],
+        s["hits"],
+        100 * s["hits"] // s["lookups"],
+        missCount,
+        )
+      if missCount:
+        line += " (%s)" % ", ".join(
+          "%i %s" % (count, reason)
+          for reason, count in sorted(s["misses"].items())
+          )
+      lines.append(line + ".\n")
+    lines.append(
+      "Object cache: restored %s, stored %s in %i targets, hashed %s in %i files in %.2fs.\n" % (
+        _formatSize(s["restoredBytes"]),
+        _formatSize(s["storedBytes"]),
+        s["storedCount"],
+        _formatSize(s["hashedBytes"]),
+        s["hashedCount"],
+        s["hashSeconds"],
+        ))
+    for name, count in sorted(s["uncacheable"].items()):
+      lines.append("Object cache: %i targets could not be cached by %s.\n" % (count, name))
+    return "".join(lines)
+
+def _formatSize(size):
+  for unit in ("bytes", "KB", "MB"):
+    if size < 1024:
+      if unit == "bytes":
+        return "%i %s" % (size, unit)
+      return "%.1f %s" % (size, unit)
+    size /= 1024.0
+  return "%.1f GB" % size
@@ -7,6 +7,7 @@
 
 import os
 import os.path
+import subprocess
 import sys
 import threading
 import datetime
@@ -14,17 +15,23 @@ import time
 import traceback
 import platform
 
+import cake.daemon
 import cake.engine
+import cake.filesys
 import cake.logging
+import cake.objectcache
 import cake.path
 import cake.script
+import cake.slots
+import cake.system
 import cake.task
 import cake.threadpool
+import cake.trace
 import cake.version
 
 from cake.async import flatten
 
-from cake.optparse import Option, OptionParser
+from cake.optparse import Option, OptionParser, SUPPRESS_HELP
 
 # Make sure stat() returns floats so timestamps are consistent across
 # Python versions (2.4 used longs, 2.5+ uses floats).
@@ -193,7 +200,7 @@ def _speedUp():
         "warning: Psyco is not installed. Installing it may halve your incremental build time.\n"
         )
 
-def run(args=None, cwd=None):
+def run(args=None, cwd=None, cacheEngine=None):
   """Run a cake build with the specified command-line args.
   
   @param args: A list of command-line args for cake. If this is None 
@@ -202,6 +209,11 @@ def run(args=None, cwd=None):
   @param cwd: The working directory to use. If this is None os.getcwd()
   is used instead.
   @type cwd: string or None
+  @param cacheEngine: If not None, an engine whose in-memory caches
+  should be shared with this build's engine so that they are kept for
+  future builds. The build's worker threads are shut down once the build
+  has finished.
+  @type cacheEngine: L{cake.engine.Engine} or None
   
   @return: The exit code of cake. Non-zero if exited with errors, zero
   if exited with success.
@@ -216,12 +228,18 @@ def run(args=None, cwd=None):
   
   if args is None:
     args = sys.argv[1:]
+  originalArgs = list(args)
 
   if cwd is not None:
     cwd = os.path.abspath(cwd)
   else:
     cwd = os.getcwd()
   
+  # Hand the build over to a build daemon, or become one.
+  for arg in args:
+    if arg in ("--daemon", "--use-daemon", "--stop-daemon"):
+      return cake.daemon.main(args, cwd)
+  
   usage = "usage: %prog [options] <cake-script>*"
   argsCakeFlag = "--args"
   
@@ -256,7 +274,7 @@ def run(args=None, cwd=None):
     "--debug", metavar="KEYWORDS",
     action="extend",
     dest="debugComponents",
-    help="Set features to debug, eg: 'reason,run,script,scan,time'.",
+    help="Set features to debug, eg: 'cache,reason,run,script,scan,time'.",
     default=[],
     )
   parser.add_option(
@@ -281,6 +299,68 @@ def run(args=None, cwd=None):
     help="Number of simultaneous jobs to execute.",
     default=cake.threadpool.getProcessorCount(),
     )
+  parser.add_option(
+    "--threads",
+    metavar="COUNT",
+    type="int",
+    dest="threads",
+    help="Number of threads to run tasks with (default: JOBCOUNT).",
+    default=None,
+    )
+  parser.add_option(
+    "--compile-jobs",
+    metavar="COUNT",
+    type="int",
+    dest="compileJobs",
+    help="Maximum number of compilers to run at once.",
+    default=None,
+    )
+  parser.add_option(
+    "--link-jobs",
+    metavar="COUNT",
+    type="int",
+    dest="linkJobs",
+    help="Maximum number of librarians and linkers to run at once.",
+    default=None,
+    )
+  parser.add_option(
+    "--shell-jobs",
+    metavar="COUNT",
+    type="int",
+    dest="shellJobs",
+    help="Maximum number of shell commands to run at once.",
+    default=None,
+    )
+  parser.add_option(
+    "--max-load",
+    metavar="LOAD",
+    type="float",
+    dest="maxLoad",
+    help="Don't start processes while the load average is at least LOAD.",
+    default=None,
+    )
+  parser.add_option(
+    "--min-free-memory",
+    metavar="MB",
+    type="int",
+    dest="minFreeMemory",
+    help="Don't start processes while less than MB megabytes of memory are free.",
+    default=None,
+    )
+  parser.add_option(
+    "--jobserver",
+    dest="jobServer",
+    action="store_true",
+    help="Share JOBCOUNT job slots with make processes run by shell commands.",
+    default=False,
+    )
+  parser.add_option(
+    "--no-jobserver",
+    dest="useJobServer",
+    action="store_false",
+    help="Don't take job slots from the jobserver of the make running Cake.",
+    default=True,
+    )
   parser.add_option(
     "-k", "--keep-going",
     dest="maximumErrorCount",
@@ -296,6 +376,94 @@ def run(args=None, cwd=None):
     help="Halt the build after a certain number of errors.",
     default=100,
     )
+  parser.add_option(
+    "--work-stealing",
+    dest="workStealing",
+    action="store_true",
+    help="Use a work-stealing thread pool that runs higher priority jobs first.",
+    default=False,
+    )
+  parser.add_option(
+    "--critical-path",
+    dest="criticalPathScheduling",
+    action="store_true",
+    help="Build targets on the critical path of previous builds first (implies --work-stealing).",
+    default=False,
+    )
+  parser.add_option(
+    "--variant-processes",
+    metavar="COUNT",
+    type="int",
+    dest="variantProcesses",
+    help="Build each variant in a separate process, running up to COUNT at once.",
+    default=1,
+    )
+  parser.add_option(
+    "--dependency-journal",
+    metavar="FILE",
+    dest="dependencyJournalPath",
+    help=SUPPRESS_HELP,
+    default=None,
+    )
+  parser.add_option(
+    "--cache-gc",
+    dest="collectCacheGarbage",
+    action="store_true",
+    help="Remove the least recently used objects from the object caches instead of building.",
+    default=False,
+    )
+  parser.add_option(
+    "--trace",
+    metavar="FILE",
+    dest="tracePath",
+    help="Write a timeline of the build to FILE in Chrome Trace Event format.",
+    default=None,
+    )
+  parser.add_option(
+    "--cache-report",
+    metavar="FILE",
+    dest="cacheReportPath",
+    help="Write object cache statistics for the build to FILE as JSON.",
+    default=None,
+    )
+  parser.add_option(
+    "--stat-first",
+    dest="statKnownDependenciesFirst",
+    action="store_true",
+    help="Stat all files known from previous builds in parallel before building.",
+    default=False,
+    )
+  parser.add_option(
+    "--scan-directories",
+    dest="scanDirectories",
+    action="store_true",
+    help="List whole directories when checking for changed files.",
+    default=False,
+    )
+  parser.add_option(
+    "--daemon",
+    action="store_true",
+    help=(
+      "Run a build daemon that keeps caches in memory between builds. On "
+      "Windows, output of shell commands that isn't captured is shown by "
+      "the daemon rather than the client."
+      ),
+    )
+  parser.add_option(
+    "--use-daemon",
+    action="store_true",
+    help="Run the build using the build daemon for this tree.",
+    )
+  parser.add_option(
+    "--stop-daemon",
+    action="store_true",
+    help="Stop the build daemon for this tree.",
+    )
+  parser.add_option(
+    "--daemon-socket",
+    metavar="FILE",
+    help="Path to the build daemon's socket file.",
+    )
   parser.add_option(
     "-l", "--list-targets",
     dest="listTargetsMode",
@@ -341,6 +509,8 @@ def run(args=None, cwd=None):
 
   logger = cake.logging.Logger()
   engine = cake.engine.Engine(logger, parser, args)
+  if cacheEngine is not None:
+    engine.adoptCaches(cacheEngine)
 
   # Try to find an args.cake command line option.
   for arg in engine.args:
@@ -409,9 +579,52 @@ def run(args=None, cwd=None):
   engine.options = options
   engine.forceBuild = options.forceBuild
   engine.maximumErrorCount = options.maximumErrorCount
+  if options.statKnownDependenciesFirst:
+    engine.statKnownDependenciesFirst = True
+  if options.scanDirectories:
+    engine.scanDirectories = True
+  if options.dependencyJournalPath is not None:
+    engine.dependencyJournalPath = options.dependencyJournalPath
     
-  threadPool = cake.threadpool.ThreadPool(options.jobs)
+  if options.criticalPathScheduling:
+    engine.criticalPathScheduling = True
+  threadCount = options.threads
+  if threadCount is None:
+    threadCount = options.jobs
+  if options.workStealing or engine.criticalPathScheduling:
+    threadPool = cake.threadpool.WorkStealingThreadPool(threadCount)
+  else:
+    threadPool = cake.threadpool.ThreadPool(threadCount)
   cake.task.setThreadPool(threadPool)
+  engine.processSlots = _createProcessSlots(engine, options)
+
+  if options.tracePath is not None:
+    tracer = cake.trace.Tracer()
+    cake.trace.setTracer(tracer)
+  else:
+    tracer = None
+
+  def writeTrace():
+    if tracer is not None:
+      cake.trace.setTracer(None)
+      try:
+        tracer.write(options.tracePath)
+      except EnvironmentError, e:
+        engine.logger.outputWarning(
+          "cake: Error writing trace %s: %s\n" % (options.tracePath, e)
+          )
+
+  def writeCacheReport(outputSummary=True):
+    statistics = engine.cacheStatistics
+    if outputSummary and statistics.used:
+      engine.logger.outputInfo(statistics.format())
+    if options.cacheReportPath is not None:
+      try:
+        statistics.write(options.cacheReportPath)
+      except EnvironmentError, e:
+        engine.logger.outputWarning(
+          "cake: Error writing cache report %s: %s\n" % (options.cacheReportPath, e)
+          )
  
   tasks = []
   
@@ -447,6 +660,52 @@ def run(args=None, cwd=None):
 
     logger.outputInfo(message)
 
+  if options.collectCacheGarbage:
+    errorCount = _collectObjectCacheGarbage(
+      engine,
+      scriptTargets,
+      configScript,
+      keywords,
+      )
+    engine.processSlots.close()
+    writeTrace()
+    endTime = datetime.datetime.utcnow()
+    engine.logger.outputInfo(
+      "Cache garbage collection took %s.\n" % _formatTimeDelta(endTime - startTime)
+      )
+    return errorCount
+
+  if options.variantProcesses > 1 and not options.listTargetsMode:
+    try:
+      errorCount = _runVariantProcesses(
+        engine,
+        originalArgs,
+        cwd,
+        scriptTargets,
+        configScript,
+        keywords,
+        options.variantProcesses,
+        options.jobs,
+        tracer,
+        )
+    except Exception:
+      errorCount = None # Report any errors by building normally.
+    if errorCount is not None:
+      if errorCount:
+        engine.logger.outputInfo("Build failed with %i errors.\n" % errorCount)
+      else:
+        engine.logger.outputInfo("Build succeeded.\n")
+      engine.flushCaches()
+      engine.processSlots.close()
+      writeTrace()
+      # Each process has output its own summary.
+      writeCacheReport(outputSummary=False)
+      endTime = datetime.datetime.utcnow()
+      engine.logger.outputInfo(
+        "Build took %s.\n" % _formatTimeDelta(endTime - startTime)
+        )
+      return errorCount
+
   for scriptPath, targetNames in scriptTargets:
     scriptPath = cake.path.fileSystemPath(scriptPath)
     try:
@@ -511,6 +770,9 @@ def run(args=None, cwd=None):
 
     engine.logger.outputInfo(msg)
   
+  if engine.statKnownDependenciesFirst and not bootFailed:
+    engine.statKnownDependencies(threadPool)
+
   mainTask = cake.task.Task()
   mainTask.addCallback(onFinish)
   mainTask.startAfter(tasks)
@@ -521,6 +783,15 @@ def run(args=None, cwd=None):
   while not finished.isSet():
     time.sleep(0.1)
   
+  engine.flushCaches()
+  engine.processSlots.close()
+  writeTrace()
+  writeCacheReport()
+  if cacheEngine is not None:
+    cacheEngine.adoptCaches(engine)
+    threadPool.shutdown()
+    engine.scriptThreadPool.shutdown()
+  
   endTime = datetime.datetime.utcnow()
   engine.logger.outputInfo(
     "Build took %s.\n" % _formatTimeDelta(endTime - startTime)
@@ -528,6 +799,292 @@ def run(args=None, cwd=None):
   
   return engine.errorCount
 
+def _runVariantProcesses(
+  engine,
+  args,
+  cwd,
+  scriptTargets,
+  configScript,
+  keywords,
+  processCount,
+  jobs,
+  tracer,
+  ):
+  """Build each variant in a separate Cake process.
+  
+  Script execution and dependency checking are done by a single thread in
+  each process, so building variants in separate processes lets them run
+  on separate cores. Each process writes its dependency info to its own
+  journal which is merged into the dependency database afterwards.
+  
+  If tracing, each process writes its own trace which is merged into
+  the tracer afterwards. Cache reports are merged in the same way.
+  
+  @return: The total error count of the processes or None if the build
+  can't be split by variant.
+  @rtype: int or None
+  """
+  configurations = set()
+  for scriptPath, _ in scriptTargets:
+    if configScript is None:
+      scriptPath = cake.path.fileSystemPath(scriptPath)
+      configurations.add(engine.findConfiguration(scriptPath))
+    else:
+      configurations.add(engine.getConfiguration(configScript))
+  if len(configurations) != 1:
+    return None
+  configuration = configurations.pop()
+  
+  variants = list(configuration.findAllVariants(keywords))
+  if len(variants) < 2:
+    return None
+  
+  # Each process is given keywords that select exactly one variant.
+  variantArgs = []
+  for variant in variants:
+    variantKeywords = {}
+    for key, value in variant.keywords.iteritems():
+      if not isinstance(value, basestring) or "," in value or "=" in key:
+        return None # Can't be passed on the command line.
+      variantKeywords[key] = [value]
+    if list(configuration.findAllVariants(variantKeywords)) != [variant]:
+      return None
+    variantArgs.append(["%s=%s" % (k, v[0]) for k, v in variantKeywords.items()])
+  
+  baseArgs = []
+  skipNext = False
+  for arg in args:
+    if skipNext:
+      skipNext = False
+    elif arg == "--variant-processes":
+      skipNext = True
+    elif arg.startswith("--variant-processes="):
+      pass
+    elif arg == "--trace":
+      skipNext = True
+    elif arg.startswith("--trace="):
+      pass # Each process writes its own trace.
+    elif arg == "--cache-report":
+      skipNext = True
+    elif arg.startswith("--cache-report="):
+      pass # Each process writes its own report.
+    elif arg == "--jobserver":
+      pass # Each process uses our jobserver.
+    elif not arg.startswith("-") and "=" in arg:
+      pass # Replaced by the variant's keywords.
+    else:
+      baseArgs.append(arg)
+  baseArgs.append("--jobs=%i" % max(1, jobs // min(processCount, len(variants))))
+  
+  journalPaths = []
+  if engine.dependencyDatabasePath is not None:
+    for index in xrange(len(variants)):
+      journalPaths.append("%s.%i.journal" % (engine.dependencyDatabasePath, index))
+
+  tracePaths = []
+  if tracer is not None:
+    for index in xrange(len(variants)):
+      tracePaths.append("%s.%i.trace" % (engine.options.tracePath, index))
+
+  reportPaths = []
+  if engine.options.cacheReportPath is not None:
+    for index in xrange(len(variants)):
+      reportPaths.append("%s.%i.report" % (engine.options.cacheReportPath, index))
+  
+  environment = dict(os.environ)
+  cakeRoot = os.path.dirname(os.path.dirname(os.path.abspath(cake.__file__)))
+  pythonPath = environment.get("PYTHONPATH", None)
+  if pythonPath:
+    environment["PYTHONPATH"] = cakeRoot + os.pathsep + pythonPath
+  else:
+    environment["PYTHONPATH"] = cakeRoot
+  environment = engine.processSlots.getEnvironment(environment)
+  
+  logger = engine.logger
+  processSemaphore = threading.Semaphore(processCount)
+  errorCounts = [0] * len(variants)
+  
+  def forward(pipe, output):
+    for line in iter(pipe.readline, ""):
+      output(line)
+    pipe.close()
+  
+  def runVariant(index):
+    processArgs = [sys.executable, "-m", "cake.main"] + baseArgs + variantArgs[index]
+    if journalPaths:
+      processArgs.append("--dependency-journal=" + journalPaths[index])
+    if tracePaths:
+      processArgs.append("--trace=" + tracePaths[index])
+    if reportPaths:
+      processArgs.append("--cache-report=" + reportPaths[index])
+    processSemaphore.acquire()
+    try:
+      try:
+        p = subprocess.Popen(
+          args=processArgs,
+          cwd=cwd,
+          env=environment,
+          stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE,
+          )
+      except EnvironmentError, e:
+        logger.outputError("cake: failed to launch %s: %s\n" % (processArgs[0], str(e)))
+        errorCounts[index] = 1
+        return
+      stderrThread = threading.Thread(
+        target=forward,
+        args=(p.stderr, logger.outputError),
+        )
+      stderrThread.start()
+      forward(p.stdout, logger.outputInfo)
+      stderrThread.join()
+      exitCode = p.wait()
+      if exitCode < 0:
+        exitCode = 1 # Killed by a signal.
+      errorCounts[index] = exitCode
+    finally:
+      processSemaphore.release()
+  
+  threads = []
+  for index in xrange(len(variants)):
+    thread = threading.Thread(target=runVariant, args=(index,))
+    thread.start()
+    threads.append(thread)
+  # Join with a timeout so that a KeyboardInterrupt can be handled.
+  for thread in threads:
+    while thread.isAlive():
+      thread.join(0.1)
+  
+  for journalPath in journalPaths:
+    if cake.filesys.isFile(journalPath):
+      try:
+        engine.mergeDependencyJournal(journalPath)
+      except (EnvironmentError, cake.engine.BuildError), e:
+        logger.outputWarning(
+          "cake: Error merging dependency journal %s: %s\n" % (journalPath, e)
+          )
+  
+  for tracePath in tracePaths:
+    if cake.filesys.isFile(tracePath):
+      try:
+        tracer.merge(tracePath)
+        cake.filesys.remove(tracePath)
+      except (EnvironmentError, ValueError), e:
+        logger.outputWarning(
+          "cake: Error merging trace %s: %s\n" % (tracePath, e)
+          )
+
+  for reportPath in reportPaths:
+    if cake.filesys.isFile(reportPath):
+      try:
+        engine.cacheStatistics.read(reportPath)
+        cake.filesys.remove(reportPath)
+      except EnvironmentError, e:
+        logger.outputWarning(
+          "cake: Error merging cache report %s: %s\n" % (reportPath, e)
+          )
+  
+  return sum(errorCounts)
+
+def _createProcessSlots(engine, options):
+  """Create the process slots requested by the command line options.
+  
+  The number of processes is limited to the job count, even if more
+  threads are used to run tasks.
+  
+  @rtype: L{cake.slots.ProcessSlots}
+  """
+  limits = {}
+  for kind, limit in [
+    (cake.slots.COMPILE, options.compileJobs),
+    (cake.slots.LINK, options.linkJobs),
+    (cake.slots.SHELL, options.shellJobs),
+    ]:
+    if limit is not None:
+      limits[kind] = max(1, limit)
+  
+  jobServer = None
+  if options.jobServer:
+    if cake.system.isWindows():
+      engine.logger.outputWarning("cake: --jobserver is not supported on Windows.\n")
+    else:
+      try:
+        jobServer = cake.slots.JobServer(options.jobs)
+      except EnvironmentError, e:
+        engine.logger.outputWarning("cake: Error starting jobserver: %s\n" % e)
+  elif options.useJobServer:
+    jobServer = cake.slots.JobServerClient.fromEnvironment()
+  
+  if options.minFreeMemory is not None:
+    minFreeMemory = options.minFreeMemory * 1024 * 1024
+  else:
+    minFreeMemory = None
+  
+  return cake.slots.ProcessSlots(
+    maxProcesses=max(1, options.jobs),
+    limits=limits,
+    maxLoad=options.maxLoad,
+    minFreeMemory=minFreeMemory,
+    jobServer=jobServer,
+    )
+
+def _collectObjectCacheGarbage(engine, scriptTargets, configScript, keywords):
+  """Remove old objects from the object caches of the selected variants.
+  
+  Each cache is reduced to the smallest objectCacheMaxSize of the
+  compilers that use it. Caches without a maximum size only have their
+  orphaned dependency entries removed. HTTP caches are skipped as their
+  server manages their size.
+  
+  @return: The number of errors.
+  @rtype: int
+  """
+  from cake.library.compilers import Compiler
+  
+  logger = engine.logger
+  caches = {}
+  errorCount = 0
+  for scriptPath, _ in scriptTargets:
+    scriptPath = cake.path.fileSystemPath(scriptPath)
+    try:
+      if configScript is None:
+        configuration = engine.findConfiguration(scriptPath)
+      else:
+        configuration = engine.getConfiguration(configScript)
+      for variant in configuration.findAllVariants(keywords):
+        for tool in variant.tools.values():
+          if isinstance(tool, Compiler) and tool.objectCachePath is not None:
+            path = tool.objectCachePath
+            if not cake.objectcache.isUrl(path):
+              path = configuration.abspath(path)
+            maxSize = tool.objectCacheMaxSize
+            if path in caches and caches[path] is not None:
+              if maxSize is None or caches[path] < maxSize:
+                maxSize = caches[path]
+            caches[path] = maxSize
+    except cake.engine.BuildError:
+      errorCount += 1 # Error already output
+  
+  if not caches and not errorCount:
+    logger.outputInfo("No object caches to collect.\n")
+  
+  for path in sorted(caches.keys()):
+    if cake.objectcache.isUrl(path):
+      logger.outputInfo("Skipping %s, its server manages its size.\n" % path)
+      continue
+    try:
+      removedCount, removedSize, size = cake.objectcache.collectGarbage(path, caches[path])
+    except EnvironmentError, e:
+      logger.outputError("cake: Error collecting %s: %s\n" % (path, e))
+      errorCount += 1
+      continue
+    logger.outputInfo(
+      "Removed %i objects (%i bytes) from %s, %i bytes remain.\n" % (
+        removedCount, removedSize, path, size)
+      )
+  
+  return errorCount
+
 def _formatTimeDelta(t):
   """Return a string representation of the time to millisecond precision."""
   
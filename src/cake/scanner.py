@@ -0,0 +1,169 @@
+"""Include Scanner.
+
+Finds the files a C or C++ source file includes without running the
+compiler, so that they can be used to find the source's object in the
+object cache before it is compiled.
+
+The scanner follows every #include directive it finds, ignoring any
+#if conditions, so it may find more files than the compiler would
+include. Directives that name a macro rather than a file can't be
+followed and are ignored.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import os
+import os.path
+import re
+
+import cake.filesys
+
+_includeExpression = re.compile(
+  r'^[ \t]*#[ \t]*(?:include|include_next|import)[ \t]*(?:"([^"\r\n]+)"|<([^>\r\n]+)>)',
+  re.MULTILINE,
+  )
+"""Matches an #include directive, with the file name in group 1 if it
+is in quotes or in group 2 if it is in angle brackets.
+"""
+
+class IncludeScanner(object):
+  """Finds the files included by source files.
+
+  The includes found in each file and the listing of each directory
+  searched are cached, so a header shared by many sources is only read
+  once. Files that change after being scanned must be reported through
+  L{invalidate}.
+  """
+
+  def __init__(self):
+    self._includes = {}
+    self._listings = {}
+
+  def invalidate(self, path):
+    """Forget anything cached about a file that has changed.
+
+    @param path: The absolute path of the file.
+    @type path: string
+    """
+    normcase = os.path.normcase
+    self._includes.pop(path, None)
+    self._listings.pop(normcase(os.path.dirname(path)), None)
+    self._listings.pop(normcase(path), None)
+
+  def scan(self, source, includePaths, forcedIncludes=()):
+    """Find the files included by a source file.
+
+    Files in quotes are searched for in the directory of the file that
+    includes them and then in the include paths. Files in angle brackets
+    are only searched for in the include paths, so those found in the
+    compiler's own system directories are reported as unresolved.
+
+    @param source: The absolute path of the source file.
+    @type source: string
+    @param includePaths: The absolute paths of the directories to search
+    for included files, in search order.
+    @type includePaths: list of string
+    @param forcedIncludes: The absolute paths of files that are included
+    before the source file.
+    @type forcedIncludes: list of string
+
+    @return: A (paths, unresolved) tuple where paths are the absolute
+    paths of the files found, including the source and forced includes,
+    and unresolved are the names of included files that couldn't be
+    found, in quotes or angle brackets as they were written.
+    @rtype: tuple of (list of string, set of string)
+
+    @raise EnvironmentError: If the source file couldn't be read.
+    """
+    includePaths = list(includePaths)
+    paths = []
+    unresolved = set()
+    visited = set()
+    pending = [source]
+    pending.extend(reversed(list(forcedIncludes)))
+
+    findFile = self._findFile
+    while pending:
+      path = pending.pop()
+      if path in visited:
+        continue
+      visited.add(path)
+      paths.append(path)
+
+      try:
+        includes = self._getIncludes(path)
+      except EnvironmentError:
+        if path == source:
+          raise
+        # Eg. a directory with the same name as an included file.
+        continue
+
+      dirPath = os.path.dirname(path)
+      for quoted, angled in reversed(includes):
+        if quoted:
+          found = findFile(quoted, [dirPath], includePaths)
+        else:
+          found = findFile(angled, includePaths)
+        if found is None:
+          if quoted:
+            unresolved.add('"' + quoted + '"')
+          else:
+            unresolved.add('<' + angled + '>')
+        elif found not in visited:
+          pending.append(found)
+
+    return paths, unresolved
+
+  def _getIncludes(self, path):
+    """Get the file names of the #include directives in a file.
+
+    @return: A list of (quoted, angled) tuples, one of which is empty.
+    @rtype: list of tuple
+    """
+    includes = self._includes.get(path, None)
+    if includes is None:
+      text = cake.filesys.readFile(path)
+      if '#' not in text:
+        includes = []
+      else:
+        includes = [
+          (q.decode("utf8", "replace"), a.decode("utf8", "replace"))
+          for q, a in _includeExpression.findall(text)
+          ]
+      self._includes[path] = includes
+    return includes
+
+  def _findFile(self, name, *searchPaths):
+    """Find an included file in the first directory that contains it.
+
+    @return: The absolute path of the file or None if it wasn't found.
+    @rtype: string or None
+    """
+    isListed = self._isListed
+    normpath = os.path.normpath
+    join = os.path.join
+    for dirPaths in searchPaths:
+      for dirPath in dirPaths:
+        path = normpath(join(dirPath, name))
+        if isListed(path):
+          return path
+    return None
+
+  def _isListed(self, path):
+    """Check whether a path exists, using a cached listing of its
+    directory.
+    """
+    normcase = os.path.normcase
+    dirPath, name = os.path.split(path)
+    key = normcase(dirPath)
+    try:
+      names = self._listings[key]
+    except KeyError:
+      try:
+        names = set(normcase(n) for n in os.listdir(dirPath))
+      except EnvironmentError:
+        names = None
+      self._listings[key] = names
+    return names is not None and normcase(name) in names
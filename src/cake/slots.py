@@ -0,0 +1,490 @@
+"""Process Slots.
+
+Limits the number of processes that tools run at once. Limits can be set
+for all processes and for each kind of process, starting processes can
+be held back while the system is busy, and slots can be shared with GNU
+make processes through a make jobserver.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import errno
+import os
+import select
+import stat
+import threading
+import time
+
+import cake.system
+
+if not cake.system.isWindows():
+  import fcntl
+
+COMPILE = "compile"
+"""The kind of slot used to compile sources.
+"""
+LINK = "link"
+"""The kind of slot used to archive and link objects.
+"""
+SHELL = "shell"
+"""The kind of slot used to run shell commands.
+"""
+
+_pollInterval = 0.5
+"""Seconds to wait before checking the load or memory again.
+"""
+
+def getLoadAverage():
+  """Get the load average of the system over the last minute.
+
+  @return: The load average or None if it isn't known.
+  @rtype: float or None
+  """
+  try:
+    return os.getloadavg()[0]
+  except (AttributeError, OSError):
+    return None
+
+if cake.system.isWindows():
+  try:
+    import ctypes
+
+    class _MemoryStatusEx(ctypes.Structure):
+      _fields_ = [
+        ("dwLength", ctypes.c_ulong),
+        ("dwMemoryLoad", ctypes.c_ulong),
+        ("ullTotalPhys", ctypes.c_ulonglong),
+        ("ullAvailPhys", ctypes.c_ulonglong),
+        ("ullTotalPageFile", ctypes.c_ulonglong),
+        ("ullAvailPageFile", ctypes.c_ulonglong),
+        ("ullTotalVirtual", ctypes.c_ulonglong),
+        ("ullAvailVirtual", ctypes.c_ulonglong),
+        ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+        ]
+
+    def getFreeMemory():
+      """Get the physical memory available to new processes.
+
+      @return: The available memory in bytes or None if it isn't known.
+      @rtype: int or None
+      """
+      status = _MemoryStatusEx()
+      status.dwLength = ctypes.sizeof(status)
+      if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        return None
+      return status.ullAvailPhys
+  except ImportError:
+    def getFreeMemory():
+      return None
+else:
+  def getFreeMemory():
+    """Get the physical memory available to new processes.
+
+    @return: The available memory in bytes or None if it isn't known.
+    @rtype: int or None
+    """
+    try:
+      f = open("/proc/meminfo", "rt")
+      try:
+        lines = f.readlines()
+      finally:
+        f.close()
+    except EnvironmentError:
+      return None
+
+    values = {}
+    for line in lines:
+      parts = line.split()
+      if len(parts) >= 2 and parts[1].isdigit():
+        values[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    if "MemAvailable" in values:
+      return values["MemAvailable"]
+    elif "MemFree" in values:
+      # Older kernels don't estimate the available memory.
+      return values["MemFree"] + values.get("Cached", 0)
+    else:
+      return None
+
+def parseJobServerAuth(makeFlags):
+  """Find the jobserver passed to a process by make.
+
+  @param makeFlags: The value of the MAKEFLAGS environment variable.
+  @type makeFlags: string
+
+  @return: The value of the last --jobserver-auth or --jobserver-fds
+  option, eg. '3,4' or 'fifo:/tmp/GMfifo1234', or None if there is none.
+  @rtype: string or None
+  """
+  auth = None
+  for arg in makeFlags.split():
+    for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+      if arg.startswith(prefix):
+        auth = arg[len(prefix):]
+  return auth
+
+class JobServerClient(object):
+  """Takes job slots from a GNU make jobserver.
+
+  A process run by make has one implicit job slot. Each further process
+  it runs at once needs a token read from the jobserver's pipe, which is
+  written back when the process exits.
+
+  The jobserver isn't supported on Windows, where make uses a semaphore
+  instead of a pipe.
+  """
+
+  def __init__(self, readFd, writeFd, ownedFds=()):
+    """Construct a client of a jobserver.
+
+    @param readFd: The file descriptor to read tokens from.
+    @type readFd: int
+    @param writeFd: The file descriptor to write tokens back to.
+    @type writeFd: int
+    @param ownedFds: File descriptors to close when the client is closed.
+    @type ownedFds: sequence of int
+    """
+    self._readFd = readFd
+    self._writeFd = writeFd
+    self._ownedFds = list(ownedFds)
+    self._implicitFree = True
+    self._waiting = 0
+    self._lock = threading.Lock()
+
+    # Waiting threads are woken through a pipe when the implicit slot is
+    # released, as they can't wait on a condition and a pipe at once.
+    self._wakeReadFd, self._wakeWriteFd = os.pipe()
+    for fd in (self._wakeReadFd, self._wakeWriteFd):
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self._ownedFds.extend([self._wakeReadFd, self._wakeWriteFd])
+
+  @classmethod
+  def fromEnvironment(cls, environment=None):
+    """Connect to the jobserver of the make that ran this process.
+
+    @param environment: The environment to look for MAKEFLAGS in. If None
+    then os.environ is used.
+    @type environment: dict or None
+
+    @return: The client or None if there is no usable jobserver, eg.
+    because the command running Cake wasn't marked as recursive so make
+    didn't pass on its pipe.
+    @rtype: L{JobServerClient} or None
+    """
+    if cake.system.isWindows():
+      return None
+    if environment is None:
+      environment = os.environ
+
+    auth = parseJobServerAuth(environment.get("MAKEFLAGS", ""))
+    if auth is None:
+      return None
+
+    if auth.startswith("fifo:"):
+      try:
+        fd = os.open(auth[len("fifo:"):], os.O_RDWR)
+      except EnvironmentError:
+        return None
+      return cls(fd, fd, ownedFds=[fd])
+
+    try:
+      readFd, writeFd = [int(s) for s in auth.split(",")]
+    except ValueError:
+      return None
+    if readFd < 0 or writeFd < 0:
+      return None
+    # If make didn't pass on its pipe then the descriptors may have been
+    # reused for other files.
+    try:
+      if not stat.S_ISFIFO(os.fstat(readFd).st_mode):
+        return None
+      if not stat.S_ISFIFO(os.fstat(writeFd).st_mode):
+        return None
+    except OSError:
+      return None
+    return cls(readFd, writeFd)
+
+  def acquire(self):
+    """Take a job slot, waiting until one is free.
+
+    @return: The token to pass to L{release}.
+    @rtype: string or None
+    """
+    self._lock.acquire()
+    self._waiting += 1
+    self._lock.release()
+    try:
+      while True:
+        self._lock.acquire()
+        try:
+          if self._implicitFree:
+            self._implicitFree = False
+            return None
+        finally:
+          self._lock.release()
+
+        # The read may still block if another process takes the token
+        # first, but then that process will write a token back later.
+        try:
+          readable = select.select([self._readFd, self._wakeReadFd], [], [])[0]
+        except select.error, e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        if self._wakeReadFd in readable:
+          try:
+            os.read(self._wakeReadFd, 64)
+          except OSError:
+            pass # Read by another waiting thread.
+          continue
+
+        try:
+          token = os.read(self._readFd, 1)
+        except OSError, e:
+          if e.errno in (errno.EINTR, errno.EAGAIN):
+            continue
+          raise
+        if token:
+          return token
+        time.sleep(_pollInterval) # Every writer has exited.
+    finally:
+      self._lock.acquire()
+      self._waiting -= 1
+      self._lock.release()
+
+  def release(self, token):
+    """Return a job slot.
+
+    @param token: The token returned by L{acquire}.
+    @type token: string or None
+    """
+    if token is None:
+      self._lock.acquire()
+      try:
+        self._implicitFree = True
+        if self._waiting:
+          try:
+            os.write(self._wakeWriteFd, "+")
+          except OSError:
+            pass # The waiting threads haven't read earlier wakes yet.
+      finally:
+        self._lock.release()
+      return
+
+    while True:
+      try:
+        os.write(self._writeFd, token)
+        return
+      except OSError, e:
+        if e.errno != errno.EINTR:
+          raise
+
+  def getMakeFlags(self, makeFlags):
+    """Get the MAKEFLAGS to pass to processes run by Cake.
+
+    @param makeFlags: The MAKEFLAGS the process would otherwise be given.
+    @type makeFlags: string
+
+    @return: The new MAKEFLAGS.
+    @rtype: string
+    """
+    return makeFlags # Passed on from make unchanged.
+
+  def close(self):
+    """Close any file descriptors opened by the client.
+    """
+    fds, self._ownedFds = self._ownedFds, []
+    for fd in set(fds):
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+class JobServer(JobServerClient):
+  """A GNU make jobserver shared with the processes run by Cake.
+
+  Make processes run by shell commands (see L{cake.library.shell}) find
+  the jobserver through MAKEFLAGS and inherit its pipe, so that nested
+  make builds don't run more than the given number of jobs in total.
+  Compilers are run without inheriting the pipe.
+  """
+
+  def __init__(self, jobs):
+    """Start a jobserver.
+
+    @param jobs: The number of job slots, including the implicit slot.
+    @type jobs: int
+
+    @raise EnvironmentError: If the jobserver's pipe couldn't be created.
+    """
+    readFd, writeFd = os.pipe()
+    JobServerClient.__init__(self, readFd, writeFd, ownedFds=[readFd, writeFd])
+    self.jobs = max(1, jobs)
+    os.write(writeFd, "+" * (self.jobs - 1))
+
+  def getMakeFlags(self, makeFlags):
+    args = [
+      arg for arg in makeFlags.split()
+      if not arg.startswith("--jobserver-") and not arg.startswith("-j")
+      ]
+    args.append("-j%i" % self.jobs)
+    args.append("--jobserver-auth=%i,%i" % (self._readFd, self._writeFd))
+    return " " + " ".join(args)
+
+class _Slot(object):
+
+  def __init__(self, kind, token):
+    self.kind = kind
+    self.token = token
+
+class ProcessSlots(object):
+  """Limits the processes run at once by tools.
+
+  The thread pool limits the number of tasks run at once, whether they
+  run Python code or wait for a process. Process slots limit the
+  processes separately, in total and for each kind of process, eg. so
+  that only a few memory hungry links run alongside many compiles.
+
+  If a maximum load or minimum free memory is given then no more
+  processes are started while the system is busy, unless none are
+  running.
+
+  Usage::
+    slot = slots.acquire(cake.slots.COMPILE)
+    try:
+      runCompiler()
+    finally:
+      slots.release(slot)
+  """
+
+  def __init__(
+    self,
+    maxProcesses=None,
+    limits=None,
+    maxLoad=None,
+    minFreeMemory=None,
+    jobServer=None,
+    ):
+    """Construct the process slots.
+
+    @param maxProcesses: The maximum number of processes to run at once,
+    or None for no limit.
+    @type maxProcesses: int or None
+    @param limits: The maximum number of processes of each kind to run at
+    once. Kinds not in the dictionary are only limited by maxProcesses.
+    @type limits: dict of string:int or None
+    @param maxLoad: Don't start processes while the load average is at
+    least this, or None to ignore the load.
+    @type maxLoad: float or None
+    @param minFreeMemory: Don't start processes while fewer than this
+    many bytes of memory are available, or None to ignore memory.
+    @type minFreeMemory: int or None
+    @param jobServer: A jobserver to take a slot from for each process.
+    @type jobServer: L{JobServerClient} or None
+    """
+    self.maxProcesses = maxProcesses
+    self.limits = dict(limits or {})
+    self.maxLoad = maxLoad
+    self.minFreeMemory = minFreeMemory
+    self.jobServer = jobServer
+    self._running = 0
+    self._runningByKind = {}
+    self._condition = threading.Condition(threading.Lock())
+
+  def _isBusy(self):
+    if self.maxLoad is not None:
+      load = getLoadAverage()
+      if load is not None and load >= self.maxLoad:
+        return True
+    if self.minFreeMemory is not None:
+      freeMemory = getFreeMemory()
+      if freeMemory is not None and freeMemory < self.minFreeMemory:
+        return True
+    return False
+
+  def _canStart(self, kind):
+    if self.maxProcesses is not None and self._running >= self.maxProcesses:
+      return False
+    limit = self.limits.get(kind, None)
+    if limit is not None and self._runningByKind.get(kind, 0) >= limit:
+      return False
+    if self._running and self._isBusy():
+      return False
+    return True
+
+  def acquire(self, kind):
+    """Take a slot to run a process, waiting until one is free.
+
+    @param kind: The kind of process, eg. L{COMPILE}.
+    @type kind: string
+
+    @return: The slot to pass to L{release} once the process has exited.
+    """
+    if self.maxLoad is not None or self.minFreeMemory is not None:
+      timeout = _pollInterval # Check the system again in a while.
+    else:
+      timeout = None
+
+    self._condition.acquire()
+    try:
+      while not self._canStart(kind):
+        self._condition.wait(timeout)
+      self._running += 1
+      self._runningByKind[kind] = self._runningByKind.get(kind, 0) + 1
+    finally:
+      self._condition.release()
+
+    token = None
+    if self.jobServer is not None:
+      try:
+        token = self.jobServer.acquire()
+      except Exception:
+        self._release(kind)
+        raise
+    return _Slot(kind, token)
+
+  def release(self, slot):
+    """Return a slot taken by L{acquire}.
+    """
+    try:
+      if self.jobServer is not None:
+        self.jobServer.release(slot.token)
+    finally:
+      self._release(slot.kind)
+
+  def _release(self, kind):
+    self._condition.acquire()
+    try:
+      self._running -= 1
+      self._runningByKind[kind] -= 1
+      self._condition.notifyAll()
+    finally:
+      self._condition.release()
+
+  def getEnvironment(self, environment):
+    """Get the environment to run a process that may run make with.
+
+    @param environment: The environment the process would otherwise be
+    given, or None for os.environ.
+    @type environment: dict or None
+
+    @return: The environment, with MAKEFLAGS set to use the jobserver.
+    @rtype: dict or None
+    """
+    if self.jobServer is None:
+      return environment
+    if environment is None:
+      environment = os.environ
+    environment = dict(environment)
+    makeFlags = self.jobServer.getMakeFlags(environment.get("MAKEFLAGS", ""))
+    if makeFlags:
+      environment["MAKEFLAGS"] = makeFlags
+    return environment
+
+  def close(self):
+    """Stop using the jobserver, if any.
+    """
+    if self.jobServer is not None:
+      self.jobServer.close()
@@ -0,0 +1,472 @@
+"""Process Spawner.
+
+Launching a process on Unix forks the launching process, which takes
+longer the more memory it uses. A large build can make the Cake process
+big enough for this to matter when thousands of compilers are run, so
+processes can instead be launched by a small spawner process that Cake
+starts once (see L{Spawner}).
+
+The spawner reads requests from its stdin and writes responses to its
+stdout. Each message is a 4 byte big-endian length followed by the
+marshalled message. A process's output can be sent back while it runs
+(see L{runProcess}).
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import errno
+import marshal
+import os
+import os.path
+import Queue
+import select
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+_headerFormat = ">I"
+_headerSize = struct.calcsize(_headerFormat)
+
+_STDOUT = 0
+_STDERR = 1
+_RESULT = 2
+
+_readSize = 65536
+_pollInterval = 0.1
+
+class LineBuffer(object):
+  """Passes text on to a function in whole lines.
+
+  Text is fed in pieces of any size, eg. as a process writes its output
+  to a pipe. Each time the text fed so far includes the end of a line
+  the complete lines are passed to the function. Any remaining partial
+  line is passed on when the buffer is flushed.
+  """
+
+  def __init__(self, output):
+    """Construct a line buffer.
+
+    @param output: The function to pass the lines of text to.
+    @type output: function(string)
+    """
+    self._output = output
+    self._buffer = ""
+
+  def feed(self, text):
+    """Add some more text.
+
+    @type text: string
+    """
+    end = text.rfind("\n") + 1
+    if end:
+      lines = self._buffer + text[:end]
+      self._buffer = text[end:]
+      self._output(lines)
+    else:
+      self._buffer += text
+
+  def flush(self):
+    """Pass on any remaining partial line.
+    """
+    if self._buffer:
+      text = self._buffer
+      self._buffer = ""
+      self._output(text)
+
+def runProcess(args, shell=False, cwd=None, env=None, onStdout=None, onStderr=None):
+  """Run a process to completion, reading its output from pipes.
+
+  stdout and stderr are read concurrently so that a process can't block
+  writing to one while we wait for the other.
+
+  @param args: The program and its arguments, or the command line if
+  shell is True.
+  @type args: list of string or string
+  @param shell: Whether to run the command with the shell.
+  @type shell: bool
+  @param cwd: The working directory of the process.
+  @type cwd: string or None
+  @param env: The environment of the process.
+  @type env: dict or None
+  @param onStdout: If given, called with each piece of stdout as it is
+  read, rather than returning stdout once the process has finished.
+  @type onStdout: function(string) or None
+  @param onStderr: If given, called with each piece of stderr as it is
+  read, rather than returning stderr once the process has finished.
+  @type onStderr: function(string) or None
+
+  @return: An (exitCode, stdout, stderr) tuple. stdout or stderr is empty
+  if it was passed to onStdout or onStderr.
+  @rtype: tuple of (int, string, string)
+
+  @raise EnvironmentError: If the process couldn't be launched.
+  """
+  p = subprocess.Popen(
+    args=args,
+    shell=shell,
+    cwd=cwd,
+    env=env,
+    stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    # Don't leak the pipes of processes launched by other threads, or
+    # they won't see the end of their output until this process exits.
+    close_fds=True,
+    )
+  if onStdout is None and onStderr is None:
+    stdout, stderr = p.communicate()
+    return p.returncode, stdout, stderr
+
+  p.stdin.close()
+  stdoutChunks = []
+  stderrChunks = []
+  outputs = {
+    p.stdout.fileno(): onStdout or stdoutChunks.append,
+    p.stderr.fileno(): onStderr or stderrChunks.append,
+    }
+  try:
+    # poll() rather than select() as it isn't limited to low numbered
+    # file descriptors.
+    poller = select.poll()
+    for fd in outputs:
+      poller.register(fd, select.POLLIN)
+    while outputs:
+      try:
+        events = poller.poll()
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for fd, _ in events:
+        data = os.read(fd, _readSize)
+        if data:
+          outputs[fd](data)
+        else:
+          poller.unregister(fd)
+          del outputs[fd]
+  finally:
+    # If an output function failed, closing the pipes makes sure the
+    # process doesn't block writing more output.
+    p.stdout.close()
+    p.stderr.close()
+    exitCode = p.wait()
+  return exitCode, "".join(stdoutChunks), "".join(stderrChunks)
+
+def runProcessWithFiles(args, executable=None, cwd=None, env=None, onStdout=None, onStderr=None):
+  """Run a process to completion, with its output written to temporary
+  files.
+
+  This is used on Windows, where pipe handles can be inherited by
+  processes launched concurrently by other threads, which would keep
+  them open until those processes exit. The files are read as the
+  process writes to them, so output can still be passed on while the
+  process runs.
+
+  The parameters and result are the same as L{runProcess}, except that
+  shell is always False and args may be a command line.
+
+  @param executable: The path of the program to run, if args is a
+  command line.
+  @type executable: string or None
+  """
+  files = []
+  try:
+    for _ in xrange(2):
+      fd, path = tempfile.mkstemp()
+      files.append((fd, path, open(path, "rb")))
+    (stdoutFd, _, stdoutFile), (stderrFd, _, stderrFile) = files
+
+    p = subprocess.Popen(
+      args=args,
+      executable=executable,
+      shell=False,
+      cwd=cwd,
+      env=env,
+      stdin=subprocess.PIPE,
+      stdout=stdoutFd,
+      stderr=stderrFd,
+      )
+    p.stdin.close()
+
+    finished = threading.Event()
+    def wait():
+      p.wait()
+      finished.set()
+    waitThread = threading.Thread(target=wait)
+    waitThread.setDaemon(True)
+    waitThread.start()
+
+    stdoutChunks = []
+    stderrChunks = []
+    outputs = [
+      (stdoutFile, _NewlineTranslator(onStdout or stdoutChunks.append)),
+      (stderrFile, _NewlineTranslator(onStderr or stderrChunks.append)),
+      ]
+    while True:
+      # Check for the process exiting before reading so that the last
+      # read gets everything it wrote.
+      isFinished = finished.isSet()
+      for f, output in outputs:
+        while True:
+          data = f.read(_readSize)
+          if not data:
+            break
+          output.feed(data)
+      if isFinished:
+        break
+      finished.wait(_pollInterval)
+    for _, output in outputs:
+      output.flush()
+    return p.returncode, "".join(stdoutChunks), "".join(stderrChunks)
+  finally:
+    for fd, path, f in files:
+      f.close()
+      os.close(fd)
+      try:
+        os.remove(path)
+      except EnvironmentError:
+        # The file may still be open in a process launched by another
+        # thread, the system will delete it later.
+        pass
+
+class _NewlineTranslator(object):
+  """Translates CRLF line endings to LF as text is passed on, like a file
+  read in text mode.
+  """
+
+  def __init__(self, output):
+    self._output = output
+    self._pendingReturn = False
+
+  def feed(self, data):
+    if self._pendingReturn:
+      data = "\r" + data
+    self._pendingReturn = data.endswith("\r")
+    if self._pendingReturn:
+      data = data[:-1]
+    if data:
+      self._output(data.replace("\r\n", "\n"))
+
+  def flush(self):
+    if self._pendingReturn:
+      self._pendingReturn = False
+      self._output("\r")
+
+def _readMessage(f):
+  header = f.read(_headerSize)
+  if len(header) < _headerSize:
+    return None
+  size, = struct.unpack(_headerFormat, header)
+  data = f.read(size)
+  if len(data) < size:
+    return None
+  return marshal.loads(data)
+
+def _writeMessage(f, message):
+  data = marshal.dumps(message)
+  f.write(struct.pack(_headerFormat, len(data)) + data)
+  f.flush()
+
+class _Request(object):
+
+  def __init__(self):
+    # Output and the result are queued for the thread that is running
+    # the process, so that output functions are called by that thread.
+    self.responses = Queue.Queue()
+
+class Spawner(object):
+  """Launches processes from a separate spawner process.
+
+  Processes are run concurrently, any number of threads can call
+  L{run} at once.
+  """
+
+  def __init__(self):
+    """Start a spawner process.
+
+    @raise EnvironmentError: If the spawner couldn't be started.
+    """
+    environment = dict(os.environ)
+    cakeRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonPath = environment.get("PYTHONPATH", None)
+    if pythonPath:
+      environment["PYTHONPATH"] = cakeRoot + os.pathsep + pythonPath
+    else:
+      environment["PYTHONPATH"] = cakeRoot
+    self._process = subprocess.Popen(
+      args=[sys.executable, "-m", "cake.spawner"],
+      env=environment,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      close_fds=True,
+      )
+    self._requests = {}
+    self._nextId = 0
+    self._closed = False
+    self._lock = threading.Lock()
+    self._writeLock = threading.Lock()
+    readThread = threading.Thread(target=self._readResponses)
+    readThread.setDaemon(True)
+    readThread.start()
+
+  @property
+  def closed(self):
+    """Whether the spawner process has exited.
+
+    @rtype: bool
+    """
+    return self._closed
+
+  def run(self, args, shell=False, cwd=None, env=None, onStdout=None, onStderr=None):
+    """Run a process to completion using the spawner.
+
+    The parameters and result are the same as L{runProcess}.
+
+    @raise EnvironmentError: If the process couldn't be launched or the
+    spawner has exited.
+    """
+    request = _Request()
+    self._lock.acquire()
+    try:
+      if self._closed:
+        raise EnvironmentError("the process spawner has exited")
+      requestId = self._nextId
+      self._nextId += 1
+      self._requests[requestId] = request
+    finally:
+      self._lock.release()
+
+    self._writeLock.acquire()
+    try:
+      try:
+        stream = (onStdout is not None, onStderr is not None)
+        _writeMessage(self._process.stdin, (requestId, args, shell, cwd, env, stream))
+      except (EnvironmentError, ValueError), e:
+        self._lock.acquire()
+        try:
+          self._requests.pop(requestId, None)
+        finally:
+          self._lock.release()
+        raise EnvironmentError("writing to the process spawner failed: %s" % e)
+    finally:
+      self._writeLock.release()
+
+    outputs = {_STDOUT: onStdout, _STDERR: onStderr}
+    while True:
+      kind, payload = request.responses.get()
+      if kind == _RESULT:
+        break
+      outputs[kind](payload)
+    result, error = payload
+    if error is not None:
+      raise EnvironmentError(error)
+    return result
+
+  def close(self):
+    """Stop the spawner process once running processes have finished.
+    """
+    self._writeLock.acquire()
+    try:
+      self._process.stdin.close()
+    finally:
+      self._writeLock.release()
+    self._process.wait()
+
+  def _readResponses(self):
+    try:
+      while True:
+        try:
+          message = _readMessage(self._process.stdout)
+        except (EnvironmentError, ValueError, EOFError):
+          message = None
+        if message is None:
+          break
+        requestId, kind, payload = message
+        self._lock.acquire()
+        try:
+          if kind == _RESULT:
+            request = self._requests.pop(requestId, None)
+          else:
+            request = self._requests.get(requestId, None)
+        finally:
+          self._lock.release()
+        if request is not None:
+          request.responses.put((kind, payload))
+    finally:
+      # Fail any requests still waiting for a response.
+      self._lock.acquire()
+      try:
+        self._closed = True
+        requests = self._requests.values()
+        self._requests.clear()
+      finally:
+        self._lock.release()
+      for request in requests:
+        request.responses.put((_RESULT, (None, "the process spawner exited")))
+
+_spawner = None
+_spawnerLock = threading.Lock()
+
+def getSpawner():
+  """Get the spawner, starting it if it isn't running.
+
+  @rtype: L{Spawner}
+
+  @raise EnvironmentError: If the spawner couldn't be started.
+  """
+  global _spawner
+  spawner = _spawner
+  if spawner is None or spawner.closed:
+    _spawnerLock.acquire()
+    try:
+      spawner = _spawner
+      if spawner is None or spawner.closed:
+        spawner = _spawner = Spawner()
+    finally:
+      _spawnerLock.release()
+  return spawner
+
+def _serve(requests, responses):
+  """Run processes as requested until the requests are closed.
+  """
+  responseLock = threading.Lock()
+
+  def run(requestId, args, shell, cwd, env, stream):
+    def respond(kind, payload):
+      responseLock.acquire()
+      try:
+        _writeMessage(responses, (requestId, kind, payload))
+      finally:
+        responseLock.release()
+
+    onStdout = onStderr = None
+    if stream[0]:
+      onStdout = lambda data: respond(_STDOUT, data)
+    if stream[1]:
+      onStderr = lambda data: respond(_STDERR, data)
+    try:
+      result = runProcess(args, shell, cwd, env, onStdout, onStderr)
+      error = None
+    except EnvironmentError, e:
+      result = None
+      error = str(e)
+    respond(_RESULT, (result, error))
+
+  threads = []
+  while True:
+    message = _readMessage(requests)
+    if message is None:
+      break
+    thread = threading.Thread(target=run, args=message)
+    thread.start()
+    threads.append(thread)
+    threads = [t for t in threads if t.isAlive()]
+  for thread in threads:
+    thread.join()
+
+if __name__ == "__main__":
+  _serve(sys.stdin, sys.stdout)
@@ -8,6 +8,8 @@
 import sys
 import threading
 
+import cake.trace
+
 _threadPool = None
 _threadPoolLock = threading.Lock()
 
@@ -91,6 +93,7 @@ class Task(object):
     """
     self._func = func
     self._immediate = None
+    self._priority = 0
     self._threadPool = None
     self._required = False
     self._parent = Task.getCurrent()
@@ -104,6 +107,10 @@ class Task(object):
     self._completeAfterDependencies = None
     self._callbacks = []
 
+    tracer = cake.trace.getTracer()
+    if tracer is not None:
+      tracer.taskCreated(self, func)
+
   @staticmethod
   def getCurrent():
     """Get the currently executing task.
@@ -119,6 +126,12 @@ class Task(object):
     """
     return self._state
   
+  @property
+  def priority(self):
+    """Get the priority this task was started with.
+    """
+    return self._priority
+  
   @property
   def parent(self):
     """Get the parent of this task.
@@ -175,7 +188,7 @@ class Task(object):
     else:
       raise AttributeError("result only available on successful tasks")
 
-  def lazyStart(self, threadPool=None):
+  def lazyStart(self, threadPool=None, priority=0):
     """Start this task only if required as a dependency of another 'required' task.
 
     A 'required' task is a task that is started eagerly using L{start()} or L{startAfter()}
@@ -184,18 +197,18 @@ class Task(object):
     If no other required tasks have this task as a dependency then this task will never
     be executed. i.e. it is a lazy task.
     """
-    self._start(other=None, immediate=False, required=False, threadPool=threadPool)
+    self._start(other=None, immediate=False, required=False, threadPool=threadPool, priority=priority)
 
-  def lazyStartAfter(self, other, threadPool=None):
+  def lazyStartAfter(self, other, threadPool=None, priority=0):
     """Start this task only if required as a dependency of another 'required' task.
 
     But do not start this task until the 'other' tasks have completed.
     If any of the other tasks complete with failure then this task will complete
     with failure without being executed.
     """
-    self._start(other=other, immediate=False, required=False, threadPool=threadPool)
+    self._start(other=other, immediate=False, required=False, threadPool=threadPool, priority=priority)
 
-  def start(self, immediate=False, threadPool=None):
+  def start(self, immediate=False, threadPool=None, priority=0):
     """Start this task now.
     
     @param immediate: If True the task is pushed ahead of any other (waiting)
@@ -206,13 +219,17 @@ class Task(object):
     executed on the specified thread-pool. If not specified then the task
     will be queued for execution on the default thread-pool.
     @type threadPool: L{ThreadPool} or C{None}
+    
+    @param priority: The priority of the task. Thread pools that support
+    priorities run higher priority tasks first.
+    @type priority: int or float
         
     @raise TaskError: If this task has already been started or
     cancelled.
     """
-    self._start(other=None, immediate=immediate, required=True, threadPool=threadPool)
+    self._start(other=None, immediate=immediate, required=True, threadPool=threadPool, priority=priority)
 
-  def startAfter(self, other, immediate=False, threadPool=None):
+  def startAfter(self, other, immediate=False, threadPool=None, priority=0):
     """Start this task after other tasks have completed.
     
     This task is cancelled (transition to Task.State.FAILED state) if any of the
@@ -229,12 +246,16 @@ class Task(object):
     If not specified then the task is queued to the default thread-pool.
     @type threadPool: L{ThreadPool} or None
     
+    @param priority: The priority of the task. Thread pools that support
+    priorities run higher priority tasks first.
+    @type priority: int or float
+    
     @raise TaskError: If this task has already been started or
     cancelled.
     """
-    self._start(other=other, immediate=immediate, required=True, threadPool=threadPool)
+    self._start(other=other, immediate=immediate, required=True, threadPool=threadPool, priority=priority)
 
-  def _start(self, other, immediate, required, threadPool):
+  def _start(self, other, immediate, required, threadPool, priority):
     immediate = bool(immediate)
     required = bool(required)
     otherTasks = _makeTasks(other)
@@ -248,6 +269,7 @@ class Task(object):
       self._state = Task.State.WAITING_FOR_START
       self._startAfterCount = len(otherTasks) + 1
       self._immediate = immediate
+      self._priority = priority
       self._threadPool = threadPool
       if required:
         self._required = True
@@ -261,6 +283,10 @@ class Task(object):
         self._startAfterDependencies = otherTasks
     finally:
       self._lock.release()
+
+    tracer = cake.trace.getTracer()
+    if tracer is not None:
+      tracer.taskState(self, Task.State.WAITING_FOR_START)
     
     if required:
       for t in otherTasks:
@@ -342,11 +368,20 @@ class Task(object):
     finally:
       self._lock.release()
 
+    tracer = cake.trace.getTracer()
     if callbacks is None:
       # Task is ready to start executing, queue to thread-pool.
-      self._threadPool.queueJob(self._execute, front=self._immediate)          
+      if tracer is not None:
+        tracer.taskQueued(self)
+      self._threadPool.queueJob(
+        self._execute,
+        front=self._immediate,
+        priority=self._priority,
+        )
     else:
       # Task was cancelled, call callbacks now
+      if tracer is not None:
+        tracer.taskState(self, Task.State.FAILED)
       for callback in callbacks:
         callback()
               
@@ -355,18 +390,24 @@ class Task(object):
     
     This should typically be run on a background thread.
     """
+    tracer = cake.trace.getTracer()
+    if tracer is not None:
+      tracer.taskDequeued(self)
+
     if self._state is not Task.State.RUNNING:
       assert self._state is Task.State.FAILED, "should have been cancelled"
       return
     
     callbacks = None
+    func = self._func
+    if tracer is not None:
+      startTime = tracer.now()
     
     try:
       old = self.getCurrent()
       self._current.value = self
       # Don't hold onto the func after it has been executed so it can
       # be garbage collected.
-      func = self._func
       self._func = None
       try:
         if func is not None:
@@ -375,6 +416,8 @@ class Task(object):
           result = None
       finally:
         self._current.value = old
+        if tracer is not None:
+          tracer.taskExecuted(self, func, startTime)
 
       # If the result of the task was another task
       # then our result will be the same as that other
@@ -398,6 +441,7 @@ class Task(object):
             self._state = Task.State.WAITING_FOR_COMPLETE
         else:
           assert self._state is Task.State.FAILED, "should have been cancelled"
+        state = self._state
       finally:
         self._lock.release()
         
@@ -416,8 +460,12 @@ class Task(object):
             self._state = Task.State.WAITING_FOR_COMPLETE
         else:
           assert self._state is Task.State.FAILED, "should have been cancelled"
+        state = self._state
       finally:
         self._lock.release()
+
+    if tracer is not None:
+      tracer.taskState(self, state)
      
     if callbacks:
       for callback in callbacks:
@@ -477,9 +525,15 @@ class Task(object):
           self._state = Task.State.FAILED
         callbacks = self._callbacks
         self._callbacks = None
+        state = self._state
     finally:
       self._lock.release()
         
+    if callbacks is not None:
+      tracer = cake.trace.getTracer()
+      if tracer is not None:
+        tracer.taskState(self, state)
+
     if callbacks:
       for callback in callbacks:
         callback()
@@ -501,6 +555,10 @@ class Task(object):
       self._callbacks = None
     finally:
       self._lock.release()
+
+    tracer = cake.trace.getTracer()
+    if tracer is not None:
+      tracer.taskState(self, Task.State.FAILED)
     
     for callback in callbacks:
       callback()
@@ -8,6 +8,16 @@ _modules = [
   "cake.test.path",
   "cake.test.threadpool",
   "cake.test.asyncresult",
+  "cake.test.filestate",
+  "cake.test.depdb",
+  "cake.test.trace",
+  "cake.test.objectcache",
+  "cake.test.spawner",
+  "cake.test.slots",
+  "cake.test.gnu",
+  "cake.test.includegraph",
+  "cake.test.scanner",
+  "cake.test.daemon",
   ]
 
 def suite():
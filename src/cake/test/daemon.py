@@ -0,0 +1,95 @@
+"""Build Daemon Unit Tests.
+"""
+
+import unittest
+import os
+import os.path
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+
+import cake.daemon
+
+class _Collector(object):
+
+  def __init__(self):
+    self.data = []
+
+  def write(self, text):
+    self.data.append(text)
+
+class DaemonTests(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def testTcpSocketToken(self):
+    socketPath = os.path.join(self.tempDir, "daemon")
+    useUnixSockets = cake.daemon._useUnixSockets
+    cake.daemon._useUnixSockets = False
+    try:
+      listener, token = cake.daemon._listen(socketPath)
+      try:
+        if os.name == "posix":
+          self.assertEqual(stat.S_IMODE(os.stat(socketPath).st_mode), 0600)
+
+        results = []
+        def serve(count):
+          for _ in xrange(count):
+            conn = listener.accept()[0]
+            try:
+              results.append(cake.daemon._authenticate(conn, token))
+            finally:
+              conn.close()
+        thread = threading.Thread(target=serve, args=(2,))
+        thread.start()
+
+        cake.daemon._connect(socketPath).close()
+        port = listener.getsockname()[1]
+        sock = socket.create_connection(("127.0.0.1", port))
+        try:
+          sock.sendall("0" * len(token))
+        finally:
+          sock.close()
+        thread.join()
+        self.assertEqual(results, [True, False])
+      finally:
+        listener.close()
+    finally:
+      cake.daemon._useUnixSockets = useUnixSockets
+
+  if os.name == "posix":
+    def testForwardChildOutput(self):
+      path = os.path.join(self.tempDir, "output")
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+      try:
+        stream = _Collector()
+        forwarder = cake.daemon._FileDescriptorForwarder(fd, stream)
+        subprocess.call(
+          [sys.executable, "-c", "import os; os.write(1, 'child')"],
+          stdout=fd,
+          )
+        forwarder.close()
+        self.assertEqual("".join(stream.data), "child")
+
+        # The file descriptor is restored.
+        os.write(fd, "after")
+      finally:
+        os.close(fd)
+      f = open(path, "rb")
+      try:
+        self.assertEqual(f.read(), "after")
+      finally:
+        f.close()
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(DaemonTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
@@ -0,0 +1,140 @@
+"""Dependency Database Unit Tests.
+"""
+
+import unittest
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+import cake.depdb
+
+class DependencyDatabaseTests(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.dbPath = os.path.join(self.tempDir, "deps.db")
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def _reload(self):
+    db = cake.depdb.DependencyDatabase(self.dbPath)
+    db.load()
+    return db
+
+  def testPutAndReload(self):
+    db = self._reload()
+    db.put(u"/build/a.o", "first")
+    db.put(u"/build/b.o", "second")
+    db.put(u"/build/a.o", "third")
+    db.close()
+
+    db = self._reload()
+    self.assertEqual(len(db), 2)
+    self.assertEqual(db.get(u"/build/a.o"), "third")
+    self.assertEqual(db.get(u"/build/b.o"), "second")
+    self.assertEqual(db.get(u"/build/c.o"), None)
+
+  def testTruncatedRecordIsIgnored(self):
+    db = self._reload()
+    db.put(u"/build/a.o", "first")
+    db.put(u"/build/b.o", "second")
+    db.close()
+
+    size = os.path.getsize(self.dbPath)
+    f = open(self.dbPath, "r+b")
+    try:
+      f.truncate(size - 3)
+    finally:
+      f.close()
+
+    db = self._reload()
+    self.assertEqual(db.get(u"/build/a.o"), "first")
+    self.assertEqual(db.get(u"/build/b.o"), None)
+
+    # Writing after corruption must not leave the corrupt record behind.
+    db.put(u"/build/c.o", "third")
+    db.close()
+    db = self._reload()
+    self.assertEqual(sorted(db.keys()), [u"/build/a.o", u"/build/c.o"])
+
+  def testPathTableIsPersisted(self):
+    db = self._reload()
+    ids = db.pathTable.internAll([u"/src/a.h", u"/src/b.h", u"/src/a.h"])
+    self.assertEqual(list(ids), [0, 1, 0])
+    db.put(u"/build/a.o", "value")
+    db.close()
+
+    db = self._reload()
+    self.assertTrue(db.pathTable.isPersistent)
+    self.assertEqual(db.pathTable.getPaths([1, 0]), [u"/src/b.h", u"/src/a.h"])
+    self.assertEqual(db.pathTable.intern(u"/src/c.h"), 2)
+
+  def testCompaction(self):
+    db = self._reload()
+    db.compactMinimum = 10
+    db.pathTable.intern(u"/src/a.h")
+    for i in xrange(20):
+      db.put(u"/build/a.o", "value%i" % i)
+    uncompactedSize = os.path.getsize(self.dbPath)
+    db.close()
+
+    self.assertTrue(os.path.getsize(self.dbPath) < uncompactedSize)
+    db = self._reload()
+    self.assertEqual(db.get(u"/build/a.o"), "value19")
+    self.assertEqual(db.pathTable.getPath(0), u"/src/a.h")
+
+  def testDiscard(self):
+    db = self._reload()
+    db.compactMinimum = 1
+    db.compactRatio = 0.0
+    db.put(u"/build/a.o", "first")
+    db.put(u"/build/a.o", "second")
+    db.put(u"/build/b.o", "third")
+    self.assertTrue(db.needsCompaction)
+    db.discard([u"/build/b.o"])
+    self.assertEqual(db.get(u"/build/b.o"), None)
+    db.close()
+
+    db = self._reload()
+    self.assertEqual(db.keys(), [u"/build/a.o"])
+    self.assertFalse(db.needsCompaction)
+
+  def testSingleWriter(self):
+    db = self._reload()
+    db.pathTable.intern(u"/src/a.h")
+    db.put(u"/build/a.o", "first")
+
+    # A second database for the same file can't write to it.
+    other = self._reload()
+    self.assertTrue(other.readOnly)
+    self.assertFalse(other.pathTable.isPersistent)
+    self.assertEqual(other.get(u"/build/a.o"), "first")
+    other.pathTable.intern(u"/src/b.h")
+    other.put(u"/build/b.o", "second")
+    other.close()
+    db.close()
+
+    db = self._reload()
+    self.assertFalse(db.readOnly)
+    self.assertEqual(db.keys(), [u"/build/a.o"])
+    self.assertEqual(len(db.pathTable), 1)
+
+    # Once closed, a database can't write again after another has.
+    db.close()
+    other = self._reload()
+    other.put(u"/build/b.o", "second")
+    other.close()
+    self.assertRaises(EnvironmentError, db.put, u"/build/c.o", "third")
+    self.assertTrue(db.readOnly)
+    db = self._reload()
+    self.assertEqual(sorted(db.keys()), [u"/build/a.o", u"/build/b.o"])
+    db.put(u"/build/c.o", "third")
+    db.close()
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(DependencyDatabaseTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
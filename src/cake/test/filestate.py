@@ -0,0 +1,66 @@
+"""File State Cache Unit Tests.
+"""
+
+import unittest
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+import cake.filestate
+
+class FileStateCacheTests(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.cachePath = os.path.join(self.tempDir, "filestate")
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def testSaveAndLoad(self):
+    digest = "0123456789abcdefghij"
+    cache = cake.filestate.FileStateCache(self.cachePath)
+    cache.validate(u"/some/file.h", 1000.5, 42, 7)
+    cache.setDigest(u"/some/file.h", 1000.5, digest)
+    cache.validate(u"/some/other.h", 2000.0, 10, 8)
+    cache.save()
+
+    loaded = cake.filestate.FileStateCache(self.cachePath)
+    loaded.load()
+    self.assertEqual(len(loaded), 2)
+    self.assertEqual(loaded.getDigest(u"/some/file.h", 1000.5), digest)
+    self.assertEqual(loaded.getDigest(u"/some/other.h", 2000.0), None)
+
+  def testChangedFileDiscardsDigest(self):
+    digest = "0123456789abcdefghij"
+    cache = cake.filestate.FileStateCache(self.cachePath)
+    cache.validate(u"/some/file.h", 1000.0, 42, 7)
+    cache.setDigest(u"/some/file.h", 1000.0, digest)
+
+    # Same timestamp but a different size means the file has changed.
+    cache.validate(u"/some/file.h", 1000.0, 43, 7)
+    self.assertEqual(cache.getDigest(u"/some/file.h", 1000.0), None)
+
+  def testDigestIgnoredForStaleTimestamp(self):
+    cache = cake.filestate.FileStateCache(self.cachePath)
+    cache.validate(u"/some/file.h", 1000.0, 42, 7)
+    cache.setDigest(u"/some/file.h", 999.0, "0123456789abcdefghij")
+    self.assertEqual(cache.getDigest(u"/some/file.h", 1000.0), None)
+
+  def testCorruptFileIsIgnored(self):
+    f = open(self.cachePath, "wb")
+    try:
+      f.write("CKFS garbage")
+    finally:
+      f.close()
+
+    cache = cake.filestate.FileStateCache(self.cachePath)
+    cache.load()
+    self.assertEqual(len(cache), 0)
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(FileStateCacheTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
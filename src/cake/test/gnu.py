@@ -0,0 +1,108 @@
+"""GNU Utilities Unit Tests.
+"""
+
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+import cake.filesys
+import cake.gnu
+import cake.includegraph
+
+_dependencyFile = (
+  "obj/main.o: src/main.cpp include/a.h \\\n"
+  " include/with\\ space.h include/a.h\n"
+  )
+
+class DependencyParserTests(unittest.TestCase):
+
+  def testFeedInPieces(self):
+    expected = ["src/main.cpp", "include/a.h", "include/with space.h"]
+    for size in [1, 2, 7, len(_dependencyFile)]:
+      parser = cake.gnu.DependencyParser(".o")
+      for i in xrange(0, len(_dependencyFile), size):
+        parser.feed(_dependencyFile[i:i+size])
+      self.assertEqual(parser.close(), expected)
+
+    tempDir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tempDir, "main.d")
+      cake.filesys.writeFile(path, _dependencyFile)
+      self.assertEqual(cake.gnu.parseDependencyFile(path, ".o"), expected)
+    finally:
+      shutil.rmtree(tempDir)
+
+  def testRules(self):
+    def parse(text, targetSuffix=".o"):
+      parser = cake.gnu.DependencyParser(targetSuffix)
+      parser.feed(text)
+      dependencies = parser.close()
+      parser = cake.gnu.DependencyParser(targetSuffix)
+      for c in text:
+        parser.feed(c)
+      self.assertEqual(parser.close(), dependencies)
+      return dependencies
+
+    # Multiple targets, escaped characters and phony rules from -MP.
+    self.assertEqual(
+      parse(
+        "# comment\n"
+        "obj/main.d \\\n"
+        " obj/main.o: src/main.cpp cost$$.h hash\\#.h\n"
+        "\n"
+        "cost$$.h:\n"
+        "\n"
+        "hash\\#.h:\n"
+        ),
+      ["src/main.cpp", "cost$.h", "hash#.h"],
+      )
+
+    # Windows paths with drive letters and CRLF line endings.
+    self.assertEqual(
+      parse("C:\\obj\\main.obj: C:\\src\\main.c \\\r\n C:\\inc\\a.h\r\n", ".obj"),
+      ["C:\\src\\main.c", "C:\\inc\\a.h"],
+      )
+
+    # Rules for other targets are ignored.
+    self.assertEqual(parse("main.gch: main.h\nmain.o: main.c\n", ".o"), ["main.c"])
+
+class IncludeTreeParserTests(unittest.TestCase):
+
+  def testParse(self):
+    text = (
+      "x ./obj/pch.h.gch\n"
+      "! ./obj/pch.h.gch\n"
+      ". include/a.h\n"
+      ".. include/b.h\n"
+      "include/b.h:1:2: warning: something\n"
+      ". include/c.h\n"
+      "..! include/pch.h.gch\n"
+      "Multiple include guards may be useful for:\n"
+      "include/c.h\n"
+      "src/main.c:3: error: something else\n"
+      )
+    for size in [1, 5, len(text)]:
+      tree = cake.includegraph.IncludeTree()
+      parser = cake.gnu.IncludeTreeParser(tree)
+      output = ""
+      for i in xrange(0, len(text), size):
+        output += parser.feed(text[i:i+size])
+      output += parser.close()
+      self.assertEqual(
+        output,
+        "include/b.h:1:2: warning: something\n"
+        "src/main.c:3: error: something else\n"
+        )
+      self.assertEqual(
+        tree.roots,
+        [("include/a.h", [("include/b.h", [])]), ("include/c.h", [])],
+        )
+
+if __name__ == "__main__":
+  suite = unittest.TestSuite()
+  suite.addTests(unittest.TestLoader().loadTestsFromTestCase(DependencyParserTests))
+  suite.addTests(unittest.TestLoader().loadTestsFromTestCase(IncludeTreeParserTests))
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
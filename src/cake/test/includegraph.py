@@ -0,0 +1,52 @@
+"""Include Graph Unit Tests.
+"""
+
+import unittest
+import sys
+
+import cake.includegraph
+
+class IncludeGraphTests(unittest.TestCase):
+
+  def testIncludeTree(self):
+    tree = cake.includegraph.IncludeTree()
+    tree.addInclude(1, "a.h")
+    tree.addInclude(2, "b.h")
+    tree.addInclude(3, "c.h")
+    tree.addInclude(2, "d.h")
+    tree.addInclude(1, "e.h")
+    self.assertEqual(
+      tree.roots,
+      [
+        ("a.h", [("b.h", [("c.h", [])]), ("d.h", [])]),
+        ("e.h", []),
+        ],
+      )
+    self.assertEqual(tree.paths(), set(["a.h", "b.h", "c.h", "d.h", "e.h"]))
+
+    dependencies = cake.includegraph.DependencyList(["main.c"], tree)
+    self.assertEqual(dependencies, ["main.c"])
+    self.assertTrue(dependencies.includeTree is tree)
+
+  def testNodes(self):
+    packNode = cake.includegraph.packNode
+    childDigest, childRecord = packNode(u"/inc/b.h", 1.5, [])
+    digest, record = packNode(u"/inc/a.h", 2.5, [childDigest, childDigest])
+    self.assertEqual(len(digest), cake.includegraph.DIGEST_SIZE)
+    self.assertEqual(
+      cake.includegraph.unpackNode(record),
+      (u"/inc/a.h", 2.5, [childDigest, childDigest]),
+      )
+
+    # A node's digest changes with its children.
+    otherChildDigest = packNode(u"/inc/b.h", 3.5, [])[0]
+    self.assertNotEqual(packNode(u"/inc/a.h", 2.5, [otherChildDigest])[0], digest)
+
+    key = cake.includegraph.getNodeKey(digest)
+    self.assertTrue(cake.includegraph.isNodeKey(key))
+    self.assertFalse(cake.includegraph.isNodeKey(u"/build/a.o"))
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(IncludeGraphTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
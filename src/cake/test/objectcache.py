@@ -0,0 +1,293 @@
+"""Object Cache Unit Tests.
+"""
+
+import unittest
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import zlib
+
+import cake.cacheserver
+import cake.filesys
+import cake.objectcache
+import cake.zipping
+
+_objectDigest = "0123456789abcdef0123456789abcdef01234567"
+_targetDigest = "fedcba9876543210fedcba9876543210fedcba98"
+_entryDigest = "00112233445566778899aabbccddeeff00112233"
+
+class ObjectCacheTests(object):
+  """Tests run against each backend.
+  """
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.sourcePath = os.path.join(self.tempDir, "source.o")
+    self.targetPath = os.path.join(self.tempDir, "target.o")
+    cake.filesys.writeFile(self.sourcePath, "object data" * 100)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def testStoreAndRestoreObject(self):
+    cache = self.createCache()
+    self.assertRaises(
+      EnvironmentError,
+      cache.restoreObject, _objectDigest, self.targetPath,
+      )
+    self.assertTrue(cache.storeObject(_objectDigest, self.sourcePath) > 0)
+    cache.restoreObject(_objectDigest, self.targetPath)
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+
+  def testCodecs(self):
+    cache = self.createCache()
+    for name in ["zlib:9", "bz2", "none"]:
+      codec = cake.zipping.getCodec(name)
+      cache.storeObject(_objectDigest, self.sourcePath, codec)
+      cache.restoreObject(_objectDigest, self.targetPath)
+      self.assertEqual(
+        cake.filesys.readFile(self.targetPath),
+        cake.filesys.readFile(self.sourcePath),
+        )
+
+  def testIndex(self):
+    cache = self.createCache()
+    self.assertEqual(cache.readIndex(_targetDigest), None)
+    entries = [(_entryDigest, [u"/src/a.cpp", u"/src/a.h"], _objectDigest)]
+    cache.writeIndex(_targetDigest, entries)
+    self.assertEqual(cache.readIndex(_targetDigest), entries)
+
+  def testPrefetch(self):
+    cache = self.createCache()
+    cache.storeObject(_objectDigest, self.sourcePath)
+    cache.prefetchObject(_objectDigest)
+    cache.restoreObject(_objectDigest, self.targetPath)
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+    cache.prefetchObject(_entryDigest)
+    cache.discardPrefetched(_entryDigest)
+
+class FileObjectCacheTests(ObjectCacheTests, unittest.TestCase):
+
+  def createCache(self):
+    return cake.objectcache.FileObjectCache(os.path.join(self.tempDir, "cache"))
+
+  def testRestoreInvalidObject(self):
+    cache = self.createCache()
+    cache.storeObject(_objectDigest, self.sourcePath)
+    objectPath = cache.getObjectPath(_objectDigest)
+    data = cake.filesys.readFile(objectPath)
+    cake.filesys.writeFile(objectPath, data[:-4])
+    self.assertRaises(
+      EnvironmentError,
+      cache.restoreObject, _objectDigest, self.targetPath,
+      )
+
+    # Objects stored by older versions of Cake are plain zlib data.
+    cake.filesys.writeFile(objectPath, zlib.compress(cake.filesys.readFile(self.sourcePath)))
+    cache.restoreObject(_objectDigest, self.targetPath)
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+
+  def testLinkObjects(self):
+    cache = self.createCache()
+    size = cache.storeObject(_objectDigest, self.sourcePath, link=True)
+    self.assertEqual(size, os.path.getsize(self.sourcePath))
+    rawPath = cache.getRawObjectPath(_objectDigest)
+    self.assertEqual(
+      cake.filesys.readFile(rawPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+
+    cake.filesys.writeFile(self.targetPath, "old target")
+    os.utime(rawPath, (1000, 1000))
+    cache.restoreObject(_objectDigest, self.targetPath)
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+    # Marking the object as used mustn't change the timestamp of targets
+    # that may be linked to it.
+    self.assertEqual(os.path.getmtime(rawPath), 1000)
+    self.assertTrue(os.path.getmtime(rawPath + ".used") > 1000)
+
+    # Rebuilding a linked target mustn't modify the cached object.
+    cake.filesys.removeIfLinked(self.targetPath)
+    cake.filesys.writeFile(self.targetPath, "new target")
+    self.assertEqual(
+      cake.filesys.readFile(rawPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+
+    # The raw object was stored first but used last so is kept.
+    otherPath = os.path.join(self.tempDir, "other.o")
+    cake.filesys.writeFile(otherPath, os.urandom(4000))
+    otherSize = cache.storeObject(_entryDigest, otherPath)
+    os.utime(cache.getObjectPath(_entryDigest), (2000, 2000))
+    self.assertEqual(
+      cake.objectcache.collectGarbage(cache.path, size + otherSize - 1),
+      (1, otherSize, size),
+      )
+
+    self.assertEqual(cake.objectcache.collectGarbage(cache.path, size - 1), (1, size, 0))
+    self.assertFalse(os.path.exists(rawPath))
+    self.assertFalse(os.path.exists(rawPath + ".used"))
+
+  def testRestoreOverLinkedTarget(self):
+    cache = self.createCache()
+    cache.storeObject(_objectDigest, self.sourcePath, link=True)
+    rawPath = cache.getRawObjectPath(_objectDigest)
+    otherPath = os.path.join(self.tempDir, "other.o")
+    cake.filesys.writeFile(otherPath, "other data" * 100)
+    cache.storeObject(_entryDigest, otherPath)
+
+    # Restoring a compressed object over a target linked to a raw object
+    # mustn't modify the raw object.
+    cache.restoreObject(_objectDigest, self.targetPath)
+    cache.restoreObject(_entryDigest, self.targetPath)
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(otherPath),
+      )
+    self.assertEqual(
+      cake.filesys.readFile(rawPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+
+    # Nor must a restore that fails part way through.
+    cache.restoreObject(_objectDigest, self.targetPath)
+    objectPath = cache.getObjectPath(_entryDigest)
+    cake.filesys.writeFile(objectPath, cake.filesys.readFile(objectPath)[:-4])
+    self.assertRaises(
+      EnvironmentError,
+      cache.restoreObject, _entryDigest, self.targetPath,
+      )
+    self.assertEqual(
+      cake.filesys.readFile(rawPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+
+  def testCollectGarbage(self):
+    cache = self.createCache()
+    size = cache.storeObject(_objectDigest, self.sourcePath)
+    cache.writeIndex(_targetDigest, [(_entryDigest, [u"/src/a.cpp"], _objectDigest)])
+    cache.storeEntry(_targetDigest, _entryDigest, [u"/src/a.cpp"])
+
+    self.assertEqual(cake.objectcache.collectGarbage(cache.path, size), (0, 0, size))
+    self.assertEqual(len(cache.readIndex(_targetDigest)), 1)
+
+    self.assertEqual(cake.objectcache.collectGarbage(cache.path, size - 1), (1, size, 0))
+    self.assertFalse(os.path.exists(cache.getObjectPath(_objectDigest)))
+    # The entry for the removed object is orphaned.
+    self.assertFalse(os.path.exists(os.path.dirname(cache.getIndexPath(_targetDigest))))
+
+class HttpObjectCacheTests(ObjectCacheTests, unittest.TestCase):
+
+  def setUp(self):
+    ObjectCacheTests.setUp(self)
+    self.server = cake.cacheserver.CacheServer(
+      ("127.0.0.1", 0),
+      os.path.join(self.tempDir, "server"),
+      )
+    self.serverThread = threading.Thread(target=self.server.serve_forever)
+    self.serverThread.setDaemon(True)
+    self.serverThread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    ObjectCacheTests.tearDown(self)
+
+  def createCache(self):
+    return cake.objectcache.HttpObjectCache(self.server.url)
+
+  def testServerStoresFileCache(self):
+    cache = self.createCache()
+    cache.storeObject(_objectDigest, self.sourcePath)
+    cache.writeIndex(_targetDigest, [(_entryDigest, [u"/src/a.cpp"], _objectDigest)])
+
+    # The server's directory can be used directly as a file cache.
+    fileCache = cake.objectcache.FileObjectCache(self.server.cache.path)
+    fileCache.restoreObject(_objectDigest, self.targetPath)
+    self.assertEqual(
+      cake.filesys.readFile(self.targetPath),
+      cake.filesys.readFile(self.sourcePath),
+      )
+    self.assertEqual(len(fileCache.readIndex(_targetDigest)), 1)
+
+class CacheWriterTests(unittest.TestCase):
+
+  def testFlushWaitsForWrites(self):
+    writer = cake.objectcache.CacheWriter()
+    release = threading.Event()
+    written = []
+    def write(i):
+      release.wait()
+      written.append(i)
+    for i in range(4):
+      self.assertTrue(writer.put(lambda i=i: write(i), 8))
+    self.assertEqual(written, [])
+    release.set()
+    writer.flush()
+    self.assertEqual(sorted(written), [0, 1, 2, 3])
+
+  def testQueueLimit(self):
+    writer = cake.objectcache.CacheWriter()
+    self.assertFalse(writer.put(lambda: None, 0))
+    writer.flush()
+
+class CacheStatisticsTests(unittest.TestCase):
+
+  def testMergeReports(self):
+    statistics = cake.objectcache.CacheStatistics()
+    statistics.recordHit(100)
+    statistics.recordMiss(statistics.NO_ENTRY)
+    statistics.recordMiss(statistics.DIGEST_MISMATCH)
+    statistics.recordStore(40)
+    statistics.recordUncacheable("MsvcCompiler")
+    self.assertTrue(statistics.used)
+
+    tempDir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tempDir, "report.json")
+      statistics.write(path)
+      merged = cake.objectcache.CacheStatistics()
+      self.assertFalse(merged.used)
+      merged.read(path)
+      merged.read(path)
+    finally:
+      shutil.rmtree(tempDir)
+
+    self.assertEqual(merged.lookups, 6)
+    self.assertEqual(merged.hits, 2)
+    self.assertEqual(merged.misses, {"no entry": 2, "digest mismatch": 2})
+    self.assertEqual(merged.restoredBytes, 200)
+    self.assertEqual(merged.storedBytes, 80)
+    self.assertEqual(merged.uncacheable, {"MsvcCompiler": 2})
+    summary = merged.format()
+    self.assertTrue("6 lookups, 2 hits (33%)" in summary)
+    self.assertTrue("2 targets could not be cached by MsvcCompiler" in summary)
+
+if __name__ == "__main__":
+  loader = unittest.TestLoader()
+  suite = unittest.TestSuite()
+  suite.addTests(loader.loadTestsFromTestCase(FileObjectCacheTests))
+  suite.addTests(loader.loadTestsFromTestCase(HttpObjectCacheTests))
+  suite.addTests(loader.loadTestsFromTestCase(CacheWriterTests))
+  suite.addTests(loader.loadTestsFromTestCase(CacheStatisticsTests))
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
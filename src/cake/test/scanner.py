@@ -0,0 +1,74 @@
+"""Include Scanner Unit Tests.
+"""
+
+import unittest
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+import cake.filesys
+import cake.scanner
+
+class IncludeScannerTests(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def _write(self, path, text):
+    path = os.path.join(self.tempDir, path)
+    cake.filesys.writeFile(path, text)
+    return path
+
+  def testScan(self):
+    source = self._write("src/main.c",
+      '#include "local.h"\n'
+      '  # include <lib.h>\n'
+      '#if 0\n'
+      '#include "missing.h"\n'
+      '#endif\n'
+      '#include <stdio.h>\n'
+      '#include SOME_MACRO\n'
+      )
+    local = self._write("src/local.h", '#include "lib.h"\n')
+    lib = self._write("inc/lib.h", '#include "sub/inner.h"\n#include <lib.h>\n')
+    inner = self._write("inc/sub/inner.h", '#include "../lib.h"\n')
+    forced = self._write("inc/forced.h", "int x;\n")
+    # Only found by the quoted include in local.h, angle brackets only
+    # search the include paths.
+    self._write("src/lib.h", "")
+
+    scanner = cake.scanner.IncludeScanner()
+    includePaths = [os.path.join(self.tempDir, "inc")]
+    paths, unresolved = scanner.scan(source, includePaths, [forced])
+    self.assertEqual(paths[:2], [forced, source])
+    self.assertEqual(
+      sorted(paths),
+      sorted([forced, source, local, os.path.join(self.tempDir, "src", "lib.h"), lib, inner]),
+      )
+    self.assertEqual(unresolved, set(['"missing.h"', '<stdio.h>']))
+
+    # Cached listings don't notice new files until they are invalidated.
+    missing = self._write("inc/missing.h", "")
+    paths, unresolved = scanner.scan(source, includePaths)
+    self.assertFalse(missing in paths)
+    scanner.invalidate(missing)
+    paths, unresolved = scanner.scan(source, includePaths)
+    self.assertTrue(missing in paths)
+    self.assertEqual(unresolved, set(['<stdio.h>']))
+
+    self.assertRaises(
+      EnvironmentError,
+      scanner.scan,
+      os.path.join(self.tempDir, "src", "none.c"),
+      includePaths,
+      )
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(IncludeScannerTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
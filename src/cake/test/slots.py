@@ -0,0 +1,81 @@
+"""Process Slots Unit Tests.
+"""
+
+import unittest
+import os
+import sys
+import threading
+
+import cake.slots
+
+class ProcessSlotsTests(unittest.TestCase):
+
+  def testLimits(self):
+    slots = cake.slots.ProcessSlots(
+      maxProcesses=3,
+      limits={cake.slots.LINK: 1},
+      )
+    compile1 = slots.acquire(cake.slots.COMPILE)
+    link1 = slots.acquire(cake.slots.LINK)
+
+    started = []
+    def run(kind):
+      slot = slots.acquire(kind)
+      started.append(kind)
+      slots.release(slot)
+    linkThread = threading.Thread(target=run, args=(cake.slots.LINK,))
+    linkThread.start()
+    linkThread.join(0.2)
+    self.assertEqual(started, []) # Waiting for the link slot.
+
+    compile2 = slots.acquire(cake.slots.COMPILE)
+    compileThread = threading.Thread(target=run, args=(cake.slots.COMPILE,))
+    compileThread.start()
+    compileThread.join(0.2)
+    self.assertEqual(started, []) # Waiting for any slot.
+
+    slots.release(link1)
+    linkThread.join()
+    compileThread.join()
+    self.assertEqual(sorted(started), [cake.slots.COMPILE, cake.slots.LINK])
+    slots.release(compile1)
+    slots.release(compile2)
+
+  def testParseJobServerAuth(self):
+    parse = cake.slots.parseJobServerAuth
+    self.assertEqual(parse(""), None)
+    self.assertEqual(parse(" -j8 --jobserver-fds=3,4 -j"), "3,4")
+    self.assertEqual(parse("k -j --jobserver-auth=fifo:/tmp/GMfifo1"), "fifo:/tmp/GMfifo1")
+
+  if os.name == "posix":
+    def testJobServer(self):
+      server = cake.slots.JobServer(2)
+      try:
+        environment = cake.slots.ProcessSlots(jobServer=server).getEnvironment(
+          {"MAKEFLAGS": "k -j4 --jobserver-auth=5,6"}
+          )
+        makeFlags = environment["MAKEFLAGS"]
+        self.assertTrue(makeFlags.startswith(" k -j2 --jobserver-auth="))
+
+        # The client has its own implicit slot and takes the one token.
+        client = cake.slots.JobServerClient.fromEnvironment(environment)
+        self.assertEqual(server.acquire(), None)
+        self.assertEqual(client.acquire(), None)
+        token = client.acquire()
+        self.assertEqual(token, "+")
+
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(server.acquire()))
+        thread.start()
+        thread.join(0.2)
+        self.assertEqual(acquired, [])
+        client.release(token)
+        thread.join()
+        self.assertEqual(acquired, ["+"])
+      finally:
+        server.close()
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(ProcessSlotsTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
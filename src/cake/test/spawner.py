@@ -0,0 +1,87 @@
+"""Spawner Unit Tests.
+"""
+
+import unittest
+import os
+import sys
+import threading
+import time
+
+import cake.spawner
+
+_script = "import sys; sys.stdout.write('out'); sys.stderr.write('err' * 100000); sys.exit(3)"
+
+class SpawnerTests(unittest.TestCase):
+
+  def testRunProcess(self):
+    exitCode, stdout, stderr = cake.spawner.runProcess([sys.executable, "-c", _script])
+    self.assertEqual(exitCode, 3)
+    self.assertEqual(stdout, "out")
+    self.assertEqual(stderr, "err" * 100000)
+
+  def testLineBuffer(self):
+    lines = []
+    buffer = cake.spawner.LineBuffer(lines.append)
+    for piece in ["a", "b\nc", "\n", "d\ne"]:
+      buffer.feed(piece)
+    self.assertEqual(lines, ["ab\n", "c\n", "d\n"])
+    buffer.flush()
+    self.assertEqual(lines, ["ab\n", "c\n", "d\n", "e"])
+
+  def testRunProcessWithFiles(self):
+    stderr = []
+    exitCode, stdout, _ = cake.spawner.runProcessWithFiles(
+      [sys.executable, "-c", _script],
+      onStderr=stderr.append,
+      )
+    self.assertEqual(exitCode, 3)
+    self.assertEqual(stdout, "out")
+    self.assertEqual("".join(stderr), "err" * 100000)
+
+  if os.name == "posix":
+    def testRunProcessStreaming(self):
+      # Output is passed on before the process finishes.
+      script = (
+        "import sys, time; sys.stderr.write('first'); sys.stderr.flush(); "
+        "time.sleep(0.5); sys.stdout.write('last')"
+        )
+      received = []
+      exitCode, stdout, stderr = cake.spawner.runProcess(
+        [sys.executable, "-c", script],
+        onStderr=lambda data: received.append((data, time.time())),
+        )
+      finished = time.time()
+      self.assertEqual((exitCode, stdout, stderr), (0, "last", ""))
+      self.assertEqual([data for data, _ in received], ["first"])
+      self.assertTrue(received[0][1] < finished - 0.3)
+
+    def testSpawner(self):
+      spawner = cake.spawner.Spawner()
+      try:
+        results = []
+        def run():
+          results.append(spawner.run([sys.executable, "-c", _script]))
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+        self.assertEqual(results, [(3, "out", "err" * 100000)] * 4)
+
+        self.assertEqual(spawner.run("echo $0", shell=True), (0, "/bin/sh\n", ""))
+
+        stderr = []
+        self.assertEqual(
+          spawner.run([sys.executable, "-c", _script], onStderr=stderr.append),
+          (3, "out", ""),
+          )
+        self.assertEqual("".join(stderr), "err" * 100000)
+        self.assertRaises(EnvironmentError, spawner.run, ["/nonexistent/program"])
+      finally:
+        spawner.close()
+      self.assertRaises(EnvironmentError, spawner.run, ["true"])
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(SpawnerTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
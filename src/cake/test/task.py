@@ -459,6 +459,31 @@ class TaskTests(unittest.TestCase):
     self.assertTrue(ta.succeeded)
     self.assertEqual(ta.result, "b")
 
+  def testTaskPriority(self):
+    import cake.threadpool
+    threadPool = cake.threadpool.WorkStealingThreadPool(numWorkers=1)
+    result = []
+    
+    blocker = threading.Event()
+    blockerTask = cake.task.Task(blocker.wait)
+    blockerTask.start(threadPool=threadPool)
+    
+    e = threading.Event()
+    tl = cake.task.Task(lambda: result.append("low"))
+    tl.startAfter(blockerTask, threadPool=threadPool)
+    th = cake.task.Task(lambda: result.append("high"))
+    th.startAfter(blockerTask, threadPool=threadPool, priority=5)
+    tl.addCallback(e.set)
+    
+    self.assertEqual(th.priority, 5)
+    self.assertEqual(tl.priority, 0)
+    
+    blocker.set()
+    e.wait(0.5)
+    threadPool.shutdown()
+    
+    self.assertEqual(result, ["high", "low"])
+
 if __name__ == "__main__":
   suite = unittest.TestLoader().loadTestsFromTestCase(TaskTests)
   runner = unittest.TextTestRunner(verbosity=2)
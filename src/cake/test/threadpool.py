@@ -38,6 +38,94 @@ class ThreadPoolTests(unittest.TestCase):
     
     self.assertEqual(len(result), 50)
 
+  def testWorkStealingMultipleJobs(self):
+    jobCount = 500
+    result = []
+    s = threading.Semaphore(0)
+    def job():
+      result.append(None)
+      s.release()
+       
+    threadPool = cake.threadpool.WorkStealingThreadPool(numWorkers=10)
+    for _ in xrange(jobCount):
+      threadPool.queueJob(job)
+    for _ in xrange(jobCount):
+      s.acquire()
+    threadPool.shutdown()
+    
+    self.assertEqual(len(result), jobCount)
+
+  def testWorkStealingNestedJobs(self):
+    # Jobs queued by a worker go on its own queue and must be stolen by
+    # the other workers.
+    jobCount = 200
+    result = []
+    s = threading.Semaphore(0)
+    def job():
+      result.append(None)
+      s.release()
+    def spawner():
+      for _ in xrange(jobCount):
+        threadPool.queueJob(job)
+       
+    threadPool = cake.threadpool.WorkStealingThreadPool(numWorkers=4)
+    threadPool.queueJob(spawner)
+    for _ in xrange(jobCount):
+      s.acquire()
+    threadPool.shutdown()
+    
+    self.assertEqual(len(result), jobCount)
+
+  def testWorkStealingPriority(self):
+    result = []
+    blocker = threading.Event()
+    done = threading.Event()
+    
+    threadPool = cake.threadpool.WorkStealingThreadPool(numWorkers=1)
+    # Keep the only worker busy while the other jobs are queued.
+    threadPool.queueJob(blocker.wait)
+    threadPool.queueJob(lambda: result.append("low"), priority=-1)
+    threadPool.queueJob(lambda: result.append("normal"))
+    threadPool.queueJob(lambda: result.append("high"), priority=10)
+    threadPool.queueJob(lambda: result.append("front"), front=True)
+    threadPool.queueJob(done.set, priority=-2)
+    blocker.set()
+    done.wait()
+    threadPool.shutdown()
+    
+    self.assertEqual(result, ["high", "front", "normal", "low"])
+
+  def testWorkStealingPriorityAcrossQueues(self):
+    # A worker runs a higher priority job from another worker's queue
+    # before a lower priority job on its own queue.
+    result = []
+    started = threading.Semaphore(0)
+    finished = threading.Semaphore(0)
+    blockers = [threading.Event(), threading.Event()]
+
+    threadPool = cake.threadpool.WorkStealingThreadPool(numWorkers=2)
+    def block():
+      started.release()
+      blockers[threadPool._local.index].wait()
+    def record(name):
+      result.append(name)
+      finished.release()
+    # Keep both workers busy while the other jobs are queued. Jobs queued
+    # from this thread are shared out between the queues in turn.
+    threadPool.queueJob(block)
+    threadPool.queueJob(block)
+    started.acquire()
+    started.acquire()
+    threadPool.queueJob(lambda: record("low"), priority=-1)  # Worker 0's queue.
+    threadPool.queueJob(lambda: record("high"), priority=10) # Worker 1's queue.
+    blockers[0].set()
+    finished.acquire()
+    finished.acquire()
+    blockers[1].set()
+    threadPool.shutdown()
+
+    self.assertEqual(result, ["high", "low"])
+
 if __name__ == "__main__":
   suite = unittest.TestLoader().loadTestsFromTestCase(ThreadPoolTests)
   runner = unittest.TextTestRunner(verbosity=2)
@@ -0,0 +1,79 @@
+"""Trace Unit Tests.
+"""
+
+import unittest
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+
+import cake.task
+import cake.trace
+
+class TracerTests(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.tracer = cake.trace.Tracer()
+    self.oldTracer = cake.trace.setTracer(self.tracer)
+
+  def tearDown(self):
+    cake.trace.setTracer(self.oldTracer)
+    shutil.rmtree(self.tempDir)
+
+  def _writeAndLoad(self):
+    path = os.path.join(self.tempDir, "trace.json")
+    self.tracer.write(path)
+    f = open(path, "r")
+    try:
+      return json.load(f)["traceEvents"]
+    finally:
+      f.close()
+
+  def testTaskTransitionsRecorded(self):
+    def buildSomething():
+      pass
+
+    e = threading.Event()
+    t = cake.task.Task(buildSomething)
+    t.addCallback(e.set)
+    t.start()
+    e.wait(0.5)
+    self.assertTrue(t.succeeded)
+
+    events = [ev for ev in self._writeAndLoad()
+              if ev.get("args", {}).get("task") == id(t)
+              or ev.get("id") == id(t)]
+    phases = [(ev["ph"], ev["name"]) for ev in events]
+
+    self.assertEqual(phases[0], ("i", "created"))
+    self.assertEqual(events[0]["args"]["func"], "buildSomething")
+    self.assertTrue(("i", cake.task.Task.State.WAITING_FOR_START) in phases)
+    self.assertTrue(("b", "queued") in phases)
+    self.assertTrue(("e", "queued") in phases)
+    self.assertTrue(("X", "buildSomething") in phases)
+    self.assertEqual(phases[-1], ("i", cake.task.Task.State.SUCCEEDED))
+
+  def testMergeAndThreadNames(self):
+    self.tracer.span("child", "process", self.tracer.now())
+
+    otherPath = os.path.join(self.tempDir, "other.json")
+    other = cake.trace.Tracer()
+    other.instant("other", "test")
+    other.write(otherPath)
+    self.tracer.merge(otherPath)
+
+    events = self._writeAndLoad()
+    names = [ev["name"] for ev in events]
+    self.assertTrue("child" in names)
+    self.assertTrue("other" in names)
+    threadNames = [ev["args"]["name"] for ev in events if ev["ph"] == "M"]
+    self.assertTrue(threading.currentThread().getName() in threadNames)
+
+if __name__ == "__main__":
+  suite = unittest.TestLoader().loadTestsFromTestCase(TracerTests)
+  runner = unittest.TextTestRunner(verbosity=2)
+  sys.exit(not runner.run(suite).wasSuccessful())
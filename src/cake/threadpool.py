@@ -15,6 +15,8 @@ import platform
 import traceback
 import atexit
 import collections
+import heapq
+import itertools
 
 import cake.system
 
@@ -71,13 +73,15 @@ class ThreadPool(object):
       self._workers.append(worker)
     
     # Make sure the threads are joined before program exit.
-    atexit.register(self._shutdown)
+    atexit.register(self.shutdown)
     
-  def _shutdown(self):
+  def shutdown(self):
     """Shutdown the ThreadPool.
     
     On shutdown we complete any currently executing jobs then exit. Jobs
     waiting on the queue may not be executed.
+    
+    This is called automatically at program exit.
     """
     # Signal that we've finished.
     self._finished = True
@@ -103,7 +107,7 @@ class ThreadPool(object):
     """
     return len(self._workers)
   
-  def queueJob(self, callable, front=False):
+  def queueJob(self, callable, front=False, priority=0):
     """Queue a new job to be executed by the thread pool.
     
     @param callable: The job to queue.
@@ -113,6 +117,10 @@ class ThreadPool(object):
     thread pool's job queue, otherwise append it to the end of
     the job queue.
     @type front: boolean
+    
+    @param priority: The priority of the job. Ignored by this thread
+    pool, see L{WorkStealingThreadPool}.
+    @type priority: int or float
     """
     self._wakeCondition.acquire()
     try:
@@ -146,3 +154,189 @@ class ThreadPool(object):
       except Exception:
         sys.stderr.write("Uncaught Exception:\n")
         sys.stderr.write(traceback.format_exc())
+
+class WorkStealingThreadPool(object):
+  """A thread pool with a job queue per worker thread.
+  
+  Jobs queued by a worker thread are put on that worker's queue, other
+  jobs are shared out between the workers. Each queue has its own lock
+  and only a single sleeping worker is woken for each new job, so this
+  pool scales better to large numbers of workers than L{ThreadPool}.
+  
+  Jobs with a higher priority are run before jobs with a lower priority,
+  whichever queue they are on. A worker only prefers the jobs on its own
+  queue over those of the same priority on other queues. Jobs with equal
+  priority on a queue are run in the order they were queued, unless
+  queued with front=True.
+  """
+  
+  def __init__(self, numWorkers):
+    """Initialise the thread pool.
+    
+    @param numWorkers: Number of worker threads to start.
+    @type numWorkers: int
+    """
+    numWorkers = max(1, numWorkers)
+    self._queues = [[] for _ in xrange(numWorkers)]
+    self._queueLocks = [threading.Lock() for _ in xrange(numWorkers)]
+    self._workers = []
+    self._wakeCondition = threading.Condition(threading.Lock())
+    self._sleeping = 0
+    self._finished = False
+    self._sequence = itertools.count()
+    self._nextQueue = itertools.count()
+    self._local = threading.local()
+
+    for index in xrange(numWorkers):
+      worker = threading.Thread(target=self._runThread, args=(index,))
+      worker.daemon = True
+      worker.start()
+      self._workers.append(worker)
+    
+    # Make sure the threads are joined before program exit.
+    atexit.register(self.shutdown)
+    
+  def shutdown(self):
+    """Shutdown the ThreadPool.
+    
+    On shutdown we complete any currently executing jobs then exit. Jobs
+    waiting on the queues may not be executed.
+    """
+    self._finished = True
+    
+    self._wakeCondition.acquire()
+    try:
+      self._wakeCondition.notifyAll()
+    finally:      
+      self._wakeCondition.release()      
+      
+    for thread in self._workers:
+      thread.join()
+    
+  @property
+  def numWorkers(self):
+    """Returns the number of worker threads available to process jobs.
+    
+    @return: The number of worker threads available to process jobs.
+    @rtype: int
+    """
+    return len(self._workers)
+  
+  def queueJob(self, callable, front=False, priority=0):
+    """Queue a new job to be executed by the thread pool.
+    
+    @param callable: The job to queue.
+    @type callable: any callable
+    
+    @param front: If True then run the job before any other waiting jobs
+    of the same priority.
+    @type front: boolean
+    
+    @param priority: The priority of the job. Jobs with higher priorities
+    are run first.
+    @type priority: int or float
+    """
+    if self._finished: # Don't add jobs if we've shutdown.
+      return
+    
+    index = getattr(self._local, "index", None)
+    if index is None:
+      index = self._nextQueue.next() % len(self._queues)
+    
+    sequence = self._sequence.next()
+    if front:
+      sequence = -sequence
+    
+    lock = self._queueLocks[index]
+    lock.acquire()
+    try:
+      heapq.heappush(self._queues[index], (-priority, sequence, callable))
+    finally:
+      lock.release()
+    
+    # Workers register as sleeping before they make a final check of the
+    # queues, so either they will find this job or we will wake them.
+    if self._sleeping:
+      self._wakeCondition.acquire()
+      try:
+        self._wakeCondition.notify()
+      finally:
+        self._wakeCondition.release()
+  
+  def _popJob(self, index):
+    """Pop the highest priority job waiting on any queue, stealing it from
+    another worker if required.
+    
+    @return: The job or None if all queues are empty.
+    """
+    queues = self._queues
+    locks = self._queueLocks
+    
+    while True:
+      best = None
+      bestEntry = None
+      
+      queue = queues[index]
+      if queue:
+        try:
+          bestEntry = queue[0]
+          best = index
+        except IndexError:
+          pass # Emptied by another thread.
+      
+      for i in xrange(len(queues)):
+        queue = queues[i]
+        if i == index or not queue:
+          continue
+        try:
+          entry = queue[0]
+        except IndexError:
+          continue # Emptied by another thread.
+        if best is None:
+          isBetter = True
+        elif best == index:
+          # Only steal jobs with a higher priority than our own.
+          isBetter = entry[0] < bestEntry[0]
+        else:
+          isBetter = entry < bestEntry
+        if isBetter:
+          best = i
+          bestEntry = entry
+      if best is None:
+        return None
+      
+      lock = locks[best]
+      lock.acquire()
+      try:
+        queue = queues[best]
+        if queue:
+          return heapq.heappop(queue)[2]
+      finally:
+        lock.release()
+  
+  def _runThread(self, index):
+    """Process jobs continuously until dismissed.
+    """
+    self._local.index = index
+    while not self._finished:
+      job = self._popJob(index)
+      if job is None:
+        self._wakeCondition.acquire()
+        try:
+          self._sleeping += 1
+          try:
+            job = self._popJob(index)
+            if job is None and not self._finished:
+              self._wakeCondition.wait()
+          finally:
+            self._sleeping -= 1
+        finally:
+          self._wakeCondition.release()
+        if job is None:
+          continue
+            
+      try:
+        job()
+      except Exception:
+        sys.stderr.write("Uncaught Exception:\n")
+        sys.stderr.write(traceback.format_exc())
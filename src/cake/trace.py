@@ -0,0 +1,226 @@
+"""Build Tracing.
+
+Records a timeline of the build, such as task state transitions and the
+processes run by tools, and writes it out in the Chrome Trace Event
+format. The trace can be viewed with chrome://tracing or Perfetto.
+
+@see: Cake Build System (http://sourceforge.net/projects/cake-build)
+@copyright: Copyright (c) 2010 Lewis Baker, Stuart McMahon.
+@license: Licensed under the MIT license.
+"""
+
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+def _describe(func):
+  """Get a name to show in the trace for a task function.
+  """
+  if func is None:
+    return "<none>"
+  name = getattr(func, "__name__", None)
+  if name is None:
+    name = type(func).__name__
+  return name
+
+def setTracer(tracer):
+  """Set the tracer that build events are recorded to.
+
+  @param tracer: The new tracer or None to stop tracing.
+  @type tracer: L{Tracer} or None
+
+  @return: The previous tracer. This is initially None.
+  @rtype: L{Tracer} or None
+  """
+  global _tracer
+  oldTracer = _tracer
+  _tracer = tracer
+  return oldTracer
+
+def getTracer():
+  """Get the tracer that build events should be recorded to.
+
+  @return: The current tracer or None if not tracing.
+  @rtype: L{Tracer} or None
+  """
+  return _tracer
+
+class Tracer(object):
+  """Records build events for a Chrome Trace Event file.
+
+  Timestamps passed to and returned from the tracer are in seconds, as
+  returned by L{now}. They are written out as absolute times so that traces
+  from several processes can be merged.
+  """
+
+  def __init__(self):
+    self._events = []
+    self._lock = threading.Lock()
+    self._threadNames = {}
+    self._pid = os.getpid()
+
+  def now(self):
+    """Get the current time.
+
+    @rtype: float
+    """
+    return time.time()
+
+  def _makeEvent(self, phase, name, category, timestamp, args):
+    thread = threading.currentThread()
+    tid = thread.ident
+    if tid not in self._threadNames:
+      self._threadNames[tid] = thread.getName()
+    event = {
+      "ph": phase,
+      "name": name,
+      "cat": category,
+      "ts": int(timestamp * 1000000),
+      "pid": self._pid,
+      "tid": tid,
+      }
+    if args:
+      event["args"] = args
+    return event
+
+  def _addEvent(self, event):
+    self._lock.acquire()
+    try:
+      self._events.append(event)
+    finally:
+      self._lock.release()
+
+  def instant(self, name, category, args=None):
+    """Record an instantaneous event on the current thread.
+
+    @param name: The name of the event.
+    @type name: string
+    @param category: The category of the event, eg. 'task'.
+    @type category: string
+    @param args: Extra information to show with the event.
+    @type args: dict or None
+    """
+    event = self._makeEvent("i", name, category, self.now(), args)
+    event["s"] = "t"
+    self._addEvent(event)
+
+  def span(self, name, category, startTime, endTime=None, args=None):
+    """Record something that ran on the current thread.
+
+    @param name: The name of the span.
+    @type name: string
+    @param category: The category of the span, eg. 'process'.
+    @type category: string
+    @param startTime: The time the span started.
+    @type startTime: float
+    @param endTime: The time the span ended, or None if it ended now.
+    @type endTime: float or None
+    @param args: Extra information to show with the span.
+    @type args: dict or None
+    """
+    if endTime is None:
+      endTime = self.now()
+    event = self._makeEvent("X", name, category, startTime, args)
+    event["dur"] = int((endTime - startTime) * 1000000)
+    self._addEvent(event)
+
+  def beginAsync(self, name, category, id, args=None):
+    """Record the start of something that may end on another thread.
+
+    @param id: An id that is unique among the category's current
+    asynchronous spans.
+    @type id: int
+    """
+    event = self._makeEvent("b", name, category, self.now(), args)
+    event["id"] = id
+    self._addEvent(event)
+
+  def endAsync(self, name, category, id):
+    """Record the end of something started with L{beginAsync}.
+    """
+    event = self._makeEvent("e", name, category, self.now(), None)
+    event["id"] = id
+    self._addEvent(event)
+
+  def taskCreated(self, task, func):
+    """Record the creation of a task.
+    """
+    self.instant("created", "task", {
+      "task": id(task),
+      "func": _describe(func),
+      })
+
+  def taskState(self, task, state):
+    """Record a task changing to a new state.
+
+    @param state: One of the L{cake.task.Task.State} values.
+    @type state: string
+    """
+    self.instant(state, "task", {"task": id(task)})
+
+  def taskQueued(self, task):
+    """Record a task being queued to its thread pool.
+    """
+    self.beginAsync("queued", "queue", id(task), {"priority": task.priority})
+
+  def taskDequeued(self, task):
+    """Record a task being picked up by a worker thread.
+    """
+    self.endAsync("queued", "queue", id(task))
+
+  def taskExecuted(self, task, func, startTime):
+    """Record a task's function having run on the current thread.
+    """
+    self.span(_describe(func), "task", startTime, args={"task": id(task)})
+
+  def merge(self, path):
+    """Add the events from a trace file written by another process.
+
+    @param path: The path of the Chrome Trace Event JSON file to read.
+    @type path: string
+
+    @raise EnvironmentError: If the file could not be read.
+    @raise ValueError: If the file is not a valid trace.
+    """
+    f = open(path, "r")
+    try:
+      events = json.load(f)["traceEvents"]
+    finally:
+      f.close()
+
+    self._lock.acquire()
+    try:
+      self._events.extend(events)
+    finally:
+      self._lock.release()
+
+  def write(self, path):
+    """Write the trace to a file.
+
+    @param path: The path of the Chrome Trace Event JSON file to write.
+    @type path: string
+    """
+    self._lock.acquire()
+    try:
+      events = list(self._events)
+      threadNames = dict(self._threadNames)
+    finally:
+      self._lock.release()
+
+    for tid, name in threadNames.items():
+      events.append({
+        "ph": "M",
+        "name": "thread_name",
+        "pid": self._pid,
+        "tid": tid,
+        "args": {"name": name},
+        })
+
+    f = open(path, "w")
+    try:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    finally:
+      f.close()
@@ -12,20 +12,326 @@ import time
 import zipfile
 import zlib
 
-def compressFile(source, target):
+try:
+  import bz2
+except ImportError:
+  bz2 = None
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+CHUNK_SIZE = 1024 * 1024
+"""The number of bytes read at a time when compressing or decompressing.
+
+@type: int
+"""
+
+_codecMagic = "CKZ"
+
+class _Decompressor(object):
+  """Adapts a decompression object to a common interface.
+  """
+
+  def __init__(self, decompressor):
+    self._decompressor = decompressor
+
+  def decompress(self, data):
+    return self._decompressor.decompress(data)
+
+  def flush(self):
+    """Return any remaining data.
+
+    @raise EnvironmentError: If the compressed data was truncated.
+    """
+    if not self._isComplete():
+      raise EnvironmentError("compressed data is truncated")
+    return ""
+
+  def _isComplete(self):
+    return self._decompressor.eof
+
+class _ZlibDecompressor(_Decompressor):
+
+  def flush(self):
+    if not self._isComplete():
+      raise EnvironmentError("compressed data is truncated")
+    return self._decompressor.flush()
+
+  def _isComplete(self):
+    eof = getattr(self._decompressor, "eof", None)
+    if eof is not None:
+      return eof
+    # Older versions of zlib don't say whether the end of the stream was
+    # found, but any data after the end is left unused.
+    self._decompressor.decompress("\0")
+    return bool(self._decompressor.unused_data)
+
+class _Bz2Decompressor(_Decompressor):
+
+  def _isComplete(self):
+    eof = getattr(self._decompressor, "eof", None)
+    if eof is not None:
+      return eof
+    # Older versions of bz2 raise EOFError for data after the end.
+    try:
+      self._decompressor.decompress("\0")
+    except EOFError:
+      return True
+    return False
+
+class _Copier(object):
+  """A compressor or decompressor that leaves data unchanged.
+  """
+
+  def compress(self, data):
+    return data
+
+  decompress = compress
+
+  def flush(self):
+    return ""
+
+class Codec(object):
+  """A compression method for cached files.
+
+  @ivar name: The name of the codec, eg. 'zlib:1'.
+  @type name: string
+  """
+
+  id = None
+  """The character that identifies the codec in a compressed file's header,
+  or None if the codec's files have no header.
+
+  @type: string or None
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return "<%s %s>" % (self.__class__.__name__, self.name)
+
+  def compressor(self):
+    """Create an object with compress(data) and flush() methods that
+    compresses a stream.
+    """
+    raise NotImplementedError()
+
+  def decompressor(self):
+    """Create an object with decompress(data) and flush() methods that
+    decompresses a stream.
+    """
+    raise NotImplementedError()
+
+class ZlibCodec(Codec):
+  """zlib compression.
+
+  Files have no header, as written by older versions of Cake.
+  """
+
+  def __init__(self, name, level=1):
+    Codec.__init__(self, name)
+    self.level = level
+
+  def compressor(self):
+    return zlib.compressobj(self.level)
+
+  def decompressor(self):
+    return _ZlibDecompressor(zlib.decompressobj())
+
+class Bz2Codec(Codec):
+  """bzip2 compression.
+  """
+
+  id = "b"
+
+  def __init__(self, name, level=9):
+    Codec.__init__(self, name)
+    self.level = level
+
+  def compressor(self):
+    return bz2.BZ2Compressor(self.level)
+
+  def decompressor(self):
+    return _Bz2Decompressor(bz2.BZ2Decompressor())
+
+class LzmaCodec(Codec):
+  """LZMA (xz) compression.
+  """
+
+  id = "x"
+
+  def __init__(self, name, level=0):
+    Codec.__init__(self, name)
+    self.level = level
+
+  def compressor(self):
+    return lzma.LZMACompressor(preset=self.level)
+
+  def decompressor(self):
+    return _Decompressor(lzma.LZMADecompressor())
+
+class StoreCodec(Codec):
+  """No compression.
+  """
+
+  id = "n"
+
+  def compressor(self):
+    return _Copier()
+
+  def decompressor(self):
+    return _Copier()
+
+_codecTypes = {
+  "zlib": (ZlibCodec, zlib, range(0, 10)),
+  "bz2": (Bz2Codec, bz2, range(1, 10)),
+  "lzma": (LzmaCodec, lzma, range(0, 10)),
+  "none": (StoreCodec, True, None),
+  }
+
+_headerCodecNames = {
+  Bz2Codec.id: "bz2",
+  LzmaCodec.id: "lzma",
+  StoreCodec.id: "none",
+  }
+
+def getCodec(name):
+  """Get a codec by name.
+
+  The name is one of 'zlib', 'bz2', 'lzma' or 'none', optionally followed
+  by a colon and a compression level, eg. 'zlib:6'.
+
+  @param name: The name of the codec.
+  @type name: string
+
+  @rtype: L{Codec}
+
+  @raise ValueError: If the name is invalid or the codec isn't available.
+  """
+  kind, _, level = name.partition(":")
+  try:
+    codecType, module, levels = _codecTypes[kind]
+  except KeyError:
+    raise ValueError("unknown codec '%s'" % name)
+  if module is None:
+    raise ValueError("codec '%s' is not available, the %s module is missing" % (name, kind))
+  if not level:
+    return codecType(name)
+  try:
+    level = int(level)
+  except ValueError:
+    level = None
+  if levels is None or level not in levels:
+    raise ValueError("invalid level for codec '%s'" % name)
+  return codecType(name, level)
+
+def _codecErrors():
+  errors = [zlib.error, EOFError, ValueError]
+  if lzma is not None:
+    errors.append(lzma.LZMAError)
+  return tuple(errors)
+
+def compressStream(source, target, codec=None):
+  """Compress the contents of a file object and write it to another.
+
+  The data is compressed a chunk at a time so the whole file is never
+  held in memory.
+
+  @param source: The file object to read uncompressed data from.
+  @type source: file
+  @param target: The file object to write compressed data to.
+  @type target: file
+  @param codec: The codec to compress with, or None for zlib level 1.
+  @type codec: L{Codec} or None
+
+  @return: The number of bytes written.
+  @rtype: int
+  """
+  if codec is None:
+    codec = _defaultCodec
+  size = 0
+  if codec.id is not None:
+    header = _codecMagic + codec.id
+    target.write(header)
+    size += len(header)
+  try:
+    compressor = codec.compressor()
+    while True:
+      data = source.read(CHUNK_SIZE)
+      if not data:
+        break
+      data = compressor.compress(data)
+      target.write(data)
+      size += len(data)
+    data = compressor.flush()
+  except _codecErrors(), e:
+    raise EnvironmentError(str(e))
+  target.write(data)
+  size += len(data)
+  return size
+
+def decompressStream(source, target):
+  """Decompress the contents of a file object and write it to another.
+
+  The codec is determined from the compressed data's header.
+
+  @param source: The file object to read compressed data from.
+  @type source: file
+  @param target: The file object to write uncompressed data to.
+  @type target: file
+
+  @raise EnvironmentError: If the data is invalid or truncated.
+  """
+  data = source.read(CHUNK_SIZE)
+  headerLen = len(_codecMagic) + 1
+  if data[:len(_codecMagic)] == _codecMagic:
+    name = _headerCodecNames.get(data[headerLen-1:headerLen], None)
+    if name is None:
+      raise EnvironmentError("compressed data has an unknown codec")
+    try:
+      codec = getCodec(name)
+    except ValueError, e:
+      raise EnvironmentError(str(e))
+    data = data[headerLen:]
+  else:
+    codec = _defaultCodec
+  try:
+    decompressor = codec.decompressor()
+    while data:
+      target.write(decompressor.decompress(data))
+      data = source.read(CHUNK_SIZE)
+    target.write(decompressor.flush())
+  except _codecErrors(), e:
+    raise EnvironmentError(str(e))
+
+def compressFile(source, target, codec=None):
   """Compress the contents of a file and write it to another file.
   
   @param source: The path of the file to compress.
   @type source: string
   @param target: The path of the compressed file.
   @type target: string
+  @param codec: The codec to compress with, or None for zlib level 1.
+  @type codec: L{Codec} or None
+
+  @return: The size of the compressed file.
+  @rtype: int
   """
-  data = cake.filesys.readFile(source)
+  cake.filesys.makeDirs(os.path.dirname(target))
+  s = open(source, "rb")
   try:
-    data = zlib.compress(data, 1)
-  except zlib.error, e:
-    raise EnvironmentError(str(e))
-  cake.filesys.writeFile(target, data)
+    t = open(target, "wb")
+    try:
+      return compressStream(s, t, codec)
+    finally:
+      t.close()
+  finally:
+    s.close()
 
 def decompressFile(source, target):
   """Decompress the contents of a file and write it to another file.
@@ -35,13 +341,19 @@ def decompressFile(source, target):
   @param target: The path of the decompressed file.
   @type target: string
   """
-  data = cake.filesys.readFile(source)
+  s = open(source, "rb")
   try:
-    data = zlib.decompress(data)
-  except zlib.error, e:
-    raise EnvironmentError(str(e))
-  cake.filesys.writeFile(target, data)
-  
+    cake.filesys.makeDirs(os.path.dirname(target))
+    t = open(target, "wb")
+    try:
+      decompressStream(s, t)
+    finally:
+      t.close()
+  finally:
+    s.close()
+
+_defaultCodec = ZlibCodec("zlib:1")
+
 def findFilesToCompress(sourcePath, includeMatch=None):
   """Return a dictionary of files in a given directory.
   